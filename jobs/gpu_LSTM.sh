@@ -2,6 +2,7 @@
 
 #SBATCH --job-name=gpu_LSTM-bdTrueStat   
 #SBATCH --time=24:00:00          
+#SBATCH --signal=B:USR1@600
 #SBATCH --nodes=1
 #SBATCH --cpus-per-task=24
 #SBATCH --constraint=gpu
@@ -13,4 +14,4 @@
 
 export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
 module load daint-gpu PyTorch      
-python3 ../src/LSTM_main.py --noise_dim 0 --statics 1 --bidirectional 1 --debug 0 # no noise, static features addes, bidirectional, training mode
\ No newline at end of file
+exec python3 ../src/LSTM_main.py --noise_dim 0 --statics 1 --bidirectional 1 --debug 0 --resume 1 # no noise, static features addes, bidirectional, training mode
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 #SBATCH --job-name=gpu_LSTM_AE_bdTrue3
 #SBATCH --time=24:00:00 
+#SBATCH --signal=B:USR1@600
 #SBATCH --nodes=1
 #SBATCH --cpus-per-task=24
 #SBATCH --constraint=gpu
@@ -13,4 +14,4 @@
 
 export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
 module load daint-gpu PyTorch     
-python3 ../src/LSTM_AE_main.py --num_features 3 --bidirectional 1 --debug 0 # no bidirectional, training mode
+exec python3 ../src/LSTM_AE_main.py --num_features 3 --bidirectional 1 --debug 0 --resume 1 # no bidirectional, training mode
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+#SBATCH --job-name=gpu_sweep
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=24
+#SBATCH --time=24:00:00
+#SBATCH --partition=earth-4
+#SBATCH --constraint=rhel8
+#SBATCH --gres=gpu:a100:1
+#SBATCH --mail-type=BEGIN
+#SBATCH --mail-type=END,FAIL     
+#SBATCH --output=gpu_sweep.out
+#SBATCH --error=gpu_sweep.err
+
+module load gcc/9.4.0-pe5.34 miniconda3/4.12.0 lsfm-init-miniconda/1.0.0	
+conda activate my_env
+python3 ../src/sweep.py --configs sweep_configs.json --num_workers 6 # all configurations on one loaded dataset
@@ -5,6 +5,7 @@
 #SBATCH --ntasks-per-node=1
 #SBATCH --cpus-per-task=1
 #SBATCH --time=24:00:00
+#SBATCH --signal=B:USR1@600
 #SBATCH --partition=earth-4
 #SBATCH --constraint=rhel8
 #SBATCH --gres=gpu:a100:1
@@ -15,4 +16,4 @@
 
 module load gcc/9.4.0-pe5.34 miniconda3/4.12.0 lsfm-init-miniconda/1.0.0	
 conda activate my_env
-python3 ../src/LSTM_main.py --noise_dim 0 --statics 1 --hydro 1 --debug 0 
+exec python3 ../src/LSTM_main.py --noise_dim 0 --statics 1 --hydro 1 --debug 0 --resume 1 
@@ -16,6 +16,9 @@ import multiprocessing
 # user functions
 from dataset import CamelDataset
 from models import Hydro_LSTM_AE
+from scheduler import SuccessiveHalving, SuccessiveHalvingCallback
+from registry import RunRegistry, RegistryCallback
+from checkpointing import AsyncAtomicCheckpointIO, PreemptionCallback, resume_checkpoint
 from utils import MetricsCallback, NSELoss
 
 
@@ -25,6 +28,11 @@ def parse_args():
     parser.add_argument('--num_features', type=int, default=27, help="Number of features in the encoded space")
     parser.add_argument('--bidirectional', type=int, default=1, help="Bidirectionality of LSTM decoder. 0 False, else True")
     parser.add_argument('--debug', type=int, default=0, help="If debug mode is on load only 15 basins. 0 False, else True")
+    parser.add_argument('--decoder', type=str, default="lstm", help="Decoder of the autoencoder, 'lstm' or 'tcn' (causal temporal convolutions)")
+    parser.add_argument('--asha_dir', type=str, default="", help="Folder shared by runs for successive halving. Empty string disables it")
+    parser.add_argument('--asha_min_epoch', type=int, default=100, help="Epoch of the first successive halving rung")
+    parser.add_argument('--asha_reduction_factor', type=int, default=3, help="Fraction 1/factor of runs continuing at each rung")
+    parser.add_argument('--resume', type=int, default=0, help="Resume from the last or preempted checkpoint if present. 0 False, else True")
     args=parser.parse_args()
     return args
 
@@ -105,7 +113,8 @@ if __name__ == '__main__':
                     bidirectional = bool(args.bidirectional),
                     linear=512,
                     num_force_attributes = len(force_attributes),
-                    warmup = 45)
+                    warmup = 45,
+                    decoder = args.decoder)
     
     print("Training and Validation lengths (days): %d"%model.seq_len)
     print("Warmup days: %d"%model.warmup)
@@ -120,11 +129,20 @@ if __name__ == '__main__':
     check_val_every_n_epoch = 10
     save_top_k = int(max_epochs/check_val_every_n_epoch)
 
-    dirpath = "checkpoints/lstm-ae-bd"+str(bool(args.bidirectional))+"-E"+str(args.num_features)+"/"
+    dirpath = "checkpoints/lstm-ae-bd"+str(bool(args.bidirectional))+"-E"+str(args.num_features)
+    if args.decoder != "lstm":
+        dirpath += "-"+args.decoder
+    dirpath += "/"
+    callbacks = []
+    if args.asha_dir:
+        # stop the run early if it falls behind the others at a rung
+        scheduler = SuccessiveHalving(log_dir=args.asha_dir, min_epoch=args.asha_min_epoch, reduction_factor=args.asha_reduction_factor, max_epoch=max_epochs)
+        # the threads of this process are its share of the node, rebalanced among the active runs at every rung
+        callbacks.append(SuccessiveHalvingCallback(scheduler, dirpath.split("/")[-2], num_threads=torch.get_num_threads()))
     
     metrics_callback = MetricsCallback(
         dirpath=dirpath,
-        filename="metrics.pt",
+        filename="metrics.bin",
     )
 
     checkpoint_model = ModelCheckpoint(
@@ -135,11 +153,17 @@ if __name__ == '__main__':
             dirpath=dirpath,
             filename="model-{epoch:02d}",
         )
+    # keep the run registry up to date
+    callbacks.append(RegistryCallback(RunRegistry(), dirpath.split("/")[-2], dirpath, "lstm-ae"))
+    # save a resumable checkpoint on SIGUSR1/SIGTERM before the job is killed
+    callbacks.append(PreemptionCallback(dirpath=dirpath))
+    ckpt_path = resume_checkpoint(dirpath) if args.resume else None
+    print("Resume from checkpoint: ", ckpt_path)
     
 
  
     # define trainer 
-    trainer = pl.Trainer(max_epochs=max_epochs, callbacks=[checkpoint_model,metrics_callback], accelerator=str(device),devices=1, check_val_every_n_epoch=check_val_every_n_epoch, logger=False, gradient_clip_val=1.0, gradient_clip_algorithm="value")
+    trainer = pl.Trainer(max_epochs=max_epochs, callbacks=[checkpoint_model,metrics_callback]+callbacks, plugins=[AsyncAtomicCheckpointIO()], accelerator=str(device),devices=1, check_val_every_n_epoch=check_val_every_n_epoch, logger=False, gradient_clip_val=1.0, gradient_clip_algorithm="value")
     
-    trainer.fit(model=model, train_dataloaders=train_dataloader, val_dataloaders = val_dataloader)
+    trainer.fit(model=model, train_dataloaders=train_dataloader, val_dataloaders = val_dataloader, ckpt_path=ckpt_path)
    
\ No newline at end of file
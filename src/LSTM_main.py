@@ -14,8 +14,11 @@ from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 
 # user functions
 from dataset import CamelDataset, YearlyCamelsDataset
-from models import Hydro_LSTM
-from utils import MetricsCallback, NSELoss
+from models import Hydro_LSTM, Hydro_LSTM_Ensemble
+from scheduler import SuccessiveHalving, SuccessiveHalvingCallback
+from registry import RunRegistry, RegistryCallback
+from checkpointing import AsyncAtomicCheckpointIO, PreemptionCallback, resume_checkpoint
+from utils import MetricsCallback, NSELoss, EnsembleCheckpoint
 
 
 
@@ -26,6 +29,11 @@ def parse_args():
     parser.add_argument('--hydro', type=int, default=0, help="Include Camels Hydrological signatures")
     parser.add_argument('--bidirectional', type=int, default=1, help="Bidirectionality of LSTM decoder. 0 False, else True")
     parser.add_argument('--debug', type=int, default=0, help="If debug mode is on load only 15 basins. 0 False, else True")
+    parser.add_argument('--ensemble', type=int, default=0, help="Number of seeds trained together as one ensemble. 0 single model")
+    parser.add_argument('--asha_dir', type=str, default="", help="Folder shared by runs for successive halving. Empty string disables it")
+    parser.add_argument('--asha_min_epoch', type=int, default=100, help="Epoch of the first successive halving rung")
+    parser.add_argument('--asha_reduction_factor', type=int, default=3, help="Fraction 1/factor of runs continuing at each rung")
+    parser.add_argument('--resume', type=int, default=0, help="Resume from the last or preempted checkpoint if present. 0 False, else True")
     args=parser.parse_args()
     return args
 
@@ -46,8 +54,7 @@ if __name__ == '__main__':
     #dates = ["1989/10/01", "2009/09/30"] 
     dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
     force_attributes =  ["PRCP(mm/day)", "SRAD(W/m2)", "Tmin(C)", "Tmax(C)", "Vp(Pa)"] # force attributes to use
-    camel_dataset = CamelDataset(dates, force_attributes, debug=bool(args.debug))
-    print("Debug mode: ", bool(camel_dataset.debug))
+    camel_dataset = CamelDataset(dates, force_attributes)
     print("Bidirectional LSTM: ", bool(args.bidirectional))
     print("Use static features: ", bool(args.statics))
     print("Use hydro signatures: ", bool(args.hydro))
@@ -56,7 +63,7 @@ if __name__ == '__main__':
 
     #dataset.adjust_dates() # adjust dates if necessary
     camel_dataset.load_data() # load data
-    loaded_basin_ids = camel_dataset.loaded_basin_ids
+    loaded_basin_ids = camel_dataset.basin_list
     camel_dataset.load_statics() # load statics attributes
     camel_dataset.load_hydro() # load hydrological signatures
     num_basins = camel_dataset.__len__()
@@ -142,7 +149,7 @@ if __name__ == '__main__':
     loss_fn = NSELoss()
     assert args.noise_dim >= 0
     # possibly adjust kernel sizes according to seq_len
-    model = Hydro_LSTM(lstm_hidden_units = 256, 
+    model_kwargs = dict(lstm_hidden_units = 256, 
                  bidirectional = bool(args.bidirectional),
                  layers_num = 2,
                  act = nn.LeakyReLU, 
@@ -156,6 +163,11 @@ if __name__ == '__main__':
                  statics = bool(args.statics),
                  hydro =  bool(args.hydro),
                  warmup = 45)
+    if args.ensemble > 1:
+        # all seeds trained in one forward/backward
+        model = Hydro_LSTM_Ensemble(num_members = args.ensemble, seeds = list(range(42, 42+args.ensemble)), **model_kwargs)
+    else:
+        model = Hydro_LSTM(**model_kwargs)
                 
 
     ##########################################################
@@ -174,28 +186,54 @@ if __name__ == '__main__':
 
     # select dirpath according to noise features added
     dirpath="checkpoints/lstm-bd"+str(bool(args.bidirectional))+"-N"+str(args.noise_dim)+"-S"+str(bool(args.statics))+"-H"+str(bool(args.hydro))+"/"
+    callbacks = []
+    if args.ensemble > 1:
+        # per member checkpoints in checkpoints/<model_id>-M<k>/
+        callbacks.append(EnsembleCheckpoint(dirpath=dirpath, save_top_k=10))
+    if args.asha_dir:
+        # stop the run early if it falls behind the others at a rung
+        scheduler = SuccessiveHalving(log_dir=args.asha_dir, min_epoch=args.asha_min_epoch, reduction_factor=args.asha_reduction_factor, max_epoch=max_epochs)
+        # the threads of this process are its share of the node, rebalanced among the active runs at every rung
+        callbacks.append(SuccessiveHalvingCallback(scheduler, dirpath.split("/")[-2], num_threads=torch.get_num_threads()))
         
     metrics_callback = MetricsCallback(
         dirpath=dirpath,
-        filename="metrics.pt",
+        filename="metrics.bin",
     )
 
-    checkpoint_model = ModelCheckpoint(
-            save_top_k=10,
-            save_last=True,
-            monitor="val_loss",
-            mode="min",
-            dirpath=dirpath,
-            filename="model-{epoch:02d}",
-        )
+    if args.ensemble > 1:
+        # the members keep their own metrics and best checkpoints, the packed model only its last checkpoint
+        # to resume from
+        checkpoint_model = ModelCheckpoint(
+                save_top_k=0,
+                save_last=True,
+                monitor="val_loss",
+                mode="min",
+                dirpath=dirpath,
+            )
+    else:
+        checkpoint_model = ModelCheckpoint(
+                save_top_k=10,
+                save_last=True,
+                monitor="val_loss",
+                mode="min",
+                dirpath=dirpath,
+                filename="model-{epoch:02d}",
+            )
+    model_callbacks = [checkpoint_model]
+    if args.ensemble <= 1:
+        model_callbacks.append(metrics_callback)
+    # keep the run registry up to date
+    callbacks.append(RegistryCallback(RunRegistry(), dirpath.split("/")[-2], dirpath, "lstm"))
+    # save a resumable checkpoint on SIGUSR1/SIGTERM before the job is killed
+    callbacks.append(PreemptionCallback(dirpath=dirpath))
+    ckpt_path = resume_checkpoint(dirpath) if args.resume else None
+    print("Resume from checkpoint: ", ckpt_path)
     
 
-    # # retrieve checkpoints and continue training
-    # ckpt_path = "checkpoints/lstm-bdTrue-N0/last.ckpt"
-
     # define trainer 
     # , gradient_clip_val=1.0, gradient_clip_algorithm="value"
-    trainer = pl.Trainer(max_epochs=max_epochs, callbacks=[checkpoint_model,metrics_callback], accelerator=str(device), devices=1, check_val_every_n_epoch=check_val_every_n_epoch, logger=False, gradient_clip_val=1.0, gradient_clip_algorithm="value")
+    trainer = pl.Trainer(max_epochs=max_epochs, callbacks=model_callbacks+callbacks, plugins=[AsyncAtomicCheckpointIO()], accelerator=str(device), devices=1, check_val_every_n_epoch=check_val_every_n_epoch, logger=False, gradient_clip_val=1.0, gradient_clip_algorithm="value")
     
-    trainer.fit(model=model, train_dataloaders=train_dataloader, val_dataloaders = val_dataloader)
+    trainer.fit(model=model, train_dataloaders=train_dataloader, val_dataloaders = val_dataloader, ckpt_path=ckpt_path)
     
\ No newline at end of file
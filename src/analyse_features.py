@@ -1,7 +1,10 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
+
+# user functions
+from basin_metadata import basin_attributes
+from plotting import render_figures
+from encoding_cache import load_encodings
 
 
 
@@ -12,50 +15,19 @@ if __name__ == '__main__':
     ##########################################################
     # Load encoded features
     model_id = "lstm-ae-bdTrue-E3"
-    filename = "encoded_features/encoded_features_"+model_id+".txt"
-    df = pd.read_csv(filename, sep=" ")
-    features = df.iloc[:,2::]
-    features_basin_ids = df.iloc[:,1]
+    # from the encoding cache, the encoder runs only for basins not cached yet
+    basin_ids, enc = load_encodings(model_id)
+    df = pd.DataFrame(enc, columns=["E"+str(i) for i in range(enc.shape[1])])
+    features = df
+    features_basin_ids = [int(basin_id) for basin_id in basin_ids]
     # Load latitude and longitude
-    file_topo = "basin_dataset_public_v1p2/camels_topo.txt"
-    df_topo = pd.read_csv(file_topo, sep=";")
-    topo_basin_ids = df_topo.iloc[:,0]
-   
-    lat_topo = df_topo["gauge_lat"]
-    lon_topo = df_topo["gauge_lon"]
-
-    lat = []
-    lon = []
-    for i in range(len(features_basin_ids)):
-        for j in range(len(topo_basin_ids)):
-            if topo_basin_ids[j] == features_basin_ids[i]:
-                lat.append(lat_topo[j])
-                lon.append(lon_topo[j])
+    lat, lon = basin_attributes(features_basin_ids, ("gauge_lat", "gauge_lon"), "basin_dataset_public_v1p2")
 
     
    
-    # initialize an axis
-    fig, axes= plt.subplots(2,2, figsize=(8,8), sharex=True, sharey=True)
-
-    # plot map on axis
-    countries = gpd.read_file(  
-        gpd.datasets.get_path("naturalearth_lowres"))
-    
-    num_features = 4
-    for i in range(2):
-        for j in range(2):
-            f = 2*i +j 
-            if f<3:
-                ax = axes[i,j]
-                ax.set_xlim(-128, -65)
-                ax.set_ylim(24, 50)
-                ax.set_title("E"+str(f))
-                ax.set_axis_off()
-                countries[countries["name"] == "United States of America"].plot(color="lightgrey", ax=ax)
-                im = ax.scatter(x=lon, y=lat,c=df["E"+str(f)], cmap="YlOrRd", s=1)
-                fig.colorbar(im, ax=ax, fraction=0.028, pad=0.02, location="bottom")
-        
-    # Colorbar
-
-    save_file = "plot/plot_encoded_"+model_id+".png"
-    fig.savefig(save_file)
\ No newline at end of file
+    # encoded features over us map, 3 panels
+    num_features = 3
+    figures = [("map", dict(save_file="plot/plot_encoded_"+model_id+".png", lat=lat, lon=lon,
+                            values=np.stack([df["E"+str(f)].to_numpy() for f in range(num_features)]),
+                            titles=["E"+str(f) for f in range(num_features)], nrows=2, ncols=2))]
+    render_figures(figures)
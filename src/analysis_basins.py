@@ -6,12 +6,15 @@ import datetime
 import torch
 from torch.utils.data import DataLoader, random_split
 import multiprocessing
+import argparse
 
 
 # user functions
 from dataset import CamelDataset
-from models import Hydro_LSTM_AE, Hydro_LSTM
-from utils import NSELoss, PFAB, Globally_Scale_Data, find_best_epoch
+from utils import Globally_Scale_Data
+from evaluation import evaluate_models
+from bootstrap import quantiles_table, paired_differences
+from registry import best_model_ids
 
 # def parse_args():
 #     parser=argparse.ArgumentParser(description="Take model id and best model epoch to analysis on test dataset")
@@ -21,7 +24,15 @@ from utils import NSELoss, PFAB, Globally_Scale_Data, find_best_epoch
 #     return args
 
 
+def parse_args():
+    parser=argparse.ArgumentParser(description="Statistics of the test basins of the models")
+    parser.add_argument('--from_registry', type=int, default=0, help="Best 3 autoencoders and 2 lstm of the run registry instead of the published models. 0 False, else True")
+    args=parser.parse_args()
+    return args
+
+
 if __name__ == '__main__':
+    args = parse_args()
     ##########################################################
     # set seed
     ##########################################################
@@ -83,6 +94,8 @@ if __name__ == '__main__':
 
     # load best model
     model_ids =["lstm-ae-bdTrue-E27","lstm-ae-bdTrue-E4", "lstm-ae-bdTrue-E3", "lstm-bdTrue-N0-STrue", "lstm-bdTrue-N0"]
+    if args.from_registry:
+        model_ids = best_model_ids()
     num_models = len(model_ids)
    
     start_date = datetime.datetime.strptime(dates[0], '%Y/%m/%d').date()
@@ -102,13 +115,6 @@ if __name__ == '__main__':
     # define figure
     fig_stat, axs_stat = plt.subplots(num_models,3, figsize=(20,10))
    
-    # define metric functions
-    loss_NSE = NSELoss(reduction=None)
-    loss_mNSE = NSELoss(alpha=1, reduction=None)
-    loss_PFAB = PFAB(ex_prob=0.01, reduction=None)
-    nse_df = pd.DataFrame()
-    mnse_df = pd.DataFrame()
-    pfab_df = pd.DataFrame()
 
     ###################################################################################
     # PLOT
@@ -132,50 +138,8 @@ if __name__ == '__main__':
     #         at1 = AnchoredText(basin_name,loc='upper left', prop=dict(size=8), frameon=True)
     #         ax1.add_artist(at1)
 
-    for count in range(num_models):
-        model_id = model_ids[count]
-        best_epoch = find_best_epoch(model_id)
-        # open best model
-        dirpath = os.path.join("checkpoints", model_id)
-        filename = "model-epoch="+str(best_epoch)+".ckpt"
-        path_best  = os.path.join(dirpath, filename)
-        
-        if model_id.find("lstm-ae") != -1:
-            model = Hydro_LSTM_AE.load_from_checkpoint(path_best)
-            model.eval()
-            # compute squeezed encoded representation and reconstruction
-            with torch.no_grad():
-                enc, rec = model(x,y)
-
-        else:
-            model = Hydro_LSTM.load_from_checkpoint(path_best)
-            print(model.statics, model.hydro)
-            with torch.no_grad():
-                rec = model(y, statics, hydro)
-
-        # compute NSE, mNSE and save in dataframe
-        nse_df[model_id] = - loss_NSE(x.squeeze(), rec.squeeze()).detach().numpy() # array of size (num_test_data)
-        mnse_df[model_id] = - loss_mNSE(x.squeeze(), rec.squeeze()).detach().numpy() # array of size (num_test_data)
-        pfab_df[model_id] = loss_PFAB(x.squeeze(), rec.squeeze()).detach().numpy() # array of size (num_test_data)
-        
-        # unnormalize input and output
-        rec = transform_input.reverse_transform(rec.detach()).squeeze().numpy()
-        # # perform tsne over encoded space
-        # enc_embedded = TSNE(n_components=2, perplexity=1.0).fit_transform(enc)
-
-        # fig1, ax1 = plt.subplots(1,1,figsize=(5,5))
-        # ax1.scatter(enc_embedded[:,0], enc_embedded[:,1])
-        # fig1.savefig("encoded_space-"+args.model_id+"-epoch="+str(args.best_epoch)+".png")
-
-        # # plot some sequences
-        # for i in range(basins_n):
-        #     for j in range(basins_n):
-        #         ax = axs[i,j]
-        #         ax1 = axs1[i,j]
-        #         val = i*basins_n + j
-        #         start_seq = start_sequences_list[val]
-        #         ax.plot(rec[val, start_seq:start_seq+length_to_plot], label=model_id)
-        #         ax1.semilogy(np.absolute(rec[val, start_seq:start_seq+length_to_plot]-x_unnorm[val, start_seq:start_seq+length_to_plot]), label=model_id)
+    # evaluate the models in parallel processes, streaming the test basins in chunks
+    nse_df, mnse_df, pfab_df = evaluate_models(model_ids, camel_dataset, split_indices, chunk_size=32)
 
     # compute and plot statistics
     # NSE 
@@ -190,6 +154,19 @@ if __name__ == '__main__':
     stat_pfab = pfab_df.describe()
     print("PFAB statistics")
     print(stat_pfab)
+
+    # bootstrap confidence intervals of the quartiles and paired differences of the medians
+    ci_stats = {}
+    for name, df in [("NSE", nse_df), ("mNSE", mnse_df), ("PFAB", pfab_df)]:
+        ci_stats[name] = quantiles_table(df)
+        print(name+" quartiles with 95% bootstrap intervals")
+        print(ci_stats[name])
+        ci_stats[name].to_csv("plot/bootstrap_"+name+".csv", sep=" ")
+        difference, low, high, prob = paired_differences(df[model_ids].to_numpy())
+        print(name+" paired differences of the medians (row - column), 95% interval")
+        for i in range(num_models):
+            for j in range(i+1, num_models):
+                print("  %s - %s: %.3f [%.3f, %.3f], P(>0) = %.3f"%(model_ids[i], model_ids[j], difference[i,j], low[i,j], high[i,j], prob[i,j]))
     axs_stat[0,0].set_title("NSE", fontsize=30)
     axs_stat[0,1].set_title("mNSE", fontsize=30)
     axs_stat[0,2].set_title("PFAB", fontsize=30)
@@ -202,6 +179,7 @@ if __name__ == '__main__':
         axs_stat[count,0].grid()
         axs_stat[count,0].axvline(stat_NSE.loc["25%",model_id], ls="--", lw=1, c="black")
         axs_stat[count,0].axvline(stat_NSE.loc["50%", model_id], ls="-", lw=2, c="black")
+        axs_stat[count,0].axvspan(ci_stats["NSE"].loc[model_id, "q50_low"], ci_stats["NSE"].loc[model_id, "q50_high"], color="grey", alpha=0.3)
         axs_stat[count,0].axvline(stat_NSE.loc["75%", model_id], ls="--", lw=1, c="black")
         axs_stat[count,0].set_ylabel(model_id, fontsize=15)
         axs_stat[count,0].set_xlim(-0.5,1.0)
@@ -211,6 +189,7 @@ if __name__ == '__main__':
         axs_stat[count,1].grid()
         axs_stat[count,1].axvline(stat_mNSE.loc["25%",model_id], ls="--", lw=1, c="black")
         axs_stat[count,1].axvline(stat_mNSE.loc["50%", model_id], ls="-", lw=2, c="black")
+        axs_stat[count,1].axvspan(ci_stats["mNSE"].loc[model_id, "q50_low"], ci_stats["mNSE"].loc[model_id, "q50_high"], color="grey", alpha=0.3)
         axs_stat[count,1].axvline(stat_mNSE.loc["75%", model_id], ls="--", lw=1, c="black")
         axs_stat[count,1].set_xlim(-0.5,1.0)
 
@@ -219,6 +198,7 @@ if __name__ == '__main__':
         axs_stat[count,2].grid()
         axs_stat[count,2].axvline(stat_pfab.loc["25%",model_id], ls="--", lw=1, c="black")
         axs_stat[count,2].axvline(stat_pfab.loc["50%", model_id], ls="-", lw=2, c="black")
+        axs_stat[count,2].axvspan(ci_stats["PFAB"].loc[model_id, "q50_low"], ci_stats["PFAB"].loc[model_id, "q50_high"], color="grey", alpha=0.3)
         axs_stat[count,2].axvline(stat_pfab.loc["75%", model_id], ls="--", lw=1, c="black")
         axs_stat[count,2].set_xlim(0.0,100.0)
 
@@ -2,40 +2,51 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from dadapy import data
 
-A = pd.read_csv("statics.txt", sep=" ", skiprows=1).iloc[:,2::]
-A = np.array(A)
-H = pd.read_csv("hydro.txt", sep=" ", skiprows=1).iloc[:,2::]
-H = np.array(H)
+# user functions
+from encoding_cache import load_encodings
+from intrinsic_dimension import batch_ids_scaling
+from feature_store import FeatureStore, normalize_basin_id
+
+
+def align_encodings(model_id, basin_ids):
+    """
+    Encoded features of model_id in the order of basin_ids
+    """
+    ids, enc = load_encodings(model_id)
+    position = {normalize_basin_id(basin_id): i for i, basin_id in enumerate(ids)}
+    missing = [basin_id for basin_id in basin_ids if normalize_basin_id(basin_id) not in position]
+    if missing:
+        raise Exception("Basins not encoded by "+model_id+": "+", ".join(missing[:10]))
+    return np.asarray(enc)[[position[normalize_basin_id(basin_id)] for basin_id in basin_ids]]
+
+
+# encoded features from the encoding cache
+basin_ids, E = load_encodings("lstm-ae-bdTrue-E27")
+# statics and hydrological signatures of the same basins
+store = FeatureStore()
+A = store.load("statics", basin_ids)
+H = store.load("hydro", basin_ids)
 
 S = np.concatenate((A,H), axis=1)
 print(S.shape)
-E = pd.read_csv("encoded_features_lstm-ae-bdTrue-E27.txt", sep=" ", skiprows=1).iloc[:,2::]
-E4 = pd.read_csv("encoded_features_lstm-ae-bdTrue-E4.txt", sep=" ", skiprows=1).iloc[:,2::]
-E3 = pd.read_csv("encoded_features_lstm-ae-bdTrue-E3.txt", sep=" ", skiprows=1).iloc[:,2::]
+# same basins, in the same order, as E27 and S
+E4 = align_encodings("lstm-ae-bdTrue-E4", basin_ids)
+E3 = align_encodings("lstm-ae-bdTrue-E3", basin_ids)
 
 E = np.array(E)
 E4 = np.array(E4)
 E3 = np.array(E3)
 
 
-def compute_ids_scaling(X, range_max = 2048, N_min = 20):
-    "instantiate data class"
-    _data = data.Data(coordinates = X,
-                     maxk = 100)
-    "compute ids scaling gride"
-    ids_gride, ids_err_gride, rs_gride = _data.return_id_scaling_gride(range_max=range_max)
-    "compute ids with twoNN + decimation"
-    ids_twoNN, ids_err_twoNN, rs_twoNN = _data.return_id_scaling_2NN(N_min = N_min)
-    return ids_gride, ids_twoNN, rs_gride, rs_twoNN
-
 #*************************************************************
 
-ids_S_gride, ids_S_twoNN, rs_S_gride, rs_S_twoNN = compute_ids_scaling(S,range_max = S.shape[0]-1,N_min = 10)
-ids_E_gride, ids_E_twoNN, rs_E_gride, rs_E_twoNN = compute_ids_scaling(E,range_max = S.shape[0]-1,N_min = 10)
-ids_E4_gride, ids_E4_twoNN, rs_E4_gride, rs_E4_twoNN = compute_ids_scaling(E4,range_max = S.shape[0]-1,N_min = 10)
-ids_E3_gride, ids_E3_twoNN, rs_E3_gride, rs_E3_twoNN = compute_ids_scaling(E3,range_max = S.shape[0]-1,N_min = 10)
+# one kNN graph per feature set, sets computed in parallel, results cached in id_cache/
+results = batch_ids_scaling({"S": S, "E27": E, "E4": E4, "E3": E3}, range_max = S.shape[0]-1, n_min = 10)
+ids_S_gride, ids_S_twoNN, rs_S_gride, rs_S_twoNN = [results["S"][key] for key in ["ids_gride", "ids_twoNN", "rs_gride", "rs_twoNN"]]
+ids_E_gride, ids_E_twoNN, rs_E_gride, rs_E_twoNN = [results["E27"][key] for key in ["ids_gride", "ids_twoNN", "rs_gride", "rs_twoNN"]]
+ids_E4_gride, ids_E4_twoNN, rs_E4_gride, rs_E4_twoNN = [results["E4"][key] for key in ["ids_gride", "ids_twoNN", "rs_gride", "rs_twoNN"]]
+ids_E3_gride, ids_E3_twoNN, rs_E3_gride, rs_E3_twoNN = [results["E3"][key] for key in ["ids_gride", "ids_twoNN", "rs_gride", "rs_twoNN"]]
 
 fig, ax = plt.subplots(1,4,figsize = (24, 8), sharey=True)
 
@@ -8,36 +8,31 @@ from dadapy.metric_comparisons import MetricComparisons
 import seaborn as sns
 import copy
 
-# retrieve statics
-df_S = pd.read_csv("statics.txt", sep=" ").iloc[:,1::]
-
-S_ids = df_S.iloc[:,0]
-df_S = df_S.iloc[:,1::]
-df_S = (df_S- df_S.min())/(df_S.max()-df_S.min())
+# user functions
+from encoding_cache import load_encodings
+from imbalance import InformationImbalance
+from feature_store import FeatureStore
 
 # retrieve encoded features
 E_dim = 4
 model_id = "lstm-ae-bdTrue-E"+str(E_dim)
 
-filename = f"encoded_features/encoded_{E_dim}.txt"
-df_E = pd.read_csv(filename, sep=" ").iloc[:,1:5]
+# from the encoding cache, the encoder runs only for basins not cached yet
+basin_ids, enc = load_encodings(model_id)
+df_E = pd.DataFrame(enc, columns=["E"+str(i) for i in range(enc.shape[1])])
 print(df_E)
-E_ids = df_E.iloc[:,0]
-df_E = df_E.iloc[:,1::]
+E_ids = pd.Series([int(basin_id) for basin_id in basin_ids])
 df_E = (df_E -df_E .min())/(df_E .max()- df_E .min())
 
-# retrieve hydro features
-df_H = pd.read_csv("hydro.txt", sep=" ").iloc[:,1::]
-
-H_ids = df_H.iloc[:,0]
+# retrieve statics and hydro features of the same basins from the feature store
+store = FeatureStore()
+df_S = store.load_frame("statics", basin_ids)
+df_S = (df_S- df_S.min())/(df_S.max()-df_S.min())
+S_ids = E_ids
 
-df_H = df_H.iloc[:,1::]
+df_H = store.load_frame("hydro", basin_ids)
 df_H = (df_H- df_H.min())/(df_H.max()-df_H.min())
-
-# assert
-assert((S_ids==E_ids).all())
-assert((S_ids==H_ids).all())
-assert((E_ids==H_ids).all())
+H_ids = E_ids
 
 # concat ES
 df_ES = pd.concat([df_E, df_S], axis=1)
@@ -186,14 +181,13 @@ coor_tot = np.arange(E_dim+27)
 
 X = np.array(df_ES.iloc[:,1:])
 
-# define an instance of the MetricComparisons class
-d = MetricComparisons(X)
-d.compute_distances(X.shape[0]-1)
+# same selection as MetricComparisons(X).greedy_feature_selection_target with the full space as target
+d = InformationImbalance(X)
 fig, ax = plt.subplots(1,2,figsize=(10,10))
 
 
 
-best_sets, best_imbs, all_imbs = d.greedy_feature_selection_target(target_ranks=d.dist_indices, n_coords=27+E_dim, n_best=1, k=1)
+best_sets, best_imbs, all_imbs = d.greedy_feature_selection(n_coords=27+E_dim, n_best=1, k=1)
 
 file_sets = "plot/plot_bestSets_imbalance_"+model_id+".txt"
 print(best_sets)
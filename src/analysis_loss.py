@@ -1,14 +1,29 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import argparse
 import torch
 
+# user functions
+from utils import load_metrics, metrics_path
+from registry import best_model_ids
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Validation NSE of the models along training")
+    parser.add_argument('--from_registry', type=int, default=0, help="Best 3 autoencoders and 2 lstm of the run registry instead of the published models. 0 False, else True")
+    args=parser.parse_args()
+    return args
+
 
 if __name__ == '__main__':
+    args = parse_args()
 
     #####################################################################
     dir = "checkpoints"
     models = ["lstm-ae-bdTrue-E27","lstm-ae-bdTrue-E4",  "lstm-ae-bdTrue-E3", "lstm-bdTrue-N0-STrue", "lstm-bdTrue-N0"]
+    if args.from_registry:
+        models = best_model_ids(dir)
     epochs = []
     nse = []
     fig, ax = plt.subplots(1,1,figsize=(5,5))
@@ -16,22 +31,9 @@ if __name__ == '__main__':
     ax.set_ylabel("NSE")
     for i in range(len(models)):
         name = models[i]
-        path = os.path.join(dir, name, "metrics.pt")
-        data = torch.load(path, map_location=torch.device('cpu'))
-        epochs_mod = []
-        nse_mod = []
-        for key in data:
-            epoch_num = data[key]["epoch_num"]
-            nse = -data[key]["val_loss"]
-            if isinstance(epoch_num, int):
-                epochs_mod.append(epoch_num)
-                nse_mod.append(nse)
-            else:
-                epochs_mod.append(int(epoch_num.item()))
-                nse_mod.append(nse.item())
-
-        # reorder
-        epochs_mod, nse_mod = zip(*sorted(zip(epochs_mod, nse_mod)))
+        epochs_mod, val_loss = load_metrics(metrics_path(name, dir))
+        nse_mod = -val_loss
+
         # plot
         ax.set_ylim(0,1)
         ax.plot(epochs_mod[:400],nse_mod[:400], label=name)
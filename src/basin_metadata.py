@@ -0,0 +1,63 @@
+import os
+import pickle
+import functools
+import numpy as np
+import pandas as pd
+
+
+ATTRIBUTE_FILES = ["camels_topo.txt", "camels_clim.txt", "camels_geol.txt", "camels_soil.txt", "camels_vege.txt", "camels_hydro.txt"]
+
+
+def _files_key(paths):
+    # cache is rebuilt when any attribute file changes
+    return [(os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)) for path in paths]
+
+
+@functools.lru_cache(maxsize=None)
+def load_basin_metadata(data_dir="basin_dataset_public_v1p2", cache_file=None):
+    """
+    CAMELS attributes (topo, clim, geol, soil, vege, hydro) of all the basins in one table indexed by gauge id.
+    The table is pickled to cache_file (default data_dir/basin_metadata.pkl) and read from it while the
+    attribute files are unchanged; within a process it is loaded only once.
+    Returns
+    -------
+        pd.DataFrame indexed by the integer gauge_id
+    """
+    if cache_file is None:
+        cache_file = os.path.join(data_dir, "basin_metadata.pkl")
+    paths = [os.path.join(data_dir, filename) for filename in ATTRIBUTE_FILES if os.path.exists(os.path.join(data_dir, filename))]
+    if not paths:
+        raise Exception("No CAMELS attribute files found in "+data_dir)
+    key = _files_key(paths)
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        if cached["key"] == key:
+            return cached["table"]
+
+    table = None
+    for path in paths:
+        df = pd.read_csv(path, sep=";").set_index("gauge_id")
+        # skip columns already read from a previous file
+        df = df[[column for column in df.columns if table is None or column not in table.columns]]
+        table = df if table is None else table.join(df, how="outer")
+    table.index = table.index.astype(int)
+    with open(cache_file+".tmp", "wb") as f:
+        pickle.dump({"key": key, "table": table}, f)
+    os.replace(cache_file+".tmp", cache_file)
+    return table
+
+
+def basin_attributes(basin_ids, columns=("gauge_lat", "gauge_lon"), data_dir="basin_dataset_public_v1p2"):
+    """
+    Attributes of the basins basin_ids (str or int), in the same order, with one lookup on the gauge id index
+    Returns
+    -------
+        tuple with one np.ndarray of size (len(basin_ids),) per column
+    """
+    table = load_basin_metadata(data_dir)
+    ids = np.array([int(basin_id) for basin_id in basin_ids])
+    positions = table.index.get_indexer(ids)
+    if (positions < 0).any():
+        raise Exception("Basins not found in "+data_dir+": "+", ".join(str(i) for i in ids[positions < 0]))
+    return tuple(table[column].to_numpy()[positions] for column in columns)
@@ -0,0 +1,116 @@
+import time
+import argparse
+import numpy as np
+
+# pytorch
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+# user functions
+from dataset import CamelDataset
+from models import Hydro_LSTM_AE
+from utils import NSELoss
+from sweep import split_basins
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Compare step time and NSE of the LSTM and TCN decoders of Hydro_LSTM_AE")
+    parser.add_argument('--num_features', type=int, default=3, help="Number of features in the encoded space")
+    parser.add_argument('--epochs', type=int, default=20, help="Training epochs of each decoder")
+    parser.add_argument('--batch_size', type=int, default=32, help="Batch size")
+    parser.add_argument('--lr', type=float, default=1e-4, help="Learning rate")
+    parser.add_argument('--num_threads', type=int, default=None, help="Torch threads, default all cpus")
+    args=parser.parse_args()
+    return args
+
+
+def build_model(decoder, seq_len, num_force_attributes, num_features, lr):
+    # same hyperparameters as LSTM_AE_main.py
+    return Hydro_LSTM_AE(in_channels=(1,8,16),
+                    out_channels=(8,16,32),
+                    kernel_sizes=(6,7,4),
+                    encoded_space_dim=num_features,
+                    drop_p=0.5,
+                    seq_len=seq_len,
+                    lr = lr,
+                    act=nn.LeakyReLU,
+                    loss_fn=NSELoss(),
+                    lstm_hidden_units=256,
+                    layers_num=2,
+                    bidirectional = True,
+                    linear=512,
+                    num_force_attributes = num_force_attributes,
+                    warmup = 45,
+                    decoder = decoder)
+
+
+def benchmark(model, train_dataloader, val_dataloader, epochs, device):
+    """
+    Train model for some epochs
+    Returns
+    -------
+        step_time : (float) mean seconds of a training step (forward, backward, optimizer step)
+        val_nse : (float) mean NSE over validation basins after training
+    """
+    model.to(device)
+    optimizer = model.configure_optimizers()
+    warmup = model.warmup
+    step_times = []
+    for epoch in range(epochs):
+        model.train()
+        for x, y, _, _ in train_dataloader:
+            x, y = x.to(device), y.to(device)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            _, rec = model(x, y)
+            loss = model.loss_fn(x.squeeze(-1).squeeze(1)[:,warmup:], rec.squeeze(-1).squeeze(1)[:,warmup:])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            step_times.append(time.perf_counter() - start)
+
+    model.eval()
+    nse = []
+    with torch.no_grad():
+        for x, y, _, _ in val_dataloader:
+            x, y = x.to(device), y.to(device)
+            _, rec = model(x, y)
+            x = x.squeeze(-1).squeeze(1)[:,warmup:]
+            rec = rec.squeeze(-1).squeeze(1)[:,warmup:]
+            nse.append(-NSELoss(reduction=None)(x, rec).cpu().numpy())
+    # first step excluded, it includes allocations and kernel selection
+    return float(np.mean(step_times[1:] if len(step_times) > 1 else step_times)), float(np.mean(np.concatenate(nse)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    print(f"Device: {device}, threads: {torch.get_num_threads()}")
+
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["PRCP(mm/day)", "SRAD(W/m2)", "Tmin(C)", "Tmax(C)", "Vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data()
+
+    # same split for both decoders
+    train_indices, val_indices, _ = split_basins(len(camel_dataset), "lstm-ae", seed=42)
+    train_dataloader = DataLoader(Subset(camel_dataset, train_indices), batch_size=args.batch_size, shuffle=True, drop_last=False)
+    val_dataloader = DataLoader(Subset(camel_dataset, val_indices), batch_size=args.batch_size, shuffle=False)
+
+    results = {}
+    for decoder in ["lstm", "tcn"]:
+        torch.manual_seed(42)
+        np.random.seed(42)
+        model = build_model(decoder, camel_dataset.seq_len, camel_dataset.num_force_attributes, args.num_features, args.lr)
+        num_params = sum(p.numel() for p in model.parameters())
+        step_time, val_nse = benchmark(model, train_dataloader, val_dataloader, args.epochs, device)
+        results[decoder] = (step_time, val_nse)
+        print("%s decoder: %d parameters, %.3f s/step, validation NSE %.3f"%(decoder, num_params, step_time, val_nse))
+
+    print("Speed-up of tcn over lstm: %.1fx"%(results["lstm"][0] / results["tcn"][0]))
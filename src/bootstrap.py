@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+
+def resample_chunks(n, num_resamples=2000, seed=42, chunk_size=500):
+    """
+    Bootstrap resamples of n basins, drawn with replacement as integer index matrices.
+    The resamples are drawn from a single generator chunk after chunk, so they depend on the seed only
+    and not on chunk_size, which bounds memory.
+    Yields
+    ------
+        start, indices : first resample of the chunk and np.ndarray of int of size (chunk, n)
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_resamples, chunk_size):
+        end = min(start + chunk_size, num_resamples)
+        yield start, rng.integers(0, n, size=(end - start, n))
+
+
+def bootstrap_statistic(values, statistic, num_resamples=2000, seed=42, chunk_size=500):
+    """
+    Statistic of every bootstrap resample of the rows of values
+    Args:
+        values : np.ndarray of size (N, num_models), e.g. the NSE of each basin for each model
+        statistic : function of an array of size (chunk, N, num_models) reducing axis 1,
+                    returning an array of size (..., chunk, num_models)
+    Returns
+    -------
+        np.ndarray of size (..., num_resamples, num_models)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    out = None
+    for start, indices in resample_chunks(values.shape[0], num_resamples, seed, chunk_size):
+        # all the models are resampled on the same basins
+        stat = statistic(values[indices])
+        if out is None:
+            out = np.zeros(stat.shape[:-2] + (num_resamples, values.shape[1]))
+        out[..., start:start+stat.shape[-2], :] = stat
+    return out
+
+
+def _quantile_statistic(q):
+    return lambda x: np.quantile(x, q, axis=1)
+
+
+def bootstrap_quantiles(values, q=(0.25, 0.5, 0.75), num_resamples=2000, confidence=0.95, seed=42, chunk_size=500):
+    """
+    Percentile bootstrap confidence intervals of quantiles of per-basin skills
+    Args:
+        values : np.ndarray of size (N, num_models)
+        q : quantiles, e.g. 0.5 for the median
+    Returns
+    -------
+        estimate, low, high : np.ndarray of size (len(q), num_models)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    q = np.asarray(q, dtype=np.float64)
+    estimate = np.quantile(values, q, axis=0)
+    resampled = bootstrap_statistic(values, _quantile_statistic(q), num_resamples, seed, chunk_size)
+    alpha = (1.0 - confidence) / 2.0
+    low, high = np.quantile(resampled, [alpha, 1.0 - alpha], axis=1)
+    return estimate, low, high
+
+
+def paired_differences(values, q=0.5, num_resamples=2000, confidence=0.95, seed=42, chunk_size=500):
+    """
+    Paired bootstrap of the difference of a quantile (default the median) between every pair of models,
+    the models being compared on the same resampled basins
+    Args:
+        values : np.ndarray of size (N, num_models)
+    Returns
+    -------
+        difference, low, high, prob : np.ndarray of size (num_models, num_models), [i, j] refers to
+            quantile(model i) - quantile(model j), prob is the fraction of resamples where it is positive
+    """
+    values = np.asarray(values, dtype=np.float64)
+    estimate = np.quantile(values, q, axis=0)
+    difference = estimate[:, None] - estimate[None, :]
+    resampled = bootstrap_statistic(values, _quantile_statistic(q), num_resamples, seed, chunk_size)
+    alpha = (1.0 - confidence) / 2.0
+    num_models = resampled.shape[1]
+    low = np.zeros((num_models, num_models))
+    high = np.zeros((num_models, num_models))
+    prob = np.zeros((num_models, num_models))
+    # one model at a time, the differences held in memory are of size (num_resamples, num_models)
+    for i in range(num_models):
+        diffs = resampled[:, i, None] - resampled
+        low[i], high[i] = np.quantile(diffs, [alpha, 1.0 - alpha], axis=0)
+        prob[i] = np.mean(diffs > 0, axis=0)
+    return difference, low, high, prob
+
+
+def quantiles_table(df, q=(0.25, 0.5, 0.75), num_resamples=2000, confidence=0.95, seed=42):
+    """
+    bootstrap_quantiles of the columns (models) of df
+    Returns
+    -------
+        pd.DataFrame with one row per model and columns "q50", "q50_low", "q50_high", ... for each quantile
+    """
+    estimate, low, high = bootstrap_quantiles(df.to_numpy(), q, num_resamples, confidence, seed)
+    table = pd.DataFrame(index=df.columns)
+    for i, quantile in enumerate(q):
+        name = "q"+str(int(round(100*quantile)))
+        table[name] = estimate[i]
+        table[name+"_low"] = low[i]
+        table[name+"_high"] = high[i]
+    return table
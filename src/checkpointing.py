@@ -0,0 +1,178 @@
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+# pytorch
+import torch
+from pytorch_lightning import Callback
+from pytorch_lightning.plugins.io import CheckpointIO
+
+# classes pickled in the hyperparameters of our checkpoints, allowed by weights_only loads
+SAFE_GLOBALS = [torch.nn.LeakyReLU, torch.nn.ReLU, torch.nn.Tanh, torch.nn.Sigmoid, torch.nn.ELU, torch.nn.GELU]
+
+def _snapshot(obj):
+    # copy every tensor of the checkpoint to cpu, so that training can modify the parameters while it is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+        return type(obj)(_snapshot(value) for value in obj)
+    return obj
+
+
+def _atomic_save(checkpoint, path):
+    # write to a temporary file and rename it, a checkpoint on disk is either the old or the new one
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AsyncAtomicCheckpointIO(CheckpointIO):
+    """
+    Checkpoint plugin writing checkpoints in a background thread.
+    The training loop only pays for a cpu copy of the state dict; writes and removals of
+    checkpoints are queued in order to a single writer thread and every file is written
+    atomically (temporary file + rename), so a job killed in the middle of a write leaves the
+    previous checkpoint intact.
+    Usage: pl.Trainer(..., plugins=[AsyncAtomicCheckpointIO()])
+    """
+    def __init__(self, max_pending=2, weights_only=True):
+        """
+        Args:
+            max_pending : maximum number of checkpoints held in memory waiting to be written
+            weights_only : load checkpoints with torch.load(weights_only=True), the activation classes
+                stored in the hyperparameters are allowed through SAFE_GLOBALS
+        """
+        super().__init__()
+        self.max_pending = max_pending
+        self.weights_only = weights_only
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def _submit(self, fn, *args):
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        # raise the errors of previous writes in the training loop
+        for future in done:
+            future.result()
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        if storage_options is not None:
+            raise TypeError("storage_options is not supported by AsyncAtomicCheckpointIO")
+        path = str(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._submit(_atomic_save, _snapshot(checkpoint), path)
+
+    def load_checkpoint(self, path, map_location=None, weights_only=None):
+        # a checkpoint being written is loaded only once complete
+        self.wait()
+        if weights_only is None:
+            weights_only = self.weights_only
+        with torch.serialization.safe_globals(SAFE_GLOBALS):
+            return torch.load(path, map_location=map_location, weights_only=weights_only)
+
+    def remove_checkpoint(self, path):
+        # queued after the pending writes, so a checkpoint is never removed before being written
+        self._submit(_remove, str(path))
+
+    def wait(self):
+        """
+        Block until all the queued writes are on disk
+        """
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def teardown(self):
+        self.wait()
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class PreemptionCallback(Callback):
+    """
+    PyTorch Lightning callback saving a resumable checkpoint when the job is about to be killed.
+    SLURM sends SIGUSR1 before the time limit with "#SBATCH --signal=B:USR1@<seconds>" and SIGTERM
+    at the limit or when the job is preempted. On one of these signals the training stops after the
+    current batch and the full trainer state is saved to dirpath/filename; restart the job with
+    --resume 1 to continue from it.
+    The handlers are installed at the start of training, after the ones of Lightning, and the
+    previous handler of the signal (e.g. the SLURM requeue of Lightning) is called once the
+    checkpoint is on disk.
+    """
+    def __init__(self, dirpath, filename="preempted.ckpt", signals=(signal.SIGUSR1, signal.SIGTERM)):
+        super().__init__()
+        self.dirpath = dirpath
+        self.filename = filename
+        self.signals = signals
+        self.received = None
+        self.frame = None
+        self.previous_handlers = {}
+
+    def _handler(self, signum, frame):
+        # only set a flag, the checkpoint is saved by the training loop
+        self.received = signum
+        self.frame = frame
+
+    def _restore_handlers(self):
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers = {}
+
+    def _chain(self):
+        # hand the signal to the handler we replaced
+        handler = self.previous_handlers.get(self.received)
+        signum, frame = self.received, self.frame
+        self.received = None
+        self.frame = None
+        self._restore_handlers()
+        if callable(handler):
+            handler(signum, frame)
+
+    def on_train_start(self, trainer, pl_module):
+        # Lightning registers its handlers after the setup hook and skips SIGUSR1 if one is already installed
+        for signum in self.signals:
+            self.previous_handlers[signum] = signal.getsignal(signum)
+            signal.signal(signum, self._handler)
+
+    def on_train_end(self, trainer, pl_module):
+        # restored before Lightning restores its own handlers in the trainer teardown
+        if self.received is not None:
+            self._chain()
+        self._restore_handlers()
+
+    def on_exception(self, trainer, pl_module, exception):
+        self._restore_handlers()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.received is None or trainer.should_stop:
+            return
+        path = os.path.join(self.dirpath, self.filename)
+        print("Received signal "+signal.Signals(self.received).name+" at epoch "+str(trainer.current_epoch)+", saving "+path)
+        trainer.save_checkpoint(path)
+        checkpoint_io = trainer.strategy.checkpoint_io
+        if hasattr(checkpoint_io, "wait"):
+            checkpoint_io.wait()
+        trainer.should_stop = True
+        self._chain()
+
+
+def resume_checkpoint(dirpath, filenames=("preempted.ckpt", "last.ckpt")):
+    """
+    Most recent checkpoint to resume a run from, None if the run never saved one
+    """
+    paths = [os.path.join(dirpath, filename) for filename in filenames]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None
+    return max(paths, key=os.path.getmtime)
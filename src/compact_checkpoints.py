@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+
+# pytorch
+import torch
+import torch.nn as nn
+
+# user functions
+from models import Hydro_LSTM, Hydro_LSTM_AE, Hydro_LSTM_Ensemble
+from registry import find_best_epoch
+
+
+MODEL_CLASSES = {"Hydro_LSTM": Hydro_LSTM, "Hydro_LSTM_AE": Hydro_LSTM_AE, "Hydro_LSTM_Ensemble": Hydro_LSTM_Ensemble}
+
+
+def _model_class_name(hparams):
+    if "encoded_space_dim" in hparams:
+        return "Hydro_LSTM_AE"
+    elif "num_members" in hparams:
+        return "Hydro_LSTM_Ensemble"
+    else:
+        return "Hydro_LSTM"
+
+
+def _hparams_to_json(hparams):
+    # activation functions are classes, stored by name and resolved in torch.nn when loading
+    out = {}
+    for key, value in hparams.items():
+        if isinstance(value, type):
+            value = value.__name__
+        elif isinstance(value, tuple):
+            value = list(value)
+        out[key] = value
+    return out
+
+
+def _hparams_from_json(hparams):
+    hparams = dict(hparams)
+    if isinstance(hparams.get("act"), str):
+        hparams["act"] = getattr(nn, hparams["act"])
+    return hparams
+
+
+def tensor_key(tensor):
+    """
+    Content hash of a tensor, equal tensors of different checkpoints share the key
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    h = hashlib.sha1()
+    h.update((str(tensor.dtype)+str(tuple(tensor.shape))).encode())
+    h.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def checkpoint_files(dirpath):
+    """
+    Returns
+    -------
+        dict checkpoint name ("epoch=XX" or "last") -> path of the Lightning checkpoint
+    """
+    files = {}
+    for filename in sorted(os.listdir(dirpath)):
+        match = re.match(r"model-epoch=(\d+)\.ckpt$", filename)
+        if match:
+            files["epoch="+str(int(match.group(1)))] = os.path.join(dirpath, filename)
+        elif filename == "last.ckpt":
+            files["last"] = os.path.join(dirpath, filename)
+    return files
+
+
+def export_run(model_id, checkpoint_dir="checkpoints", fp16=False, prune=False, keep_last=True):
+    """
+    Export the checkpoints of a run to an inference-only format in checkpoint_dir/<model_id>/:
+        hparams.json : hyperparameters and model class
+        compact.pt : weights of every checkpoint, identical tensors stored once
+    Optimizer states and Lightning metadata are dropped.
+    Args:
+        fp16 : store floating point weights in half precision
+        prune : remove the exported model-epoch=XX.ckpt files (and last.ckpt if not keep_last)
+    Returns
+    -------
+        size_before, size_after : (int) bytes of the Lightning checkpoints and of the compact files
+    """
+    dirpath = os.path.join(checkpoint_dir, model_id)
+    path_compact = os.path.join(dirpath, "compact.pt")
+    path_hparams = os.path.join(dirpath, "hparams.json")
+    files = checkpoint_files(dirpath)
+    if not files:
+        raise Exception("No checkpoints found in "+dirpath)
+
+    # add to a previous export, checkpoints of the run may have been pruned
+    if os.path.exists(path_compact):
+        compact = torch.load(path_compact, map_location=torch.device('cpu'))
+    else:
+        compact = {"tensors": {}, "checkpoints": {}, "fp16": fp16}
+    if compact["fp16"] != fp16:
+        raise Exception(path_compact+" was exported with fp16="+str(compact["fp16"]))
+
+    hparams = None
+    for name, path in files.items():
+        checkpoint = torch.load(path, map_location=torch.device('cpu'))
+        hparams = checkpoint["hyper_parameters"]
+        entry = {}
+        for param, tensor in checkpoint["state_dict"].items():
+            if fp16 and tensor.is_floating_point():
+                tensor = tensor.half()
+            key = tensor_key(tensor)
+            compact["tensors"].setdefault(key, tensor.clone())
+            entry[param] = key
+        compact["checkpoints"][name] = {"epoch": checkpoint["epoch"], "state_dict": entry}
+
+    hparams = _hparams_to_json(hparams)
+    with open(path_hparams+".tmp", "w") as f:
+        json.dump({"model_class": _model_class_name(hparams), "hparams": hparams}, f, indent=1)
+    os.replace(path_hparams+".tmp", path_hparams)
+    torch.save(compact, path_compact+".tmp")
+    os.replace(path_compact+".tmp", path_compact)
+
+    size_before = sum(os.path.getsize(path) for path in files.values())
+    size_after = os.path.getsize(path_compact) + os.path.getsize(path_hparams)
+
+    if prune:
+        for name, path in files.items():
+            if name == "last" and keep_last:
+                continue
+            os.remove(path)
+    return size_before, size_after
+
+
+def load_compact(model_id, epoch=None, checkpoint_dir="checkpoints"):
+    """
+    Build Hydro_LSTM / Hydro_LSTM_AE from the compact format
+    Args:
+        epoch : (int) epoch of the checkpoint, "last", or None for the best epoch
+    Returns
+    -------
+        model in eval mode
+    """
+    dirpath = os.path.join(checkpoint_dir, model_id)
+    with open(os.path.join(dirpath, "hparams.json")) as f:
+        info = json.load(f)
+    compact = torch.load(os.path.join(dirpath, "compact.pt"), map_location=torch.device('cpu'))
+    if epoch is None:
+        epoch = find_best_epoch(model_id, checkpoint_dir)
+    name = "last" if epoch == "last" else "epoch="+str(int(epoch))
+    if name not in compact["checkpoints"]:
+        raise Exception("No checkpoint "+name+" in "+os.path.join(dirpath, "compact.pt"))
+
+    model = MODEL_CLASSES[info["model_class"]](**_hparams_from_json(info["hparams"]))
+    reference = model.state_dict()
+    state_dict = {param: compact["tensors"][key].to(reference[param].dtype) for param, key in compact["checkpoints"][name]["state_dict"].items()}
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def load_model(model_id, epoch=None, checkpoint_dir="checkpoints"):
+    """
+    Load a trained model from the compact format if exported, else from its Lightning checkpoint
+    """
+    dirpath = os.path.join(checkpoint_dir, model_id)
+    if os.path.exists(os.path.join(dirpath, "compact.pt")):
+        return load_compact(model_id, epoch, checkpoint_dir)
+    if epoch is None:
+        epoch = find_best_epoch(model_id, checkpoint_dir)
+    path = os.path.join(dirpath, "last.ckpt" if epoch == "last" else "model-epoch=%02d.ckpt"%int(epoch))
+    if model_id.find("lstm-ae") != -1:
+        model = Hydro_LSTM_AE.load_from_checkpoint(path)
+    else:
+        model = Hydro_LSTM.load_from_checkpoint(path)
+    model.eval()
+    return model
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Export checkpoints to an inference-only format")
+    parser.add_argument('--model_ids', type=str, nargs="*", default=None, help="Runs to export, default all runs in checkpoints/")
+    parser.add_argument('--fp16', type=int, default=0, help="Store weights in half precision. 0 False, else True")
+    parser.add_argument('--prune', type=int, default=0, help="Remove the exported model-epoch=XX.ckpt files. 0 False, else True")
+    parser.add_argument('--keep_last', type=int, default=1, help="Keep last.ckpt to resume training when pruning. 0 False, else True")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    checkpoint_dir = "checkpoints"
+    model_ids = args.model_ids
+    if not model_ids:
+        model_ids = [d for d in sorted(os.listdir(checkpoint_dir)) if os.path.isdir(os.path.join(checkpoint_dir, d)) and checkpoint_files(os.path.join(checkpoint_dir, d))]
+    for model_id in model_ids:
+        size_before, size_after = export_run(model_id, checkpoint_dir, fp16=bool(args.fp16), prune=bool(args.prune), keep_last=bool(args.keep_last))
+        print("%s: %.1f MB -> %.1f MB"%(model_id, size_before/2**20, size_after/2**20))
@@ -157,15 +157,29 @@ class CamelDataset(Dataset):
     def save_statics(self, filename):
         np_data =  self.statics_data.squeeze().cpu().numpy()
         df = pd.DataFrame(np_data, columns=self.df_statics.columns)
-        df.insert(0, "basin_id", self.loaded_basin_ids)
+        df.insert(0, "basin_id", self.basin_list)
         df.to_csv(filename, sep=" ")
 
 
+    def store_statics(self, store):
+        """
+        Write the (normalized) statics to the "statics" feature set of a FeatureStore
+        """
+        store.save("statics", self.basin_list, self.df_statics.columns, self.statics_data.reshape(self.len_dataset, -1).cpu().numpy())
+
+
     def save_hydro(self, filename):
         np_data =  self.hydro_data.squeeze().cpu().numpy()
         df = pd.DataFrame(np_data, columns=self.df_hydro.columns)
-        df.insert(0, "basin_id", self.loaded_basin_ids)
+        df.insert(0, "basin_id", self.basin_list)
         df.to_csv(filename, sep=" ")
+
+
+    def store_hydro(self, store):
+        """
+        Write the (normalized) hydrological signatures to the "hydro" feature set of a FeatureStore
+        """
+        store.save("hydro", self.basin_list, self.df_hydro.columns, self.hydro_data.reshape(self.len_dataset, -1).cpu().numpy())
     
     
     def __len__(self):
@@ -182,3 +196,35 @@ class CamelDataset(Dataset):
 
 
 
+
+
+class YearlyCamelsDataset(Dataset):
+    """
+    Consecutive one-year (days_per_year days) sequences between start and end of the basins indices of a
+    loaded CamelDataset, without copying its data. The basins of the split and the period of the dates
+    select the train, validation or test sequences
+    """
+    def __init__(self, indices, start: str, end: str, camel_dataset: CamelDataset, days_per_year: int = 365) -> None:
+        super().__init__()
+        self.indices = np.asarray(indices, dtype=int)
+        self.camel_dataset = camel_dataset
+        self.seq_len = days_per_year
+        start_date = datetime.datetime.strptime(start, '%Y/%m/%d').date()
+        end_date = datetime.datetime.strptime(end, '%Y/%m/%d').date()
+        self.offset = (start_date - camel_dataset.start_date).days
+        assert self.offset >= 0 and (end_date - camel_dataset.end_date).days <= 0
+        self.num_years = ((end_date - start_date).days + 1) // days_per_year
+
+    def __len__(self):
+        return len(self.indices) * self.num_years
+
+    def __getitem__(self, idx):
+        basin, year = divmod(idx, self.num_years)
+        i = self.indices[basin]
+        start = self.offset + year * self.seq_len
+        x_data = self.camel_dataset.input_data[i, :, start:start+self.seq_len]
+        y_data = self.camel_dataset.output_data[i, :, start:start+self.seq_len]
+        statics = self.camel_dataset.statics_data[i]
+        hydro = self.camel_dataset.hydro_data[i]
+
+        return x_data, y_data, statics, hydro
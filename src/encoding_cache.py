@@ -0,0 +1,226 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# pytorch
+import torch
+
+# user functions
+from dataset import CamelDataset
+from utils import NSELoss
+from registry import find_best_epoch
+from compact_checkpoints import load_model
+from feature_store import FeatureStore, encoded_feature_set
+
+
+def encode_basins(model, camel_dataset, chunk_size=128, filename=None, device=None, indices=None):
+    """
+    Encode the basins of camel_dataset in batches of chunk_size basins and compute their NSE.
+    Memory is bounded by the chunk size; if filename is given the encoded features are appended
+    to it (same format as before, space separated with basin_id and E0, E1, ... columns) as soon
+    as each chunk is computed.
+    Args:
+        indices : indices of the basins to encode, default all
+    Returns
+    -------
+        enc : np.ndarray of size (num_basins, encoded_space_dim), after sigmoid
+        nse : np.ndarray of size (num_basins,)
+    """
+    if device is None:
+        device = model.device
+    if indices is None:
+        indices = np.arange(len(camel_dataset))
+    indices = np.asarray(indices, dtype=int)
+    model.eval()
+    loss_fn = NSELoss(reduction=None)
+    num_basins = len(indices)
+    enc = np.zeros((num_basins, model.encoded_space_dim), dtype=np.float32)
+    nse = np.zeros(num_basins, dtype=np.float32)
+
+    f = open(filename, "w") if filename is not None else None
+    try:
+        with torch.inference_mode():
+            for start in range(0, num_basins, chunk_size):
+                end = min(start + chunk_size, num_basins)
+                chunk = torch.from_numpy(indices[start:end])
+                x = camel_dataset.input_data[chunk].to(device)
+                y = camel_dataset.output_data[chunk].to(device)
+                enc_chunk, rec = model(x, y)
+                # NSE of the whole chunk at once, tensors of size (chunk_size, seq_len)
+                nse[start:end] = - loss_fn(x.squeeze(-1).squeeze(1), rec.squeeze(-1).squeeze(1)).cpu().numpy()
+                # pass thorugh sigmoid
+                enc[start:end] = torch.sigmoid(enc_chunk).cpu().numpy()
+
+                if f is not None:
+                    df = pd.DataFrame(enc[start:end], columns=["E"+str(i) for i in range(enc.shape[1])], index=range(start, end))
+                    df.insert(0, "basin_id", [camel_dataset.basin_list[i] for i in indices[start:end]])
+                    df.to_csv(f, sep=" ", header=(start == 0))
+                    f.flush()
+    finally:
+        if f is not None:
+            f.close()
+    return enc, nse
+
+
+def checkpoint_hash(model_id, epoch, checkpoint_dir="checkpoints"):
+    """
+    Hash of the weights of a checkpoint, read from the compact export if present, else from model-epoch=XX.ckpt
+    """
+    dirpath = os.path.join(checkpoint_dir, model_id)
+    path_compact = os.path.join(dirpath, "compact.pt")
+    h = hashlib.sha1()
+    if os.path.exists(path_compact):
+        compact = torch.load(path_compact, map_location=torch.device('cpu'))
+        entry = compact["checkpoints"]["epoch="+str(int(epoch))]["state_dict"]
+        h.update(json.dumps(entry, sort_keys=True).encode())
+    else:
+        with open(os.path.join(dirpath, "model-epoch=%02d.ckpt"%int(epoch)), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def dataset_fingerprint(camel_dataset):
+    """
+    Fingerprint of the data a CamelDataset loads: source, forcing attributes and size and
+    modification time of the files of every basin. Normalization is global over the basins,
+    so the fingerprint covers all of them. It does not need the data to be loaded
+    """
+    h = hashlib.sha1()
+    # the forcing columns are read by position, "PRCP(mm/day)" and "prcp(mm/day)" load the same data
+    force_attributes = [name.lower() for name in camel_dataset.force_attributes]
+    h.update(json.dumps([camel_dataset.source_data_set, force_attributes]).encode())
+    for basin_id in camel_dataset.basin_list:
+        for path in [os.path.join(camel_dataset.data_path, camel_dataset.source_data_set, basin_id + "_nldas.txt"),
+                     os.path.join(camel_dataset.data_path, "streamflow", basin_id + "_streamflow.txt")]:
+            stat = os.stat(path)
+            h.update((basin_id+str(stat.st_size)+str(int(stat.st_mtime))).encode())
+    return h.hexdigest()
+
+
+class EncodingCache:
+    """
+    Cache of the encoded features of Hydro_LSTM_AE checkpoints.
+    An entry is keyed on (checkpoint hash, dataset fingerprint, date window) and holds the encoded
+    features and NSE of the basins computed so far; requests for other basins compute only those.
+    Entries are npz files in cache_dir, the least recently used are removed when the cache
+    grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir="encoded_features/cache", max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, ckpt_hash, fingerprint, start_date, end_date):
+        return hashlib.sha1((ckpt_hash+fingerprint+str(start_date)+str(end_date)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+".npz")
+
+    def _read(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path) # mark as recently used
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    def _write(self, key, entry):
+        path = self._path(key)
+        with open(path+".tmp", "wb") as f:
+            np.savez(f, **entry)
+        os.replace(path+".tmp", path)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        paths = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npz")]
+        paths.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in paths)
+        # the most recent entry is always kept
+        while total > self.max_bytes and len(paths) > 1:
+            path = paths.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def lookup(self, key, basin_ids):
+        """
+        Returns
+        -------
+            enc, nse : rows of the cached basins_ids, None if any of them is missing
+        """
+        entry = self._read(key)
+        if entry is None:
+            return None, None
+        position = {basin_id: i for i, basin_id in enumerate(entry["basin_ids"])}
+        if any(basin_id not in position for basin_id in basin_ids):
+            return None, None
+        rows = [position[basin_id] for basin_id in basin_ids]
+        return entry["enc"][rows], entry["nse"][rows]
+
+    def encode(self, model, ckpt_hash, camel_dataset, basin_ids=None, fingerprint=None, chunk_size=128, device=None):
+        """
+        Encoded features of basin_ids (default all basins of camel_dataset), computing only the
+        basins missing from the cache. camel_dataset must have its data loaded if any is missing
+        Returns
+        -------
+            enc : np.ndarray of size (num_basins, encoded_space_dim)
+            nse : np.ndarray of size (num_basins,)
+        """
+        if basin_ids is None:
+            basin_ids = list(camel_dataset.basin_list)
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(camel_dataset)
+        key = self.key(ckpt_hash, fingerprint, camel_dataset.start_date, camel_dataset.end_date)
+        entry = self._read(key)
+        if entry is None:
+            entry = {"basin_ids": np.array([], dtype=str), "enc": np.zeros((0, model.encoded_space_dim), dtype=np.float32), "nse": np.zeros(0, dtype=np.float32)}
+
+        cached = set(entry["basin_ids"].tolist())
+        missing = [basin_id for basin_id in dict.fromkeys(basin_ids) if basin_id not in cached]
+        if missing:
+            if not hasattr(camel_dataset, "min_flow"):
+                raise Exception("Basins missing from the encoding cache, load the data of the dataset first")
+            index = {basin_id: i for i, basin_id in enumerate(camel_dataset.basin_list)}
+            enc, nse = encode_basins(model, camel_dataset, chunk_size=chunk_size, device=device, indices=[index[basin_id] for basin_id in missing])
+            entry = {"basin_ids": np.concatenate((entry["basin_ids"], np.array(missing, dtype=str))),
+                     "enc": np.concatenate((entry["enc"], enc)),
+                     "nse": np.concatenate((entry["nse"], nse))}
+            self._write(key, entry)
+            print("Encoding cache: %d basins computed, %d cached"%(len(missing), len(cached)))
+
+        return self.lookup(key, basin_ids)
+
+
+def load_encodings(model_id, epoch=None, dates=("1980/10/01", "2010/09/30"), force_attributes=("PRCP(mm/day)", "SRAD(W/m2)", "Tmin(C)", "Tmax(C)", "Vp(Pa)"),
+                   checkpoint_dir="checkpoints", cache_dir="encoded_features/cache", chunk_size=128):
+    """
+    Encoded features of all basins for a trained autoencoder, from the cache when available.
+    The dataset is loaded and the model run only for the basins missing from the cache.
+    Without the checkpoints of model_id, the features saved by extract_features.py are read from the feature store.
+    Returns
+    -------
+        basin_ids : list of str
+        enc : np.ndarray of size (num_basins, encoded_space_dim)
+    """
+    if not os.path.isdir(os.path.join(checkpoint_dir, model_id)):
+        store = FeatureStore()
+        return store.basin_ids(encoded_feature_set(model_id)), store.load(encoded_feature_set(model_id))
+
+    if epoch is None:
+        epoch = find_best_epoch(model_id, checkpoint_dir)
+    camel_dataset = CamelDataset(list(dates), list(force_attributes))
+    basin_ids = list(camel_dataset.basin_list)
+    cache = EncodingCache(cache_dir)
+    fingerprint = dataset_fingerprint(camel_dataset)
+    ckpt_hash = checkpoint_hash(model_id, epoch, checkpoint_dir)
+    enc, _ = cache.lookup(cache.key(ckpt_hash, fingerprint, camel_dataset.start_date, camel_dataset.end_date), basin_ids)
+    if enc is None:
+        camel_dataset.load_data()
+        model = load_model(model_id, epoch, checkpoint_dir)
+        enc, _ = cache.encode(model, ckpt_hash, camel_dataset, basin_ids, fingerprint=fingerprint, chunk_size=chunk_size)
+    return basin_ids, enc
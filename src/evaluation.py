@@ -0,0 +1,139 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# pytorch
+import torch
+import torch.multiprocessing as mp
+
+# user functions
+from registry import find_best_epoch
+from metrics import HydroMetrics
+from compact_checkpoints import load_model
+from sweep import share_dataset
+
+
+# dataset shared by the workers of the pool, set by _init_worker
+_WORKER_STATE = {}
+
+METRICS = ["nse", "mnse", "pfab"]
+
+
+def _forward(model, camel_dataset, chunk, device):
+    """
+    Returns
+    -------
+        x, rec : observed and simulated streamflow of the basins chunk, tensors of size (len(chunk), seq_len)
+    """
+    x = camel_dataset.input_data[chunk].to(device)
+    y = camel_dataset.output_data[chunk].to(device)
+    if hasattr(model, "encoded_space_dim"):
+        _, rec = model(x, y)
+    else:
+        rec = model(y, camel_dataset.statics_data[chunk].to(device), camel_dataset.hydro_data[chunk].to(device))
+    return x.squeeze(-1).squeeze(1), rec.squeeze(-1).squeeze(1)
+
+
+def evaluate_model(model, camel_dataset, indices, chunk_size=32, device=torch.device("cpu")):
+    """
+    Run a trained Hydro_LSTM or Hydro_LSTM_AE over the basins indices of camel_dataset in chunks
+    of chunk_size basins, so that memory does not grow with the number of basins.
+    Returns
+    -------
+        metrics : dict "nse", "mnse", "pfab" -> np.ndarray of size (len(indices),)
+    """
+    hydro_metrics = HydroMetrics(METRICS, ex_prob=0.01, reduction=None)
+    indices = np.asarray(indices, dtype=int)
+    metrics = {name: np.zeros(len(indices), dtype=np.float32) for name in METRICS}
+    model = model.to(device).eval()
+    with torch.inference_mode():
+        for start in range(0, len(indices), chunk_size):
+            end = min(start + chunk_size, len(indices))
+            x, rec = _forward(model, camel_dataset, torch.from_numpy(indices[start:end]), device)
+            for name, values in hydro_metrics(x, rec).items():
+                metrics[name][start:end] = values.cpu().numpy()
+    return metrics
+
+
+def predict(model, camel_dataset, indices, chunk_size=32, device=torch.device("cpu")):
+    """
+    Simulated (normalized) streamflow of the basins indices of camel_dataset, computed in chunks of chunk_size basins
+    Returns
+    -------
+        rec : np.ndarray of size (len(indices), seq_len)
+    """
+    indices = np.asarray(indices, dtype=int)
+    out = np.zeros((len(indices), camel_dataset.seq_len), dtype=np.float32)
+    model = model.to(device).eval()
+    with torch.inference_mode():
+        for start in range(0, len(indices), chunk_size):
+            end = min(start + chunk_size, len(indices))
+            _, rec = _forward(model, camel_dataset, torch.from_numpy(indices[start:end]), device)
+            out[start:end] = rec.cpu().numpy()
+    return out
+
+
+def _init_worker(camel_dataset, indices, num_threads):
+    torch.set_num_threads(num_threads)
+    _WORKER_STATE["dataset"] = camel_dataset
+    _WORKER_STATE["indices"] = indices
+
+
+def _evaluate_task(task):
+    model_id, epoch, chunk_size, device, seed = task
+    # same noise for every model, as if evaluated alone
+    torch.manual_seed(seed)
+    if epoch is None:
+        epoch = find_best_epoch(model_id)
+    model = load_model(model_id, epoch)
+    metrics = evaluate_model(model, _WORKER_STATE["dataset"], _WORKER_STATE["indices"], chunk_size=chunk_size, device=device)
+    return model_id, metrics
+
+
+def evaluate_models(model_ids, camel_dataset, indices, epochs=None, num_workers=None, num_threads=None, chunk_size=32, seed=42):
+    """
+    Evaluate several models in parallel worker processes on the basins indices of camel_dataset.
+    The dataset is moved to shared memory once; every worker loads one model at a time and streams
+    the basins in chunks of chunk_size, so peak memory is bounded by num_workers models and chunks.
+    Arguments
+    ---------
+        epochs : list with the epoch of each model, default their best epoch
+        num_workers : number of models evaluated concurrently, default min(len(model_ids), num_cpus)
+        num_threads : torch threads per worker, default num_cpus // num_workers
+    Returns
+    -------
+        nse_df, mnse_df, pfab_df : pd.DataFrame with one column per model id and one row per basin
+    """
+    num_cpus = multiprocessing.cpu_count()
+    num_gpus = torch.cuda.device_count()
+    if epochs is None:
+        epochs = [None] * len(model_ids)
+    if num_workers is None:
+        num_workers = min(len(model_ids), num_cpus)
+    if num_threads is None:
+        num_threads = max(1, num_cpus // num_workers)
+
+    tasks = []
+    for i, (model_id, epoch) in enumerate(zip(model_ids, epochs)):
+        device = torch.device("cuda", i % num_gpus) if num_gpus > 0 else torch.device("cpu")
+        tasks.append((model_id, epoch, chunk_size, device, seed))
+
+    results = {}
+    if num_workers <= 1:
+        _init_worker(camel_dataset, indices, num_threads)
+        for task in tasks:
+            model_id, metrics = _evaluate_task(task)
+            results[model_id] = metrics
+    else:
+        share_dataset(camel_dataset)
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(camel_dataset, indices, num_threads)) as pool:
+            for model_id, metrics in pool.imap_unordered(_evaluate_task, tasks):
+                print("Evaluated "+model_id)
+                results[model_id] = metrics
+
+    # columns in the order of model_ids
+    dfs = []
+    for name in METRICS:
+        dfs.append(pd.DataFrame({model_id: results[model_id][name] for model_id in model_ids}))
+    return tuple(dfs)
@@ -0,0 +1,175 @@
+import os
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b"HYFEAT01"
+ALIGNMENT = 64
+
+# text files written before the store, converted on first use
+LEGACY_FILES = {"statics": "statics.txt", "hydro": "hydro.txt"}
+LEGACY_ENCODED = "encoded_features/encoded_features_{}.txt"
+
+
+def normalize_basin_id(basin_id):
+    # "01054200", "1054200" and 1054200 are the same basin
+    return str(int(basin_id)).rjust(8, "0")
+
+
+def encoded_feature_set(model_id):
+    """
+    Name of the feature set of the encoded features of an autoencoder
+    """
+    return "encoded-"+model_id
+
+
+class FeatureStore:
+    """
+    Feature sets (statics, hydrological signatures, encoded features, ...) stored as one binary file each:
+        magic, header length, JSON header (basin ids, column names, shape), float32 matrix of size (num_basins, num_columns)
+    The matrix is read memory-mapped and rows are aligned to any list of basin ids with one index lookup.
+    The text files of the previous format (statics.txt, hydro.txt, encoded_features/encoded_features_<model_id>.txt)
+    are converted the first time their feature set is opened.
+    """
+    def __init__(self, root="features"):
+        self.root = root
+        self._headers = {}
+
+    def path(self, feature_set):
+        return os.path.join(self.root, feature_set+".feat")
+
+    def feature_sets(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(f[:-len(".feat")] for f in os.listdir(self.root) if f.endswith(".feat"))
+
+    def save(self, feature_set, basin_ids, columns, data):
+        """
+        Args:
+            basin_ids : basin of each row of data
+            columns : name of each column of data
+            data : array of size (len(basin_ids), len(columns)), stored as float32
+        """
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        basin_ids = [normalize_basin_id(basin_id) for basin_id in basin_ids]
+        columns = [str(column) for column in columns]
+        assert data.shape == (len(basin_ids), len(columns))
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(feature_set)
+        with open(path+".tmp", "wb") as f:
+            self._write_header(f, basin_ids, columns)
+            f.write(data.tobytes())
+        os.replace(path+".tmp", path)
+        self._headers.pop(feature_set, None)
+
+    def _write_header(self, f, basin_ids, columns):
+        header = {"basin_ids": basin_ids, "columns": columns, "shape": [len(basin_ids), len(columns)], "dtype": "float32"}
+        header_bytes = json.dumps(header).encode()
+        # data starts at a multiple of ALIGNMENT
+        offset = len(MAGIC) + 8 + len(header_bytes)
+        padding = (-offset) % ALIGNMENT
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes) + padding))
+        f.write(header_bytes + b" " * padding)
+        return offset + padding
+
+    def create(self, feature_set, basin_ids, columns):
+        """
+        New feature set written in chunks of rows: the rows of the returned writable np.memmap of size
+        (len(basin_ids), len(columns)), filled with NaN, are written as they are computed and the feature
+        set replaces the previous one only at finish(feature_set, data)
+        """
+        basin_ids = [normalize_basin_id(basin_id) for basin_id in basin_ids]
+        columns = [str(column) for column in columns]
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(feature_set)
+        with open(path+".tmp", "wb") as f:
+            offset = self._write_header(f, basin_ids, columns)
+            f.truncate(offset + 4 * len(basin_ids) * len(columns))
+        data = np.memmap(path+".tmp", dtype=np.float32, mode="r+", offset=offset, shape=(len(basin_ids), len(columns)))
+        data[:] = np.nan
+        return data
+
+    def finish(self, feature_set, data):
+        data.flush()
+        del data
+        path = self.path(feature_set)
+        os.replace(path+".tmp", path)
+        self._headers.pop(feature_set, None)
+
+    def save_frame(self, feature_set, df, basin_ids):
+        self.save(feature_set, basin_ids, list(df.columns), df.to_numpy())
+
+    def _import_legacy(self, feature_set):
+        if feature_set in LEGACY_FILES:
+            filename = LEGACY_FILES[feature_set]
+        elif feature_set.startswith("encoded-"):
+            filename = LEGACY_ENCODED.format(feature_set[len("encoded-"):])
+        else:
+            return False
+        if not os.path.exists(filename):
+            return False
+        # space separated, pandas index, basin_id and one column per feature
+        df = pd.read_csv(filename, sep=" ", dtype={"basin_id": str}, index_col=0)
+        self.save(feature_set, df["basin_id"], list(df.columns[1:]), df.iloc[:, 1:].to_numpy())
+        return True
+
+    def _header(self, feature_set):
+        if feature_set not in self._headers:
+            path = self.path(feature_set)
+            if not os.path.exists(path) and not self._import_legacy(feature_set):
+                raise Exception("Feature set "+feature_set+" not found in "+self.root)
+            with open(path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise Exception(path+" is not a feature store file")
+                length = struct.unpack("<Q", f.read(8))[0]
+                header = json.loads(f.read(length))
+            header["offset"] = len(MAGIC) + 8 + length
+            header["index"] = pd.Index(header["basin_ids"])
+            self._headers[feature_set] = header
+        return self._headers[feature_set]
+
+    def basin_ids(self, feature_set):
+        return list(self._header(feature_set)["basin_ids"])
+
+    def columns(self, feature_set):
+        return list(self._header(feature_set)["columns"])
+
+    def open(self, feature_set):
+        """
+        Returns
+        -------
+            read-only np.memmap of size (num_basins, num_columns), rows in the order of basin_ids(feature_set)
+        """
+        header = self._header(feature_set)
+        return np.memmap(self.path(feature_set), dtype=np.float32, mode="r", offset=header["offset"], shape=tuple(header["shape"]))
+
+    def load(self, feature_set, basin_ids=None, columns=None):
+        """
+        Rows of basin_ids (default all, in stored order) and columns (names, default all) of a feature set
+        Returns
+        -------
+            np.ndarray of float32 of size (len(basin_ids), len(columns))
+        """
+        header = self._header(feature_set)
+        data = self.open(feature_set)
+        if basin_ids is None:
+            rows = slice(None)
+        else:
+            requested = [normalize_basin_id(basin_id) for basin_id in basin_ids]
+            rows = header["index"].get_indexer(requested)
+            if (rows < 0).any():
+                missing = [basin_id for basin_id, row in zip(requested, rows) if row < 0]
+                raise Exception("Basins not found in feature set "+feature_set+": "+", ".join(missing[:10]))
+        if columns is None:
+            return np.array(data[rows])
+        position = {column: i for i, column in enumerate(header["columns"])}
+        return np.array(data[rows][:, [position[column] for column in columns]])
+
+    def load_frame(self, feature_set, basin_ids=None, columns=None):
+        """
+        load as a pd.DataFrame with the column names
+        """
+        return pd.DataFrame(self.load(feature_set, basin_ids, columns), columns=self.columns(feature_set) if columns is None else list(columns))
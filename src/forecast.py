@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+
+# user functions
+from models import Hydro_LSTM
+
+
+class StatefulForecaster:
+    """
+    Incremental streamflow forecasting with a unidirectional Hydro_LSTM.
+    The (h, c) state of the LSTM is kept for every basin of the fleet, so that each new day of
+    forcing costs one LSTM step instead of a rerun over a whole seq_len window. All the basins
+    (or a subset of them) are advanced in one batched call.
+    The state starts at zeros: spin it up by stepping over some past forcing (e.g. one year)
+    before using the forecasts, as the warmup days are discarded in training.
+    """
+    def __init__(self, model, basin_ids, statics=None, hydro=None):
+        """
+        Args:
+            model : trained unidirectional Hydro_LSTM
+            basin_ids : list of basin ids of the fleet
+            statics : tensor of size (num_basins, 27), needed if the model uses statics
+            hydro : tensor of size (num_basins, 13), needed if the model uses hydrological signatures
+        """
+        assert isinstance(model, Hydro_LSTM)
+        if model.lstm.bidirectional:
+            raise Exception("Stateful forecasting needs a unidirectional LSTM")
+        if model.statics and statics is None:
+            raise Exception("The model uses statics, provide them")
+        if model.hydro and hydro is None:
+            raise Exception("The model uses hydrological signatures, provide them")
+        self.model = model.eval()
+        self.device = model.device
+        self.basin_ids = list(basin_ids)
+        self.index = {basin_id: i for i, basin_id in enumerate(self.basin_ids)}
+        num_basins = len(self.basin_ids)
+
+        # size (num_basins, 1, 1, num_attributes) as in CamelDataset
+        self.statics = torch.zeros(num_basins, 1, 1, 27, device=self.device) if statics is None else statics.reshape(num_basins, 1, 1, -1).to(self.device)
+        self.hydro = torch.zeros(num_basins, 1, 1, 13, device=self.device) if hydro is None else hydro.reshape(num_basins, 1, 1, -1).to(self.device)
+
+        shape = (model.lstm.num_layers, num_basins, model.lstm.hidden_size)
+        self.h = torch.zeros(shape, device=self.device)
+        self.c = torch.zeros(shape, device=self.device)
+        self.days = np.zeros(num_basins, dtype=int) # days stepped per basin
+
+    def _indices(self, basin_ids):
+        if basin_ids is None:
+            return torch.arange(len(self.basin_ids), device=self.device)
+        return torch.tensor([self.index[basin_id] for basin_id in basin_ids], device=self.device)
+
+    def step(self, forcing, basin_ids=None):
+        """
+        Advance the state of the basins by the days of forcing
+        Args:
+            forcing : normalized forcing of size (num_selected, days, force_attributes) or (num_selected, force_attributes) for one day
+            basin_ids : basins the rows of forcing refer to, default all the fleet in order
+        Returns
+        -------
+            streamflow : normalized streamflow in [0,1] of size (num_selected, days)
+        """
+        forcing = torch.as_tensor(forcing, dtype=torch.float32, device=self.device)
+        if forcing.dim() == 2:
+            forcing = forcing.unsqueeze(1)
+        idx = self._indices(basin_ids)
+        assert forcing.shape[0] == len(idx)
+        with torch.no_grad():
+            rec, (h, c) = self.model.step(forcing, self.statics[idx], self.hydro[idx], (self.h[:, idx], self.c[:, idx]))
+        self.h[:, idx] = h
+        self.c[:, idx] = c
+        self.days[idx.cpu().numpy()] += forcing.shape[1]
+        return rec
+
+    def snapshot(self):
+        """
+        Copy of the state of the fleet, to restore it later, e.g. before a what-if forecast
+        """
+        return {"basin_ids": list(self.basin_ids), "h": self.h.clone(), "c": self.c.clone(), "days": self.days.copy()}
+
+    def restore(self, snapshot):
+        if snapshot["basin_ids"] != self.basin_ids:
+            raise Exception("The snapshot was taken on a different fleet of basins")
+        self.h = snapshot["h"].clone().to(self.device)
+        self.c = snapshot["c"].clone().to(self.device)
+        self.days = snapshot["days"].copy()
+
+    def save(self, path):
+        torch.save(self.snapshot(), path)
+
+    def load(self, path):
+        self.restore(torch.load(path, map_location=self.device))
+
+    def reset(self, basin_ids=None):
+        """
+        Set the state of the basins back to zeros
+        """
+        idx = self._indices(basin_ids)
+        self.h[:, idx] = 0.0
+        self.c[:, idx] = 0.0
+        self.days[idx.cpu().numpy()] = 0
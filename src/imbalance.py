@@ -0,0 +1,245 @@
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+
+def _square_distances(x):
+    """
+    Squared euclidean distances between the rows of x, of size (N, num_coords), summed coordinate by coordinate
+    """
+    d = np.zeros((x.shape[0], x.shape[0]))
+    for c in range(x.shape[1]):
+        d += (x[:, c, None] - x[None, :, c])**2
+    return d
+
+
+def _neighbor_order(x):
+    """
+    All the points ordered by distance from every point, with sklearn's exact euclidean search as in
+    dadapy's compute_nn_distances(x, maxk=N-1). Points at the same distance keep the order of this search,
+    which depends on the number of neighbors requested, so all N are always requested.
+    Args:
+        x : coordinates of size (N, num_coords)
+    Returns
+    -------
+        np.ndarray of int of size (N, N), row i starts with the nearest neighbors of i
+    """
+    n = x.shape[0]
+    return NearestNeighbors(n_neighbors=n, metric="euclidean").fit(x).kneighbors(x, return_distance=False)
+
+
+def _positions(order):
+    """
+    Inverse of _neighbor_order: positions[i, j] is the rank of point j in the order of point i
+    """
+    n = order.shape[0]
+    positions = np.empty_like(order)
+    positions[np.arange(n)[:, None], order] = np.arange(order.shape[1])[None, :]
+    return positions
+
+
+def _ranks_without_ties(d, order_target, k, tol):
+    """
+    Neighbors and ranks of a subset from its squared distances, with argpartition on the k+2 nearest
+    and by counting the closer points, valid when no two distances that decide them are within tol
+    Args:
+        d : squared distances of the subset of size (N, N)
+        order_target : neighbor order of the target space
+    Returns
+    -------
+        neighbors : k nearest neighbors of every point (the point itself excluded) of size (N, k)
+        ranks : rank in the subset of the k nearest neighbors in the target space, of size (N, k)
+        ties : rows where distances within tol make the above differ from the order of the exact search
+    """
+    n = d.shape[0]
+    rows = np.arange(n)[:, None]
+    # k+1 nearest, the point itself first, plus the next one to detect a tie on the boundary
+    part = np.argpartition(d, k+1, axis=1)[:, :k+2]
+    part = np.take_along_axis(part, np.argsort(d[rows, part], axis=1), axis=1)
+    ties = np.any(np.diff(d[rows, part], axis=1) <= tol, axis=1)
+    ranks = np.zeros((n, k))
+    for j in range(k):
+        d_target = d[rows[:, 0], order_target[:, j+1]][:, None]
+        ranks[:, j] = np.sum(d < d_target, axis=1)
+        # any other point at the distance of the target neighbor
+        ties |= np.sum(np.abs(d - d_target) <= tol, axis=1) > 1
+    return part[:, 1:k+1], ranks, ties
+
+
+class InformationImbalance:
+    """
+    Information imbalance (Glielmo et al. 2022) between a target space and subsets of the coordinates of X,
+    identical to dadapy's MetricComparisons after compute_distances(N-1):
+        imbalance(A -> B) = mean rank in B of the k nearest neighbors in A / (N/2)
+    The squared distances of every coordinate are computed once; the distances of a subset are the sum of those
+    of a smaller subset and of one more coordinate, as the greedy selection adds one coordinate at a time.
+    Neighbors come from argpartition on the k nearest and ranks from counting the closer points. Points at
+    (nearly) equal distance, e.g. from duplicated attribute values, are ordered by dadapy as its sklearn search
+    returns them; subsets with such ties use the same search, so the results are identical.
+    Candidate subsets are evaluated in parallel threads.
+    """
+    def __init__(self, X, target=None, num_threads=None):
+        """
+        Args:
+            X : coordinates of size (N, num_coords)
+            target : coordinates of the target space of size (N, num_target_coords), default X
+            num_threads : threads evaluating the candidate subsets, default the number of cpus
+        """
+        # the neighbor search runs on X as given, like dadapy, since float32 and float64 may order ties differently
+        self.X = np.asarray(X)
+        if not np.issubdtype(self.X.dtype, np.floating):
+            self.X = self.X.astype(np.float64)
+        self.N, self.dims = self.X.shape
+        self.num_threads = multiprocessing.cpu_count() if num_threads is None else num_threads
+        # squared distances of each coordinate, size (num_coords, N, N)
+        self.coord_distances = np.stack([_square_distances(self.X[:, [c]].astype(np.float64)) for c in range(self.dims)])
+        target = self.X if target is None else np.asarray(target)
+        assert target.shape[0] == self.N
+        self.target_order = _neighbor_order(target)
+        self.target_positions = _positions(self.target_order)
+
+    def distances(self, coords):
+        """
+        Squared distances in the subspace of coords
+        """
+        return np.sum(self.coord_distances[list(coords)], axis=0)
+
+    def _imbalances_from_distances(self, coords, d, k):
+        # (target -> coords, coords -> target)
+        rows = np.arange(self.N)[:, None]
+        # bound on the rounding of the squared distances of sklearn's search, |x|^2 - 2 x.y + |y|^2
+        tol = 64 * np.finfo(np.float64).eps * (1.0 + 4.0 * np.max(np.sum(self.X[:, list(coords)].astype(np.float64)**2, axis=1)))
+        neighbors, ranks, ties = _ranks_without_ties(d, self.target_order, k, tol)
+        if ties.any():
+            order = _neighbor_order(self.X[:, list(coords)])
+            neighbors = order[:, 1:k+1]
+            ranks = _positions(order)[rows, self.target_order[:, 1:k+1]]
+        imb_target_coords = np.mean(ranks) / (self.N / 2.0)
+        imb_coords_target = np.mean(self.target_positions[rows, neighbors]) / (self.N / 2.0)
+        return imb_target_coords, imb_coords_target
+
+    def _map(self, function, items):
+        if self.num_threads <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+        # sklearn and numpy release the GIL on the (N, N) operations
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            return list(executor.map(function, items))
+
+    def imbalances(self, coord_list, k=1):
+        """
+        Information imbalances between the target space and each subset of coordinates of coord_list
+        Returns
+        -------
+            np.ndarray of size (2, len(coord_list)), (target -> coords, coords -> target)
+        """
+        return np.array(self._map(lambda coords: self._imbalances_from_distances(coords, self.distances(coords), k), coord_list)).T
+
+    def greedy_feature_selection(self, n_coords, k=1, n_best=10, symm=True):
+        """
+        Greedy selection of the coordinates most informative about the target space,
+        as dadapy's MetricComparisons.greedy_feature_selection_target: the n_best subsets of each
+        size are extended with one more coordinate, until subsets of n_coords coordinates.
+        Returns
+        -------
+            best_tuples : list of the best subset of each size
+            best_imbalances : np.ndarray of size (n_coords, 2), imbalances (target -> coords, coords -> target)
+                of the best subsets, rounded to 3 decimals
+            all_imbalances : imbalances of all the candidate subsets of each size
+        """
+        imbalances = self.imbalances([[i] for i in range(self.dims)], k=k)
+        if symm:
+            proj = np.dot(imbalances.T, np.array([np.sqrt(0.5), np.sqrt(0.5)]))
+            selected_coords = np.argsort(proj)[0:n_best]
+        else:
+            selected_coords = np.argsort(imbalances[1])[0:n_best]
+        selected_coords = [selected_coords[i : i + 1] for i in range(0, len(selected_coords))]
+        # distances of the selected subsets, extended incrementally
+        selected_distances = {frozenset(coords.tolist()): self.coord_distances[coords[0]] for coords in selected_coords}
+
+        best_one = selected_coords[0]
+        best_tuples = [[int(best_one[0])]]
+        best_imbalances = [[round(float(imbalances[0][best_one[0]]), 3), round(float(imbalances[1][best_one[0]]), 3)]]
+        all_imbalances = [[[round(float(num), 3) for num in imbalances[0]], [round(float(num), 3) for num in imbalances[1]]]]
+
+        while len(best_tuples) < n_coords:
+            c_list = []
+            parents = {}
+            for i in selected_coords:
+                for j in range(self.dims):
+                    if j not in i:
+                        ii = list(i)
+                        ii.append(j)
+                        c_list.append(ii)
+                        parents.setdefault(frozenset(ii), (frozenset(list(i)), j))
+            # same order of the candidates, and of the coordinates in each candidate, as dadapy
+            coord_list = [list(e) for e in set(frozenset(d) for d in c_list)]
+
+            def evaluate(coords):
+                parent, j = parents[frozenset(coords)]
+                return self._imbalances_from_distances(coords, selected_distances[parent] + self.coord_distances[j], k)
+            imbalances_ = np.array(self._map(evaluate, coord_list)).T
+
+            if symm:
+                proj = np.dot(imbalances_.T, np.array([np.sqrt(0.5), np.sqrt(0.5)]))
+                to_select = np.argsort(proj)[0:n_best]
+            else:
+                to_select = np.argsort(imbalances_[1])[0:n_best]
+
+            best_ind = to_select[0]
+            best_tuples.append(coord_list[best_ind])
+            best_imbalances.append([round(imbalances_[0][best_ind], 3), round(imbalances_[1][best_ind], 3)])
+            all_imbalances.append([[round(num, 3) for num in imbalances_[0]], [round(num, 3) for num in imbalances_[1]]])
+            selected_coords = np.array(coord_list)[to_select]
+            new_distances = {}
+            for coords in selected_coords:
+                key = frozenset(coords.tolist())
+                parent, j = parents[key]
+                new_distances[key] = selected_distances[parent] + self.coord_distances[j]
+            selected_distances = new_distances
+
+        return best_tuples, np.array(best_imbalances), all_imbalances
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Check the greedy selection against dadapy's MetricComparisons on the normalized statics")
+    parser.add_argument('--model_id', type=str, default=None, help="Autoencoder whose encoded features are added before the statics, e.g. lstm-ae-bdTrue-E4")
+    parser.add_argument('--n_coords', type=int, default=5, help="Size of the largest subset")
+    parser.add_argument('--n_best', type=int, default=1, help="Subsets extended at each size")
+    parser.add_argument('--k', type=int, default=1, help="Neighbors of the imbalance")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    import time
+    from dadapy.metric_comparisons import MetricComparisons
+    from feature_store import FeatureStore
+    from encoding_cache import load_encodings
+
+    args = parse_args()
+    # same space as analysis_imbalance.py: encoded features then statics, each min-max normalized
+    store = FeatureStore()
+    if args.model_id is None:
+        X = store.load("statics")
+    else:
+        basin_ids, enc = load_encodings(args.model_id)
+        X = np.concatenate((enc, store.load("statics", basin_ids)), axis=1)
+    # float32 as in the feature store
+    X = (X - X.min(axis=0)) / (X.max(axis=0) - X.min(axis=0))
+
+    start = time.perf_counter()
+    d = MetricComparisons(X)
+    d.compute_distances(X.shape[0]-1)
+    expected = d.greedy_feature_selection_target(target_ranks=d.dist_indices, n_coords=args.n_coords, n_best=args.n_best, k=args.k)
+    time_dadapy = time.perf_counter() - start
+    start = time.perf_counter()
+    result = InformationImbalance(X).greedy_feature_selection(n_coords=args.n_coords, n_best=args.n_best, k=args.k)
+    time_engine = time.perf_counter() - start
+
+    print("dadapy: %s in %.1f s"%(expected[0], time_dadapy))
+    print("engine: %s in %.1f s"%(result[0], time_engine))
+    if expected[0] != result[0] or not np.array_equal(expected[1], result[1]) or expected[2] != result[2]:
+        raise Exception("The greedy selection differs from dadapy's MetricComparisons")
+    print("Best sets and imbalances identical")
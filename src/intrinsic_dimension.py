@@ -0,0 +1,187 @@
+import argparse
+import os
+import json
+import math
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.optimize import curve_fit
+from dadapy import data
+
+
+RESULTS = ["ids_gride", "ids_err_gride", "rs_gride", "ids_twoNN", "ids_err_twoNN", "rs_twoNN"]
+
+
+def _id_2NN(mus, mu_fraction=0.9):
+    """
+    twoNN estimate of the intrinsic dimension from the ratios of the second to the first neighbor distances,
+    the linear fit of dadapy's Data.compute_id_2NN(algorithm="base")
+    """
+    N = mus.shape[0]
+    n_eff = int(N * mu_fraction)
+    log_mus_reduced = np.sort(np.log(mus))[:n_eff]
+    y = -np.log(1 - np.arange(1, n_eff + 1) / N)
+    intrinsic_dim, _ = curve_fit(lambda x, m: m * x, log_mus_reduced, y)
+    return intrinsic_dim[0]
+
+
+def _id_scaling_2NN(_data, n_min, mu_fraction=0.9, seed=42):
+    """
+    Same as return_id_scaling_2NN(n_min) of a Data with the full kNN graph (maxk = N-1) and no coordinates,
+    with the neighbors of each decimated subset found for all its points at once.
+    The random subsets are those of dadapy's default generator (rng_seed=42).
+    """
+    rng = np.random.default_rng(seed)
+    N = _data.N
+    max_ndec = int(math.log(N, 2)) - 1
+    num_subsets = np.round(N / np.array([2**i for i in range(max_ndec)])).astype(int)
+    if n_min is not None:
+        num_subsets = num_subsets[num_subsets > n_min]
+
+    ids_scaling = np.zeros(num_subsets.shape[0])
+    ids_scaling_err = np.zeros(num_subsets.shape[0])
+    rs_scaling = np.zeros(num_subsets.shape[0])
+    for i, num_subset in enumerate(num_subsets):
+        data_fraction = num_subset / N
+        if data_fraction == 1:
+            mus = _data.distances[:, 2] / _data.distances[:, 1]
+            ids_scaling[i] = _id_2NN(mus, mu_fraction)
+            rs_scaling[i] = np.mean(_data.distances[:, np.array([1, 2])])
+            continue
+        n_subset = int(np.rint(N * data_fraction))
+        n_iter = int(np.rint(1.0 / data_fraction))
+        ids = np.zeros(n_iter)
+        rs = np.zeros(n_iter)
+        for j in range(n_iter):
+            # same random subsets as dadapy
+            indices = rng.choice(N, n_subset, replace=False)
+            in_subset = np.zeros(N, dtype=bool)
+            in_subset[indices] = True
+            mask = in_subset[_data.dist_indices[indices]]
+            count = np.cumsum(mask, axis=1)
+            # first three neighbors within the subset, the point itself included
+            keep = count[:, -1] > 2
+            first = np.argmax(count[keep] >= 2, axis=1)
+            second = np.argmax(count[keep] >= 3, axis=1)
+            distances = np.stack([_data.distances[indices[keep], 0],
+                                  _data.distances[indices[keep], first],
+                                  _data.distances[indices[keep], second]], axis=1)
+            ids[j] = _id_2NN(distances[:, 2] / distances[:, 1], mu_fraction)
+            rs[j] = np.mean(distances[:, np.array([1, 2])])
+        ids_scaling[i] = np.mean(ids)
+        ids_scaling_err[i] = np.std(ids) / len(ids) ** 0.5
+        rs_scaling[i] = np.mean(rs)
+    return ids_scaling, ids_scaling_err, rs_scaling
+
+
+def compute_ids_scaling(X, range_max=2048, n_min=20, maxk=None):
+    """
+    Intrinsic dimension of X at different scales with Gride and twoNN + decimation, from a single kNN graph.
+    The graph is computed once up to maxk neighbors and given to dadapy as distances: Gride reads the
+    neighbor ratios from it and, with maxk = N-1 (default), the decimation of twoNN keeps the neighbors
+    within each random subset, so no neighbor search is repeated. With a smaller maxk dadapy searches
+    the neighbors of each subset.
+    Returns
+    -------
+        dict RESULTS -> np.ndarray
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if maxk is None:
+        maxk = X.shape[0] - 1
+    _data = data.Data(coordinates=X, maxk=maxk)
+    _data.compute_distances(maxk)
+    ids_gride, ids_err_gride, rs_gride = _data.return_id_scaling_gride(range_max=min(range_max, maxk))
+    if maxk == X.shape[0] - 1:
+        ids_twoNN, ids_err_twoNN, rs_twoNN = _id_scaling_2NN(_data, n_min)
+    else:
+        ids_twoNN, ids_err_twoNN, rs_twoNN = _data.return_id_scaling_2NN(n_min)
+    return {"ids_gride": ids_gride, "ids_err_gride": ids_err_gride, "rs_gride": rs_gride,
+            "ids_twoNN": ids_twoNN, "ids_err_twoNN": ids_err_twoNN, "rs_twoNN": rs_twoNN}
+
+
+def _cache_key(X, range_max, n_min, maxk):
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    h = hashlib.sha1()
+    h.update(json.dumps({"shape": X.shape, "range_max": range_max, "n_min": n_min, "maxk": maxk}).encode())
+    h.update(X.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _compute_task(task):
+    name, X, range_max, n_min, maxk = task
+    return name, compute_ids_scaling(X, range_max, n_min, maxk)
+
+
+def batch_ids_scaling(feature_sets, range_max=2048, n_min=20, maxk=None, num_workers=None, cache_dir="id_cache"):
+    """
+    compute_ids_scaling of several feature sets in parallel processes. Results are stored in
+    cache_dir/<name>-<hash>.npz, keyed by the data and the parameters, and read back instead of recomputed.
+    Args:
+        feature_sets : dict name -> np.ndarray of size (N, num_features)
+        num_workers : number of feature sets processed concurrently, default min(len(feature_sets), num_cpus)
+    Returns
+    -------
+        dict name -> dict RESULTS -> np.ndarray
+    """
+    results = {}
+    tasks = []
+    paths = {}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    for name, X in feature_sets.items():
+        if cache_dir is not None:
+            paths[name] = os.path.join(cache_dir, name+"-"+_cache_key(X, range_max, n_min, maxk)+".npz")
+            if os.path.exists(paths[name]):
+                with np.load(paths[name]) as f:
+                    results[name] = {key: f[key] for key in RESULTS}
+                continue
+        tasks.append((name, X, range_max, n_min, maxk))
+
+    if num_workers is None:
+        num_workers = min(len(tasks), multiprocessing.cpu_count())
+    # forked workers, analysis_id.py runs at module level and spawned workers would re-execute it
+    if "fork" not in multiprocessing.get_all_start_methods():
+        num_workers = 1
+    if num_workers <= 1:
+        computed = map(_compute_task, tasks)
+    else:
+        executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"))
+        computed = executor.map(_compute_task, tasks)
+    for name, result in computed:
+        results[name] = result
+        if cache_dir is not None:
+            np.savez(paths[name][:-len(".npz")]+".tmp.npz", **result)
+            os.replace(paths[name][:-len(".npz")]+".tmp.npz", paths[name])
+    if num_workers > 1:
+        executor.shutdown()
+
+    # same order as feature_sets
+    return {name: results[name] for name in feature_sets}
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Check the twoNN decimation on the shared kNN graph against dadapy's Data.return_id_scaling_2NN")
+    parser.add_argument('--num_points', type=int, default=500, help="Number of random points")
+    parser.add_argument('--dim', type=int, default=5, help="Dimension of the points")
+    parser.add_argument('--n_min', type=int, default=10, help="Smallest decimated subset")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    X = np.random.default_rng(0).normal(size=(args.num_points, args.dim))
+    # fresh Data objects, both draw the random subsets from dadapy's generator
+    _data = data.Data(coordinates=X, maxk=X.shape[0]-1)
+    _data.compute_distances(X.shape[0]-1)
+    expected = _data.return_id_scaling_2NN(args.n_min)
+    _data = data.Data(coordinates=X, maxk=X.shape[0]-1)
+    _data.compute_distances(X.shape[0]-1)
+    result = _id_scaling_2NN(_data, args.n_min)
+
+    for name, e, r in zip(["ids", "ids_err", "rs"], expected, result):
+        print(name, "dadapy:", np.round(e, 4), "engine:", np.round(r, 4))
+    if any(e.shape != r.shape or not np.allclose(e, r) for e, r in zip(expected, result)):
+        raise Exception("The twoNN decimation differs from dadapy's Data.return_id_scaling_2NN")
+    print("twoNN scaling identical")
@@ -0,0 +1,164 @@
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+from scipy.spatial import cKDTree
+
+# user functions
+from feature_store import FeatureStore, normalize_basin_id, encoded_feature_set
+
+
+class NeighborIndex:
+    """
+    k nearest basins in a feature space (encoded features, statics, ...), for regionalization.
+    Features are min-max normalized with the ranges of the basins the index is built on, then transformed
+    by the metric: weights of size (num_features,) give the distance sqrt(sum_i w_i (x_i - y_i)^2), a matrix L
+    of size (num_out, num_features) gives |L (x - y)|, and None the euclidean distance.
+    Points live in a KD-tree; basins added afterwards go to a buffer searched exhaustively and merged into
+    the tree when the buffer grows beyond rebuild_fraction of the tree.
+    """
+    def __init__(self, basin_ids, X, weights=None, normalize=True, leafsize=16, rebuild_fraction=0.1):
+        X = np.asarray(X, dtype=np.float64)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.leafsize = leafsize
+        self.rebuild_fraction = rebuild_fraction
+        if normalize:
+            self.offset = X.min(axis=0)
+            scale = X.max(axis=0) - self.offset
+            # constant features do not contribute to the distance
+            self.scale = np.where(scale > 0, scale, 1.0)
+        else:
+            self.offset = np.zeros(X.shape[1])
+            self.scale = np.ones(X.shape[1])
+        self.basin_ids = []
+        self._position = {}
+        self._points = np.zeros((0, self._transform(X[:0]).shape[1]))
+        self.tree = None
+        self.add(basin_ids, X)
+        self.rebuild()
+
+    def _transform(self, X):
+        Z = (np.asarray(X, dtype=np.float64) - self.offset) / self.scale
+        if self.weights is None:
+            return Z
+        if self.weights.ndim == 1:
+            return Z * np.sqrt(self.weights)
+        return Z @ self.weights.T
+
+    def __len__(self):
+        return len(self.basin_ids)
+
+    def rebuild(self):
+        """
+        Merge the buffer into the KD-tree
+        """
+        self.tree = cKDTree(self._points, leafsize=self.leafsize)
+
+    def add(self, basin_ids, X):
+        """
+        Insert new basins, features in the original (not normalized) space of size (len(basin_ids), num_features)
+        """
+        basin_ids = [normalize_basin_id(basin_id) for basin_id in basin_ids]
+        for basin_id in basin_ids:
+            if basin_id in self._position:
+                raise Exception("Basin "+basin_id+" already in the index")
+        for basin_id in basin_ids:
+            self._position[basin_id] = len(self.basin_ids)
+            self.basin_ids.append(basin_id)
+        self._points = np.concatenate((self._points, self._transform(np.atleast_2d(X))), axis=0)
+        if self.tree is not None and len(self) - self.tree.n > self.rebuild_fraction * self.tree.n:
+            self.rebuild()
+
+    def features(self, basin_ids):
+        """
+        Transformed features of basins of the index
+        """
+        return self._points[[self._position[normalize_basin_id(basin_id)] for basin_id in basin_ids]]
+
+    def _query(self, Z, k):
+        distances, positions = self.tree.query(Z, k=min(k, self.tree.n))
+        distances = distances.reshape(len(Z), -1)
+        positions = positions.reshape(len(Z), -1)
+        if len(self) > self.tree.n:
+            # exhaustive search of the buffer, merged with the tree neighbors
+            buffer = self._points[self.tree.n:]
+            d_buffer = np.sqrt(np.maximum(np.sum(Z**2, axis=1)[:, None] - 2 * Z @ buffer.T + np.sum(buffer**2, axis=1)[None, :], 0.0))
+            distances = np.concatenate((distances, d_buffer), axis=1)
+            positions = np.concatenate((positions, np.broadcast_to(np.arange(self.tree.n, len(self)), d_buffer.shape)), axis=1)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            positions = np.take_along_axis(positions, order, axis=1)
+        return distances, positions
+
+    def query(self, X, k=10):
+        """
+        k nearest basins of a batch of points in the original space, e.g. the features of ungauged basins
+        Args:
+            X : np.ndarray of size (num_queries, num_features)
+        Returns
+        -------
+            distances : np.ndarray of size (num_queries, k), increasing
+            neighbors : np.ndarray of str (basin ids) of size (num_queries, k)
+        """
+        distances, positions = self._query(self._transform(np.atleast_2d(X)), k)
+        return distances, np.array(self.basin_ids)[positions]
+
+    def query_basins(self, basin_ids, k=10):
+        """
+        k nearest other basins of basins of the index, each basin excluded from its own neighbors
+        Returns
+        -------
+            distances, neighbors : np.ndarray of size (len(basin_ids), k)
+        """
+        positions = np.array([self._position[normalize_basin_id(basin_id)] for basin_id in basin_ids], dtype=int)
+        distances, neighbors = self._query(self._points[positions], k + 1)
+        # drop the basin itself, found at distance 0 but not necessarily first among duplicates
+        keep = neighbors != positions[:, None]
+        keep[keep.all(axis=1), -1] = False
+        distances = distances[keep].reshape(len(positions), -1)
+        neighbors = neighbors[keep].reshape(len(positions), -1)
+        return distances, np.array(self.basin_ids)[neighbors]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path+".tmp", "wb") as f:
+            pickle.dump(self, f)
+        os.replace(path+".tmp", path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def from_feature_set(cls, store, feature_set, basin_ids=None, columns=None, **kwargs):
+        """
+        Index over a feature set of a FeatureStore, e.g. "statics" or encoded_feature_set(model_id)
+        """
+        if basin_ids is None:
+            basin_ids = store.basin_ids(feature_set)
+        return cls(basin_ids, store.load(feature_set, basin_ids, columns), **kwargs)
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Nearest neighbor indexes of the basins in statics and encoded spaces")
+    parser.add_argument('--model_ids', type=str, nargs="*", default=[], help="Autoencoders whose encoded features are indexed")
+    parser.add_argument('--k', type=int, default=10, help="Neighbors of each basin")
+    parser.add_argument('--index_dir', type=str, default="knn", help="Directory of the saved indexes")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    store = FeatureStore()
+    feature_sets = ["statics"] + [encoded_feature_set(model_id) for model_id in args.model_ids]
+    for feature_set in feature_sets:
+        index = NeighborIndex.from_feature_set(store, feature_set)
+        index.save(os.path.join(args.index_dir, feature_set+".pkl"))
+        start = time.perf_counter()
+        distances, neighbors = index.query_basins(index.basin_ids, k=args.k)
+        elapsed = time.perf_counter() - start
+        print("%s: %d basins, %d features, batch query of all basins in %.1f ms"%(feature_set, len(index), index._points.shape[1], 1000*elapsed))
+        np.savetxt(os.path.join(args.index_dir, feature_set+"_neighbors.txt"), np.concatenate((np.array(index.basin_ids)[:, None], neighbors), axis=1), fmt="%s")
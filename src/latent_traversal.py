@@ -0,0 +1,149 @@
+import argparse
+import numpy as np
+
+# pytorch
+import torch
+
+# user functions
+from dataset import CamelDataset
+from registry import find_best_epoch
+from compact_checkpoints import load_model
+from feature_store import FeatureStore
+from encoding_cache import encode_basins
+
+EXCEEDANCE = (0.01, 0.1, 0.5, 0.9)
+SUMMARIES = ["mean"] + ["q"+str(int(round(100*p))) for p in EXCEEDANCE]
+
+
+def traversal_grid(enc, num_points=9, low=0.05, high=0.95):
+    """
+    Grid of each encoded dimension at the quantiles low, ..., high of its values over the basins
+    Args:
+        enc : encoded features after sigmoid, np.ndarray of size (num_basins, encoded_space_dim)
+    Returns
+    -------
+        np.ndarray of size (encoded_space_dim, num_points)
+    """
+    return np.quantile(enc, np.linspace(low, high, num_points), axis=0).T
+
+
+def flow_summaries(flow, exceedance=EXCEEDANCE):
+    """
+    Mean flow and flow duration curve at the exceedance probabilities of a batch of series
+    Args:
+        flow : tensor of size (batch_size, days)
+    Returns
+    -------
+        tensor of size (batch_size, 1 + len(exceedance))
+    """
+    q = torch.tensor([1.0 - p for p in exceedance], dtype=flow.dtype, device=flow.device)
+    fdc = torch.quantile(flow, q, dim=-1).T
+    return torch.cat((flow.mean(dim=-1, keepdim=True), fdc), dim=-1)
+
+
+def traversal_columns(grid, dims):
+    # summaries of the basin's own encoding, then their change at each point of each grid
+    columns = list(SUMMARIES)
+    for j, dim in enumerate(dims):
+        for value in grid[j]:
+            columns += ["E%d=%.3f_d%s"%(dim, value, name) for name in SUMMARIES]
+    return columns
+
+
+def latent_traversal(model, camel_dataset, grid, dims=None, indices=None, chunk_size=8, batch_size=64, skip_warmup=True,
+                     device=torch.device("cpu"), store=None, feature_set=None):
+    """
+    Decode the streamflow of each basin with its own forcing and encoding, except for one encoded dimension
+    set in turn to each value of its grid. The encoder runs once per basin; the decoder runs on the grid
+    points of all the dimensions of a chunk of chunk_size basins in batches of batch_size series.
+    The summaries (mean flow and flow duration curve, in mm/day) of each chunk are written to the feature
+    set of store as soon as they are computed.
+    Args:
+        grid : values after sigmoid, np.ndarray of size (len(dims), num_points), e.g. from traversal_grid
+        dims : encoded dimensions to traverse, default all
+        skip_warmup : summaries without the warmup days of the model
+    Returns
+    -------
+        base : summaries of the basins with their own encoding, np.ndarray of size (len(indices), len(SUMMARIES))
+        delta : change of the summaries, np.ndarray of size (len(indices), len(dims), num_points, len(SUMMARIES))
+    """
+    if dims is None:
+        dims = np.arange(model.encoded_space_dim)
+    if indices is None:
+        indices = np.arange(len(camel_dataset))
+    dims = np.asarray(dims, dtype=int)
+    indices = np.asarray(indices, dtype=int)
+    grid = np.asarray(grid, dtype=np.float32)
+    num_basins, num_points = len(indices), grid.shape[1]
+    assert grid.shape[0] == len(dims)
+    # variant 0 is the basin's own encoding, variant 1 + j*num_points + g sets dims[j] to grid[j, g]
+    num_variants = 1 + len(dims) * num_points
+    variant_dims = torch.from_numpy(np.repeat(dims, num_points)).to(device)
+    variant_values = torch.from_numpy(grid.ravel()).to(device)
+    warmup = model.warmup if skip_warmup else 0
+    flow_range = (camel_dataset.max_flow - camel_dataset.min_flow).item(), camel_dataset.min_flow.item()
+
+    base = np.zeros((num_basins, len(SUMMARIES)), dtype=np.float32)
+    delta = np.zeros((num_basins, len(dims), num_points, len(SUMMARIES)), dtype=np.float32)
+    out = None
+    if store is not None:
+        out = store.create(feature_set, [camel_dataset.basin_list[i] for i in indices], traversal_columns(grid, dims))
+    model = model.to(device).eval()
+    with torch.inference_mode():
+        for start in range(0, num_basins, chunk_size):
+            end = min(start + chunk_size, num_basins)
+            chunk = torch.from_numpy(indices[start:end])
+            B = end - start
+            x = camel_dataset.input_data[chunk].to(device)
+            y = camel_dataset.output_data[chunk].to(device)
+            latent = model.sigmoid(model.encoder(x.squeeze(dim=-1)))
+
+            latents = latent.expand(num_variants, B, -1).clone()
+            latents[torch.arange(1, num_variants, device=device)[:, None], torch.arange(B, device=device)[None, :], variant_dims[:, None]] = variant_values[:, None]
+
+            summaries = torch.zeros(num_variants * B, len(SUMMARIES), device=device)
+            for s in range(0, num_variants * B, batch_size):
+                k = torch.arange(s, min(s + batch_size, num_variants * B), device=device)
+                v, b = k // B, k % B
+                rec = model.decode(latents[v, b], y[b]).squeeze(-1).squeeze(1)
+                summaries[k] = flow_summaries(rec[:, warmup:] * flow_range[0] + flow_range[1])
+
+            summaries = summaries.view(num_variants, B, -1).cpu().numpy()
+            base[start:end] = summaries[0]
+            delta[start:end] = (summaries[1:] - summaries[0]).reshape(len(dims), num_points, B, -1).transpose(2, 0, 1, 3)
+            if out is not None:
+                out[start:end] = np.concatenate((base[start:end], delta[start:end].reshape(B, -1)), axis=1)
+    if out is not None:
+        store.finish(feature_set, out)
+    return base, delta
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Streamflow decoded while traversing each encoded dimension of autoencoders")
+    parser.add_argument('--model_ids', type=str, nargs="+", help="Autoencoders, e.g. lstm-ae-bdTrue-E4")
+    parser.add_argument('--num_points', type=int, default=9, help="Points of the grid of each dimension")
+    parser.add_argument('--chunk_size', type=int, default=8, help="Basins sharing their forcing")
+    parser.add_argument('--batch_size', type=int, default=64, help="Series per forward pass")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["prcp(mm/day)", "srad(W/m2)", "tmin(C)", "tmax(C)", "vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data()
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    store = FeatureStore()
+    for model_id in args.model_ids:
+        model = load_model(model_id, find_best_epoch(model_id))
+        enc, _ = encode_basins(model.to(device), camel_dataset, chunk_size=args.chunk_size, device=device)
+        grid = traversal_grid(enc, args.num_points)
+        base, delta = latent_traversal(model, camel_dataset, grid, chunk_size=args.chunk_size, batch_size=args.batch_size,
+                                       device=device, store=store, feature_set="traversal-"+model_id)
+        print(model_id)
+        # median over the basins of the change of mean flow across the grid of each dimension
+        for j in range(grid.shape[0]):
+            print("  E%d: mean flow change %s mm/day"%(j, np.array2string(np.median(delta[:, j, :, 0], axis=0), precision=3)))
@@ -0,0 +1,242 @@
+import datetime
+import numpy as np
+import torch
+from torch import Tensor
+
+
+ALLOWED_METRICS = ["nse", "mnse", "pfab", "kge", "bias"]
+
+
+class HydroMetrics():
+    """
+    Compute several hydrological metrics of a batch of series in one call, sharing the
+    intermediate quantities (errors, means) between them:
+        nse : Nash-Sutcliffe efficiency, equal to - NSELoss()
+        mnse : modified NSE with absolute errors, equal to - NSELoss(alpha=1)
+        pfab : absolute percent bias of the flow duration curve high segment, equal to PFAB(ex_prob)
+        kge : Kling-Gupta efficiency
+        bias : percent bias of the total volume, 100 * sum(obs - tar) / sum(tar)
+    The flow duration curve segment is taken with torch.topk instead of sorting the whole series.
+    Entries where tar is NaN (or equal to missing_value) are excluded from every metric.
+    """
+    def __init__(self, metrics=("nse", "mnse", "pfab"), ex_prob=0.01, reduction=None, missing_value=None):
+        """
+        Args:
+            metrics : names of the metrics to compute, among ALLOWED_METRICS
+            ex_prob : exceedance probability of the high flow segment of pfab
+            reduction : reduction over the basins, None, "mean" or "sum"
+            missing_value : sentinel marking missing targets, besides NaN
+        """
+        for name in metrics:
+            if name not in ALLOWED_METRICS:
+                raise Exception("Invalid metric provided. Allowed "+", ".join(ALLOWED_METRICS))
+        if reduction not in [None, "mean", "sum"]:
+            raise Exception("Invalid reduction provided. Allowed 'mean', 'sum', None")
+        self.metrics = list(metrics)
+        self.ex_prob = ex_prob
+        self.reduction = reduction
+        self.missing_value = missing_value
+
+    def _mask(self, tar):
+        mask = ~torch.isnan(tar)
+        if self.missing_value is not None:
+            mask &= tar != self.missing_value
+        # without missing values the metrics follow exactly the unmasked functions
+        return None if bool(mask.all()) else mask
+
+    def __call__(self, tar : Tensor, obs : Tensor) -> dict:
+        """
+        Arguments
+        _________
+            tar : target values, tensor of size (batch_size, seq_len) "true values"
+            obs : observed values, tensor of size (batch_size, seq_len) "simulated values"
+        Returns
+        _______
+            metrics : dict name -> tensor of size (batch_size,), or () if reduced
+        """
+        assert(tar.shape==obs.shape)
+        mask = self._mask(tar)
+        if mask is None:
+            count = tar.shape[-1]
+            def total(x):
+                return torch.sum(x, dim=-1)
+            def mean(x):
+                return torch.mean(x, dim=-1, keepdims=True)
+        else:
+            tar = torch.where(mask, tar, torch.zeros_like(tar))
+            obs = torch.where(mask, obs, torch.zeros_like(obs))
+            count = mask.sum(dim=-1)
+            def total(x):
+                return torch.sum(torch.where(mask, x, torch.zeros_like(x)), dim=-1)
+            def mean(x):
+                return (total(x) / count).unsqueeze(-1)
+
+        out = {}
+        abs_err = torch.abs(tar - obs)
+        if "nse" in self.metrics or "mnse" in self.metrics:
+            # same quirk as NSELoss, the denominator is centered on the mean of obs
+            abs_dev = torch.abs(tar - mean(obs))
+            if "nse" in self.metrics:
+                out["nse"] = 1.0 - total(abs_err**2) / total(abs_dev**2)
+            if "mnse" in self.metrics:
+                out["mnse"] = 1.0 - total(abs_err**1) / total(abs_dev**1)
+
+        if "pfab" in self.metrics:
+            out["pfab"] = self._pfab(tar, obs, mask)
+
+        if "kge" in self.metrics or "bias" in self.metrics:
+            sum_tar = total(tar)
+            sum_obs = total(obs)
+            if "bias" in self.metrics:
+                out["bias"] = 100.0 * (sum_obs - sum_tar) / sum_tar
+            if "kge" in self.metrics:
+                mean_tar = mean(tar)
+                mean_obs = mean(obs)
+                dev_tar = tar - mean_tar
+                dev_obs = obs - mean_obs
+                std_tar = torch.sqrt(total(dev_tar**2) / count)
+                std_obs = torch.sqrt(total(dev_obs**2) / count)
+                r = total(dev_tar * dev_obs) / count / (std_tar * std_obs)
+                alpha = std_obs / std_tar
+                beta = mean_obs.squeeze(-1) / mean_tar.squeeze(-1)
+                out["kge"] = 1.0 - torch.sqrt((r - 1.0)**2 + (alpha - 1.0)**2 + (beta - 1.0)**2)
+
+        for name in out:
+            if name == "pfab":
+                continue
+            if self.reduction == "mean":
+                out[name] = torch.mean(out[name])
+            elif self.reduction == "sum":
+                out[name] = torch.sum(out[name])
+        return {name: out[name] for name in self.metrics}
+
+    def _pfab(self, tar, obs, mask):
+        if mask is None:
+            high_peak_length = int(tar.shape[-1] * self.ex_prob)
+            top_tar = torch.topk(tar, high_peak_length, dim=-1).values
+            top_obs = torch.topk(obs, high_peak_length, dim=-1).values
+        else:
+            # length of the segment per basin, the masked entries are never selected
+            lengths = (mask.sum(dim=-1) * self.ex_prob).long()
+            high_peak_length = int(lengths.max())
+            low = torch.finfo(tar.dtype).min
+            top_tar = torch.topk(torch.where(mask, tar, torch.full_like(tar, low)), high_peak_length, dim=-1).values
+            top_obs = torch.topk(torch.where(mask, obs, torch.full_like(obs, low)), high_peak_length, dim=-1).values
+            keep = torch.arange(high_peak_length, device=tar.device).unsqueeze(0) < lengths.unsqueeze(-1)
+            top_tar = torch.where(keep, top_tar, torch.zeros_like(top_tar))
+            top_obs = torch.where(keep, top_obs, torch.zeros_like(top_obs))
+        num = torch.sum(top_obs - top_tar, dim=-1, keepdim=False)
+        den = torch.sum(top_obs, dim=-1, keepdim=False)
+        out = num/den
+        # as PFAB, the reduction is applied before the absolute value
+        if self.reduction == "mean":
+            out = torch.mean(out)
+        elif self.reduction == "sum":
+            out = torch.sum(out)
+        return torch.abs(out)*100
+
+
+class WindowNSE():
+    """
+    Prefix-sum index of a batch of series giving the NSE of any time window [t0, t1) in constant time.
+    Cumulative sums of tar, tar**2, obs, obs**2 and tar*obs are computed once (in float64), then the
+    numerator and denominator of the NSE of a window are differences of two prefix sums:
+        num = S(tar**2) - 2 S(tar*obs) + S(obs**2)
+        den = S(tar**2) - 2 m S(tar) + n m**2,   m = S(center)/n
+    With center="obs" the denominator is centered on the mean of obs as in NSELoss,
+    with center="tar" it is the usual NSE. NaN targets are excluded.
+    """
+    def __init__(self, tar : Tensor, obs : Tensor, center="obs"):
+        """
+        Args:
+            tar : target values, tensor of size (batch_size, seq_len) "true values"
+            obs : observed values, tensor of size (batch_size, seq_len) "simulated values"
+            center : "obs" or "tar", series whose window mean centers the denominator
+        """
+        assert(tar.shape==obs.shape)
+        if center not in ["obs", "tar"]:
+            raise Exception("Invalid center provided. Allowed 'obs', 'tar'")
+        self.center = center
+        mask = ~torch.isnan(tar)
+        tar = torch.where(mask, tar, torch.zeros_like(tar)).double()
+        obs = torch.where(mask, obs, torch.zeros_like(obs)).double()
+        def prefix(x):
+            # leading zero, so that the sum over [t0, t1) is prefix[t1] - prefix[t0]
+            return torch.nn.functional.pad(torch.cumsum(x, dim=-1), (1, 0))
+        self.count = prefix(mask.double())
+        self.tar = prefix(tar)
+        self.tar2 = prefix(tar*tar)
+        self.obs = prefix(obs)
+        self.obs2 = prefix(obs*obs)
+        self.cross = prefix(tar*obs)
+        self.batch_size, self.seq_len = tar.shape
+
+    def _window_sum(self, prefix, t0, t1):
+        return torch.gather(prefix, -1, t1) - torch.gather(prefix, -1, t0)
+
+    def numerator_denominator(self, t0, t1):
+        """
+        Arguments
+        _________
+            t0, t1 : window starts (included) and ends (excluded), of size (num_windows,) shared by all
+                     series or (batch_size, num_windows)
+        Returns
+        _______
+            num, den : float64 tensors of size (batch_size, num_windows)
+        """
+        t0 = torch.as_tensor(t0, dtype=torch.long, device=self.tar.device)
+        t1 = torch.as_tensor(t1, dtype=torch.long, device=self.tar.device)
+        t0 = t0.expand(self.batch_size, -1) if t0.dim() == 1 else t0
+        t1 = t1.expand(self.batch_size, -1) if t1.dim() == 1 else t1
+        n = self._window_sum(self.count, t0, t1)
+        s_tar = self._window_sum(self.tar, t0, t1)
+        s_tar2 = self._window_sum(self.tar2, t0, t1)
+        s_obs = self._window_sum(self.obs, t0, t1)
+        s_obs2 = self._window_sum(self.obs2, t0, t1)
+        s_cross = self._window_sum(self.cross, t0, t1)
+        num = s_tar2 - 2.0 * s_cross + s_obs2
+        m = (s_obs if self.center == "obs" else s_tar) / n
+        den = s_tar2 - 2.0 * m * s_tar + n * m * m
+        return num, den
+
+    def __call__(self, t0, t1):
+        """
+        Returns
+        _______
+            NSE of each series over each window, tensor of size (batch_size, num_windows)
+        """
+        num, den = self.numerator_denominator(t0, t1)
+        return 1.0 - num / den
+
+
+def yearly_windows(start_date, end_date, first_month=10):
+    """
+    Windows [t0, t1) of the (hydrological) years starting on day 1 of first_month,
+    for a series going from start_date to end_date included. Incomplete years are dropped.
+    Returns
+    -------
+        t0, t1 : np.ndarray of int
+        years : list of the first calendar year of each window
+    """
+    start = start_date
+    # first window begins at the first day 1 of first_month
+    year = start.year if (start.month, start.day) <= (first_month, 1) else start.year + 1
+    t0, t1, years = [], [], []
+    while True:
+        begin = datetime.date(year, first_month, 1)
+        end = datetime.date(year + 1, first_month, 1)
+        if (end - datetime.timedelta(days=1)) > end_date:
+            break
+        t0.append((begin - start).days)
+        t1.append((end - start).days)
+        years.append(year)
+        year += 1
+    return np.array(t0, dtype=int), np.array(t1, dtype=int), years
+
+
+def sliding_windows(seq_len, length=365, stride=1):
+    """
+    Windows [t0, t1) of given length every stride days
+    """
+    t0 = np.arange(0, seq_len - length + 1, stride, dtype=int)
+    return t0, t0 + length
@@ -107,6 +107,66 @@ class ConvEncoder(nn.Module):
 
         return x
 
+class TCNDecoder(nn.Module):
+
+    def __init__(self,
+                 input_size,
+                 channels = 64,
+                 kernel_size = 3,
+                 receptive_field = 365,
+                 drop_p = 0.5,
+                 act = nn.LeakyReLU,
+                ):
+        """
+        Causal dilated temporal convolution network, the output at day t depends only on days <= t.
+        It is computed in parallel over the whole sequence. Residual blocks of two convolutions with
+        dilation 1, 2, 4, ... are stacked until the receptive field covers receptive_field days
+        Args:
+            input_size : number of input features
+            channels : channels of the hidden convolutional layers
+            kernel_size : kernel size of the convolutions
+            receptive_field : minimum number of past days (including the current one) seen by each output
+            drop_p : dropout probability
+            act : activation function
+        """
+        super().__init__()
+        self.channels = channels
+        self.kernel_size = kernel_size
+
+        # each block adds 2*(kernel_size-1)*dilation days to the receptive field
+        self.dilations = []
+        self.receptive_field = 1
+        while self.receptive_field < receptive_field:
+            dilation = 2**len(self.dilations)
+            self.dilations.append(dilation)
+            self.receptive_field += 2*(kernel_size-1)*dilation
+
+        self.blocks = nn.ModuleList()
+        self.residuals = nn.ModuleList()
+        in_channels = input_size
+        for dilation in self.dilations:
+            self.blocks.append(nn.Sequential(
+                nn.ConstantPad1d(((kernel_size-1)*dilation, 0), 0.0),
+                nn.Conv1d(in_channels, channels, kernel_size, dilation=dilation),
+                act(inplace = True),
+                nn.Dropout(drop_p, inplace = False),
+                nn.ConstantPad1d(((kernel_size-1)*dilation, 0), 0.0),
+                nn.Conv1d(channels, channels, kernel_size, dilation=dilation),
+                act(inplace = True),
+                nn.Dropout(drop_p, inplace = False),
+            ))
+            # 1x1 convolution on the skip connection when the number of channels changes
+            self.residuals.append(nn.Conv1d(in_channels, channels, 1) if in_channels != channels else nn.Identity())
+            in_channels = channels
+
+    def forward(self, x):
+        # x of size (batch_size, seq_len, input_size) as the input of a batch_first LSTM
+        x = x.transpose(1, 2)
+        for block, residual in zip(self.blocks, self.residuals):
+            x = block(x) + residual(x)
+        return x.transpose(1, 2) # size (batch_size, seq_len, channels)
+
+
 class Hydro_LSTM_AE(pl.LightningModule):
     """
     Autoencoder with a convolutional encoder and a LSTM decoder
@@ -129,6 +189,10 @@ class Hydro_LSTM_AE(pl.LightningModule):
                  weight_decay = 0.0,
                  num_force_attributes = 5,
                  warmup = 45, # 2 years
+                 decoder = "lstm",
+                 tcn_channels = 64,
+                 tcn_kernel_size = 3,
+                 receptive_field = 365,
                 ):
         
         """
@@ -146,6 +210,10 @@ class Hydro_LSTM_AE(pl.LightningModule):
             act : activation function
             seq_len : length of input sequences 
             lr : learning rate
+            decoder : "lstm" or "tcn", causal temporal convolution network parallel over time
+            tcn_channels : channels of the tcn decoder
+            tcn_kernel_size : kernel size of the tcn decoder
+            receptive_field : minimum receptive field in days of the tcn decoder
         """
         
         super().__init__()
@@ -154,6 +222,7 @@ class Hydro_LSTM_AE(pl.LightningModule):
         # Parameters
         self.seq_len = seq_len
         self.lr = lr
+        self.decoder = decoder
         self.encoded_space_dim = encoded_space_dim
         self.weight_decay = weight_decay
         self.sigmoid = nn.Sigmoid()
@@ -167,21 +236,34 @@ class Hydro_LSTM_AE(pl.LightningModule):
                  drop_p=drop_p, act=act, seq_len=seq_len, linear=linear)
      
                     
-        ### LSTM decoder
-        self.lstm = nn.LSTM(input_size=encoded_space_dim+num_force_attributes, 
-                           hidden_size=lstm_hidden_units,
-                           num_layers=layers_num,
-                           dropout=drop_p,
-                           batch_first=True,
-                          bidirectional=bidirectional)
+        if decoder == "tcn":
+            ### Temporal convolution decoder
+            self.tcn = TCNDecoder(input_size=encoded_space_dim+num_force_attributes,
+                                  channels=tcn_channels,
+                                  kernel_size=tcn_kernel_size,
+                                  receptive_field=receptive_field,
+                                  drop_p=drop_p,
+                                  act=act)
+            hidden_size = tcn_channels
+        elif decoder == "lstm":
+            ### LSTM decoder
+            self.lstm = nn.LSTM(input_size=encoded_space_dim+num_force_attributes, 
+                               hidden_size=lstm_hidden_units,
+                               num_layers=layers_num,
+                               dropout=drop_p,
+                               batch_first=True,
+                              bidirectional=bidirectional)
+            if bidirectional:
+                D = 2
+            else:
+                D = 1
+            hidden_size = D * lstm_hidden_units
+        else:
+            raise Exception("Invalid decoder provided. Allowed 'lstm', 'tcn'")
         
         self.dropout = nn.Dropout(drop_p, inplace = False)
-        if bidirectional:
-            D = 2
-        else:
-            D = 1
             
-        self.out = nn.Linear(D * lstm_hidden_units, 1)
+        self.out = nn.Linear(hidden_size, 1)
 
         print("Convolutional LSTM Autoencoder initialized")
 
@@ -189,18 +271,34 @@ class Hydro_LSTM_AE(pl.LightningModule):
     def forward(self, x, y):
         # Encode data and keep track of indexes
         enc = self.encoder(x.squeeze(dim=-1))
-        enc_expanded = self.sigmoid(enc.unsqueeze(1).expand(-1, self.seq_len, -1))
+        rec = self.decode(self.sigmoid(enc), y)
+        return enc, rec
+
+    def decode(self, latent, y):
+        """
+        Decode streamflow from encoded features, without the encoder
+        Args:
+            latent : encoded features after sigmoid, size (batch_size, encoded_space_dim)
+            y : forcing of size (batch_size, 1, seq_len, force_attributes)
+        Returns
+        -------
+            rec : streamflow in [0,1] of size (batch_size, 1, seq_len, 1)
+        """
+        enc_expanded = latent.unsqueeze(1).expand(-1, self.seq_len, -1)
         # concat data
         input_lstm = torch.cat((enc_expanded, y.squeeze(1)),dim=-1) # squeeze channel dimension for input to lstm
         # Decode data
-        hidd_rec, _ = self.lstm(input_lstm)
+        if self.decoder == "tcn":
+            hidd_rec = self.tcn(input_lstm)
+        else:
+            hidd_rec, _ = self.lstm(input_lstm)
         #hidd_rec = self.dropout(hidd_rec)
         # Fully connected output layer, forced in [0,1]
         rec = self.out(hidd_rec)
         rec = self.sigmoid(rec)
         # Reinsert channel dimension
         rec = rec.unsqueeze(1)
-        return enc, rec
+        return rec
         
     def training_step(self, batch, batch_idx):        
         ### Unpack batch
@@ -331,19 +429,31 @@ class Hydro_LSTM(pl.LightningModule):
         print("LSTM initialized")
 
         
-    def forward(self, y, statics, hydro): 
-        input_lstm = y.squeeze()
-    
+    def lstm_input(self, input_lstm, statics, hydro, noise=None):
+        """
+        Append statics, hydrological signatures and noise to the forcing
+        Args:
+            input_lstm : forcing of size (batch_size, days, force_attributes), any number of days
+            statics : size (batch_size, 1, 1, 27)
+            hydro : size (batch_size, 1, 1, 13)
+            noise : size (batch_size, days, noise_dim), default drawn at random
+        """
+        batch_size, days = input_lstm.shape[0], input_lstm.shape[1]
+
         # Append statics/hydro
         if self.statics:
-            input_lstm = torch.cat((input_lstm, statics.squeeze(1).repeat(1,self.seq_len,1)),dim=-1)
+            input_lstm = torch.cat((input_lstm, statics.squeeze(1).repeat(1,days,1)),dim=-1)
         if self.hydro:
-            input_lstm = torch.cat((input_lstm, hydro.squeeze(1).repeat(1,self.seq_len,1)),dim=-1)
+            input_lstm = torch.cat((input_lstm, hydro.squeeze(1).repeat(1,days,1)),dim=-1)
         
         # append noise
-        batch_size = input_lstm.shape[0] # size (batch_size, seq_len, force_attributes)
-        noise = self.sigmoid(torch.randn(size=(batch_size, self.seq_len, self.noise_dim), device=self.device))
+        if noise is None:
+            noise = self.sigmoid(torch.randn(size=(batch_size, days, self.noise_dim), device=self.device))
         input_lstm = torch.cat((input_lstm, noise),dim=-1)
+        return input_lstm
+
+    def forward(self, y, statics, hydro): 
+        input_lstm = self.lstm_input(y.squeeze(1), statics, hydro)
        
         #print("input_lstm shape: ", input_lstm.shape)
         hidd_rec, _ = self.lstm(input_lstm)
@@ -355,6 +465,23 @@ class Hydro_LSTM(pl.LightningModule):
         # Reinsert channel dimension
         rec = rec.unsqueeze(1)
         return rec
+
+    def step(self, y, statics, hydro, state=None):
+        """
+        Advance the LSTM from state by the days of y, only for unidirectional models
+        Args:
+            y : forcing of size (batch_size, days, force_attributes)
+            state : (h, c) of the LSTM, each of size (layers_num, batch_size, lstm_hidden_units), None for zeros
+        Returns
+        -------
+            rec : streamflow in [0,1] of size (batch_size, days)
+            state : (h, c) after the last day
+        """
+        if self.lstm.bidirectional:
+            raise Exception("Stateful steps need a unidirectional LSTM")
+        hidd_rec, state = self.lstm(self.lstm_input(y, statics, hydro), state)
+        rec = self.sigmoid(self.out(hidd_rec)).squeeze(-1)
+        return rec, state
         
     def training_step(self, batch, batch_idx):        
         ### Unpack batch
@@ -414,3 +541,197 @@ class Hydro_LSTM(pl.LightningModule):
         return optimizer #{"optimizer":optimizer, "lr_scheduler":lr_scheduler}
 
 
+
+
+
+class Hydro_LSTM_Ensemble(pl.LightningModule):
+    """
+    K independently initialized Hydro_LSTM trained in one forward/backward.
+    The LSTM parameters of the members are stacked along a first dimension of size K, e.g. weight_ih_l0 of
+    size (K, 4*lstm_hidden_units, input_size), and all the members advance together with batched matrix
+    products, so a step of the ensemble costs K steps of one member.
+    Every member draws its own noise, as if it were trained alone with its seed.
+    """
+    def __init__(self,
+                 num_members = 4,
+                 seeds = None,
+                 lstm_hidden_units = 100, 
+                 bidirectional = False,
+                 layers_num = 2,
+                 act = nn.LeakyReLU, 
+                 loss_fn = nn.MSELoss(),
+                 drop_p = 0.5, 
+                 seq_len = 100,
+                 lr = 1e-4,
+                 weight_decay = 0.0,
+                 num_force_attributes = 5,
+                 noise_dim = 0,
+                 statics = False,
+                 hydro = False,
+                 warmup = 45,
+                ):
+        
+        """
+        Args:
+            num_members : number of ensemble members K
+            seeds : list of K seeds used to initialize the members, default 0,...,K-1
+            others : as in Hydro_LSTM
+        """
+        
+        super().__init__()
+        self.save_hyperparameters(ignore=['loss_fn']) # save hyperparameters for chekpoints
+        if seeds is None:
+            seeds = list(range(num_members))
+        assert len(seeds) == num_members
+        
+        # Parameters
+        self.num_members = num_members
+        self.seeds = seeds
+        self.hidden = lstm_hidden_units
+        self.layers_num = layers_num
+        self.seq_len = seq_len
+        self.lr = lr
+        self.weight_decay = weight_decay
+        self.sigmoid = nn.Sigmoid()
+        self.loss_fn = loss_fn
+        self.num_force_attributes = num_force_attributes 
+        self.noise_dim = noise_dim
+        self.statics = statics
+        self.hydro = hydro
+        self.warmup = warmup
+        self.D = 2 if bidirectional else 1
+        self.member_kwargs = dict(lstm_hidden_units=lstm_hidden_units, bidirectional=bidirectional, layers_num=layers_num,
+                        act=act, drop_p=drop_p, seq_len=seq_len, lr=lr, weight_decay=weight_decay,
+                        num_force_attributes=num_force_attributes, noise_dim=noise_dim, statics=statics, hydro=hydro, warmup=warmup)
+
+        # initialize members with their own seed
+        members = []
+        rng_state = torch.get_rng_state()
+        for seed in seeds:
+            torch.manual_seed(seed)
+            members.append(Hydro_LSTM(loss_fn=loss_fn, **self.member_kwargs))
+        torch.set_rng_state(rng_state)
+        
+        ### stacked LSTM decoder, parameters named as in nn.LSTM
+        self.lstm = nn.ParameterDict({name: nn.Parameter(torch.stack([getattr(member.lstm, name).detach() for member in members]))
+                                      for name, _ in members[0].lstm.named_parameters()})
+        # dropout between LSTM layers, as nn.LSTM
+        self.dropout = nn.Dropout(drop_p, inplace = False)
+        # one output head per member
+        self.out_weight = nn.Parameter(torch.stack([member.out.weight.detach().squeeze(0) for member in members]))
+        self.out_bias = nn.Parameter(torch.stack([member.out.bias.detach().squeeze(0) for member in members]))
+
+        print("LSTM ensemble of %d members initialized"%num_members)
+
+    # forcing, statics, hydrological signatures and noise as in Hydro_LSTM
+    lstm_input = Hydro_LSTM.lstm_input
+
+    def load_members(self, members):
+        """
+        Copy the weights of K Hydro_LSTM into the stacked ensemble
+        """
+        assert len(members) == self.num_members
+        with torch.no_grad():
+            for name, param in self.lstm.items():
+                param.copy_(torch.stack([getattr(member.lstm, name) for member in members]))
+            for k, member in enumerate(members):
+                self.out_weight[k] = member.out.weight.squeeze(0)
+                self.out_bias[k] = member.out.bias.squeeze(0)
+
+    def member(self, k):
+        """
+        Return member k as a standalone Hydro_LSTM
+        """
+        model = Hydro_LSTM(loss_fn=self.loss_fn, **self.member_kwargs)
+        with torch.no_grad():
+            for name, param in model.lstm.named_parameters():
+                param.copy_(self.lstm[name][k])
+            model.out.weight.copy_(self.out_weight[k].unsqueeze(0))
+            model.out.bias.copy_(self.out_bias[k].unsqueeze(0))
+        return model
+
+    def run_lstm(self, input_lstm):
+        """
+        Run the LSTM of every member on its own input
+        Args:
+            input_lstm : size (K, batch_size, days, input_size)
+        Returns
+        -------
+            hidden states of the last layer, size (K, batch_size, days, D*lstm_hidden_units)
+        """
+        K, batch_size, days, _ = input_lstm.shape
+        H = self.hidden
+        hidd = input_lstm
+        for layer in range(self.layers_num):
+            outputs = []
+            for suffix in ["", "_reverse"][:self.D]:
+                name = "_l"+str(layer)+suffix
+                weight_hh = self.lstm["weight_hh"+name].transpose(1, 2)
+                bias = self.lstm["bias_ih"+name] + self.lstm["bias_hh"+name]
+                # input contribution to the gates of all the days in one product, size (K, batch_size, days, 4*H)
+                gates_in = torch.bmm(hidd.reshape(K, batch_size * days, -1), self.lstm["weight_ih"+name].transpose(1, 2))
+                # unbind, so that the backward does not build a full size gradient for every day
+                gates_in = (gates_in.view(K, batch_size, days, 4 * H) + bias[:, None, None, :]).unbind(dim=2)
+                h = hidd.new_zeros(K, batch_size, H)
+                c = hidd.new_zeros(K, batch_size, H)
+                states = [None] * days
+                for t in (range(days - 1, -1, -1) if suffix else range(days)):
+                    # gates in the order of nn.LSTM: input, forget, cell, output
+                    i, f, g, o = torch.baddbmm(gates_in[t], h, weight_hh).chunk(4, dim=-1)
+                    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+                    h = torch.sigmoid(o) * torch.tanh(c)
+                    states[t] = h
+                outputs.append(torch.stack(states, dim=2))
+            hidd = torch.cat(outputs, dim=-1)
+            if layer < self.layers_num - 1:
+                hidd = self.dropout(hidd)
+        return hidd
+
+    def forward(self, y, statics, hydro): 
+        K, batch_size = self.num_members, y.shape[0]
+        # the batch is repeated for every member, so that each one draws its own noise
+        input_lstm = self.lstm_input(y.squeeze(1).repeat(K, 1, 1), statics.repeat(K, 1, 1, 1), hydro.repeat(K, 1, 1, 1))
+        hidd_rec = self.run_lstm(input_lstm.view(K, batch_size, -1, input_lstm.shape[-1])) # size (K, batch_size, days, D*hidden)
+        # Fully connected output layer of each member, forced in [0,1]
+        rec = torch.einsum("kbtj,kj->kbt", hidd_rec, self.out_weight) + self.out_bias[:, None, None]
+        rec = self.sigmoid(rec)
+        # Reinsert channel dimension, size (K, batch_size, 1, days, 1)
+        rec = rec.unsqueeze(2).unsqueeze(-1)
+        return rec
+
+    def members_loss(self, x, rec):
+        """
+        Loss of each member, tensor of size (K,)
+        """
+        x = x.squeeze(1).squeeze(-1)
+        return torch.stack([self.loss_fn(x[:,self.warmup:], rec[k].squeeze(1).squeeze(-1)[:,self.warmup:]) for k in range(self.num_members)])
+        
+    def training_step(self, batch, batch_idx):        
+        ### Unpack batch
+        x, y, statics, hydro = batch
+        # forward pass
+        rec = self.forward(y, statics, hydro)
+        # members have disjoint parameters, the sum trains each one on its own loss
+        losses = self.members_loss(x, rec)
+        train_loss = torch.sum(losses)
+        self.log("train_loss", train_loss / self.num_members, prog_bar=True)
+        for k in range(self.num_members):
+            self.log("train_loss_"+str(k), losses[k])
+        return train_loss
+    
+    def validation_step(self, batch, batch_idx):
+        ### Unpack batch
+        x, y, statics, hydro = batch
+        # forward pass
+        rec = self.forward(y, statics, hydro)
+        losses = self.members_loss(x, rec)
+        val_loss = torch.mean(losses)
+        self.log("val_loss", val_loss, prog_bar=True)
+        for k in range(self.num_members):
+            self.log("val_loss_"+str(k), losses[k])
+        self.log("epoch_num", float(self.current_epoch),prog_bar=True)
+        return val_loss
+    
+    def configure_optimizers(self):
+        optimizer = optim.Adam(self.parameters(), lr = self.lr, weight_decay = self.weight_decay)
+        return optimizer
@@ -0,0 +1,148 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+# pytorch
+import torch
+
+# user functions
+from dataset import CamelDataset
+from registry import find_best_epoch
+from metrics import HydroMetrics
+from compact_checkpoints import load_model
+from bootstrap import bootstrap_statistic, bootstrap_quantiles
+
+
+def permutations(num_basins, num_attributes, num_repeats=5, seed=42):
+    """
+    Independent permutations of the basins for every repeat and attribute
+    Returns
+    -------
+        np.ndarray of int of size (num_repeats, num_attributes, num_basins)
+    """
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(np.arange(num_basins), (num_repeats, num_attributes, 1)), axis=-1)
+
+
+def permutation_importance(model, camel_dataset, attributes=None, num_repeats=5, indices=None, chunk_size=8, batch_size=64,
+                           seed=42, device=torch.device("cpu")):
+    """
+    NSE of a Hydro_LSTM with statics when one static attribute at a time is permuted among the basins indices.
+    Only the inputs are shared: the forcing, hydrological signatures and noise of a chunk of chunk_size basins
+    are moved to the device and drawn once, then indexed by its baseline and all its permuted variants.
+    The LSTM is not shared, every variant runs its own full pass over the series (statics change the state from
+    the first day), in batches of batch_size series so that the variants fill the batches of the fused LSTM.
+    Args:
+        attributes : positions of the static attributes to permute, default all
+        num_repeats : permutations of each attribute
+    Returns
+    -------
+        baseline : NSE with the true statics, np.ndarray of size (len(indices),)
+        delta : baseline minus the NSE with the permuted attribute, np.ndarray of size (len(indices), num_repeats, len(attributes))
+    """
+    if not model.statics:
+        raise Exception("The model does not use the statics")
+    if indices is None:
+        indices = np.arange(len(camel_dataset))
+    indices = np.asarray(indices, dtype=int)
+    statics = camel_dataset.statics_data[torch.from_numpy(indices)].reshape(len(indices), -1)
+    if attributes is None:
+        attributes = np.arange(statics.shape[1])
+    attributes = np.asarray(attributes, dtype=int)
+    num_basins, num_attributes = len(indices), len(attributes)
+    perms = torch.from_numpy(permutations(num_basins, num_attributes, num_repeats, seed))
+    # variant 0 is the baseline, variant 1 + r*num_attributes + a permutes attributes[a] in repeat r
+    num_variants = 1 + num_repeats * num_attributes
+
+    hydro_metrics = HydroMetrics(["nse"], reduction=None)
+    baseline = np.zeros(num_basins, dtype=np.float32)
+    delta = np.zeros((num_basins, num_repeats, num_attributes), dtype=np.float32)
+    model = model.to(device).eval()
+    # same noise for the baseline and the variants
+    torch.manual_seed(seed)
+    with torch.inference_mode():
+        for start in range(0, num_basins, chunk_size):
+            end = min(start + chunk_size, num_basins)
+            chunk = torch.from_numpy(indices[start:end])
+            B = end - start
+            x = camel_dataset.input_data[chunk].to(device).squeeze(-1).squeeze(1)
+            y = camel_dataset.output_data[chunk].to(device).squeeze(1)
+            hydro = camel_dataset.hydro_data[chunk].to(device)
+            days = y.shape[1]
+            noise = model.sigmoid(torch.randn(size=(B, days, model.noise_dim), device=device))
+
+            S = statics[start:end].expand(num_variants, B, -1).clone()
+            permuted = S[1:].view(num_repeats, num_attributes, B, -1)
+            for i, a in enumerate(attributes):
+                permuted[:, i, :, a] = statics[perms[:, i, start:end], a]
+            S = S.to(device)
+
+            nse = torch.zeros(num_variants * B, device=device)
+            for s in range(0, num_variants * B, batch_size):
+                k = torch.arange(s, min(s + batch_size, num_variants * B), device=device)
+                v, b = k // B, k % B
+                input_lstm = model.lstm_input(y[b], S[v, b].view(len(k), 1, 1, -1), hydro[b], noise[b])
+                hidd_rec, _ = model.lstm(input_lstm)
+                rec = model.sigmoid(model.out(hidd_rec)).squeeze(-1)
+                nse[k] = hydro_metrics(x[b], rec)["nse"]
+
+            nse = nse.view(num_variants, B).cpu().numpy()
+            baseline[start:end] = nse[0]
+            delta[start:end] = (nse[0] - nse[1:]).reshape(num_repeats, num_attributes, B).transpose(2, 0, 1)
+    return baseline, delta
+
+
+def importance_table(delta, attributes, num_resamples=2000, confidence=0.95, seed=42):
+    """
+    Mean and median over the basins of the NSE drop of each attribute, averaged over the repeats,
+    with percentile bootstrap confidence intervals over the basins
+    Args:
+        delta : np.ndarray of size (num_basins, num_repeats, num_attributes) from permutation_importance
+        attributes : names of the permuted attributes
+    Returns
+    -------
+        pd.DataFrame with one row per attribute, sorted by decreasing mean NSE drop
+    """
+    per_basin = delta.mean(axis=1)
+    alpha = (1.0 - confidence) / 2.0
+    resampled = bootstrap_statistic(per_basin, lambda x: x.mean(axis=1), num_resamples, seed)
+    low, high = np.quantile(resampled, [alpha, 1.0 - alpha], axis=0)
+    median, median_low, median_high = bootstrap_quantiles(per_basin, (0.5,), num_resamples, confidence, seed)
+    table = pd.DataFrame({"delta_nse": per_basin.mean(axis=0), "delta_nse_low": low, "delta_nse_high": high,
+                          "delta_nse_median": median[0], "delta_nse_median_low": median_low[0], "delta_nse_median_high": median_high[0],
+                          # spread of the mean over the permutations
+                          "delta_nse_repeats_std": delta.mean(axis=0).std(axis=0)},
+                         index=list(attributes))
+    return table.sort_values("delta_nse", ascending=False)
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Permutation importance of the static attributes of a Hydro_LSTM trained with statics")
+    parser.add_argument('--model_id', type=str, required=True, help="Model trained with statics")
+    parser.add_argument('--epoch', type=int, default=None, help="Epoch of the checkpoint, default the best one")
+    parser.add_argument('--num_repeats', type=int, default=5, help="Permutations of each attribute")
+    parser.add_argument('--chunk_size', type=int, default=8, help="Basins sharing their forcing")
+    parser.add_argument('--batch_size', type=int, default=64, help="Series per forward pass")
+    parser.add_argument('--num_resamples', type=int, default=2000, help="Bootstrap resamples of the confidence intervals")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["prcp(mm/day)", "srad(W/m2)", "tmin(C)", "tmax(C)", "vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data()
+    camel_dataset.load_statics()
+    camel_dataset.load_hydro()
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    epoch = args.epoch if args.epoch is not None else find_best_epoch(args.model_id)
+    model = load_model(args.model_id, epoch)
+    baseline, delta = permutation_importance(model, camel_dataset, num_repeats=args.num_repeats, chunk_size=args.chunk_size,
+                                             batch_size=args.batch_size, device=device)
+    print("Baseline median NSE: %.3f"%np.median(baseline))
+    table = importance_table(delta, camel_dataset.df_statics.columns, num_resamples=args.num_resamples)
+    table.to_csv("plot/permutation_importance_"+args.model_id+".csv", sep=" ")
+    print(table)
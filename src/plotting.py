@@ -0,0 +1,164 @@
+import os
+import json
+import pickle
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+
+# user functions
+from regression import batch_linregress
+
+
+BASEMAP_FILE = "plot/usa_basemap.pkl"
+INDEX_FILE = "plot/figures_index.json"
+
+
+@functools.lru_cache(maxsize=None)
+def usa_basemap(cache_file=BASEMAP_FILE):
+    """
+    Exterior rings of the USA polygons of naturalearth_lowres, as arrays of (lon, lat) points.
+    geopandas is only needed the first time, the rings are then read from cache_file.
+    """
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    import geopandas as gpd
+    countries = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
+    geometry = countries[countries["name"] == "United States of America"].geometry.iloc[0]
+    polygons = geometry.geoms if hasattr(geometry, "geoms") else [geometry]
+    rings = [np.array(polygon.exterior.coords) for polygon in polygons]
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    with open(cache_file+".tmp", "wb") as f:
+        pickle.dump(rings, f)
+    os.replace(cache_file+".tmp", cache_file)
+    return rings
+
+
+def draw_basemap(ax, rings):
+    for ring in rings:
+        ax.fill(ring[:, 0], ring[:, 1], color="lightgrey")
+    ax.set_xlim(-128, -65)
+    ax.set_ylim(24, 50)
+    ax.set_axis_off()
+
+
+def plot_map(save_file, lat, lon, values, titles, nrows=1, ncols=1, figsize=(8,8), fontsize=None):
+    """
+    Scatter of values over the USA map, one panel per row of values
+    Args:
+        values : np.ndarray of size (num_panels, num_basins)
+        titles : title of each panel
+    """
+    import matplotlib.pyplot as plt
+    rings = usa_basemap()
+    fig, axes = plt.subplots(nrows, ncols, figsize=figsize, sharex=True, sharey=True, squeeze=False)
+    for f, (value, title) in enumerate(zip(values, titles)):
+        ax = axes[f // ncols, f % ncols]
+        ax.set_title(title, fontsize=fontsize)
+        draw_basemap(ax, rings)
+        im = ax.scatter(x=lon, y=lat, c=value, cmap="YlOrRd", s=1)
+        fig.colorbar(im, ax=ax, fraction=0.028, pad=0.02, location="bottom")
+    fig.savefig(save_file)
+    plt.close(fig)
+
+
+def plot_correlation_grid(save_file, attributes, columns, y, nrows, ncols, xlabel, ylabel, figsize=(24,20)):
+    """
+    Scatter of y against each attribute with its linear regression, one panel per attribute
+    Args:
+        attributes : np.ndarray of size (num_basins, num_attributes)
+        columns : names of the attributes
+    """
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(nrows, ncols, figsize=figsize, sharex=True, sharey=True)
+    # regressions of all the panels at once
+    res = batch_linregress(attributes, y)
+    for i in range(nrows):
+        for j in range(ncols):
+            c = i*ncols + j
+            ax = axes[i,j]
+            ax.set_title(columns[c])
+            x = attributes[:,c]
+            ax.scatter(x, y, s=10)
+            ax.plot(x, res["intercept"][0,c] + res["slope"][0,c]*x, 'r', label="Rvalue: "+ str(round(res["rvalue"][0,c],3)))
+            ax.legend()
+    fig.text(0.5, 0.04, xlabel, ha='center', fontsize=50)
+    fig.text(0.04, 0.5, ylabel, va='center', rotation='vertical', fontsize=50)
+    fig.savefig(save_file)
+    plt.close(fig)
+
+
+FIGURES = {"map": plot_map, "correlation_grid": plot_correlation_grid}
+
+
+def _figure_hash(kind, kwargs):
+    h = hashlib.sha1(kind.encode())
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        h.update(key.encode())
+        if isinstance(value, np.ndarray):
+            h.update(str((value.dtype, value.shape)).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def _render(job):
+    kind, kwargs = job
+    FIGURES[kind](**kwargs)
+    return kwargs["save_file"]
+
+
+def render_figures(jobs, num_workers=None, index_file=INDEX_FILE):
+    """
+    Render figures in a pool of processes with the Agg backend. A figure is skipped if its file exists
+    and the hash of its inputs is the one recorded in index_file when it was last rendered.
+    Args:
+        jobs : list of (kind, kwargs), kind among FIGURES and kwargs its arguments, save_file included
+        num_workers : processes, default min(number of figures to render, num_cpus)
+    Returns
+    -------
+        list of the rendered files
+    """
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    todo = []
+    hashes = {}
+    for kind, kwargs in jobs:
+        save_file = kwargs["save_file"]
+        hashes[save_file] = _figure_hash(kind, kwargs)
+        if os.path.exists(save_file) and index.get(save_file) == hashes[save_file]:
+            continue
+        todo.append((kind, kwargs))
+    if not todo:
+        return []
+
+    # basemap cached before starting the workers
+    if any(kind == "map" for kind, _ in todo):
+        usa_basemap()
+    if num_workers is None:
+        num_workers = min(len(todo), multiprocessing.cpu_count())
+    if num_workers <= 1:
+        _init_worker()
+        rendered = [_render(job) for job in todo]
+    else:
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker) as executor:
+            rendered = list(executor.map(_render, todo))
+
+    for save_file in rendered:
+        index[save_file] = hashes[save_file]
+    os.makedirs(os.path.dirname(index_file) or ".", exist_ok=True)
+    with open(index_file+".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_file+".tmp", index_file)
+    return rendered
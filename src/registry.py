@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import numpy as np
+import torch
+from pytorch_lightning import Callback
+from pytorch_lightning.callbacks import ModelCheckpoint
+
+# user functions
+from utils import read_metrics, load_metrics, metrics_path, EnsembleCheckpoint
+
+
+# hyperparameters indexed as columns, the others are kept in the json of the run
+INDEXED_HPARAMS = ["bidirectional", "statics", "hydro", "noise_dim", "encoded_space_dim"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    model_id TEXT PRIMARY KEY,
+    model_type TEXT,
+    dirpath TEXT,
+    hparams TEXT,
+    bidirectional INTEGER,
+    statics INTEGER,
+    hydro INTEGER,
+    noise_dim INTEGER,
+    encoded_space_dim INTEGER,
+    best_epoch INTEGER,
+    best_val_loss REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    model_id TEXT,
+    epoch INTEGER,
+    val_loss REAL,
+    train_loss REAL,
+    PRIMARY KEY (model_id, epoch)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    model_id TEXT,
+    epoch INTEGER,
+    path TEXT,
+    PRIMARY KEY (model_id, path)
+);
+CREATE INDEX IF NOT EXISTS runs_best ON runs (best_val_loss);
+"""
+
+
+def _to_json(value):
+    # activation functions and other classes are stored by name
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return getattr(value, "__name__", str(value))
+
+
+class RunRegistry:
+    """
+    SQLite index of the training runs in a checkpoint folder.
+    It keeps hyperparameters, per-epoch metrics, best epoch and checkpoint paths of every model id,
+    so that cross-model queries do not need to load metrics or checkpoints.
+    """
+    def __init__(self, path="checkpoints/registry.db"):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        # runs of a sweep write concurrently, wait for the lock instead of failing
+        return sqlite3.connect(self.path, timeout=60)
+
+    def register_run(self, model_id, model_type, hparams, dirpath):
+        """
+        Insert or update a run with its hyperparameters
+        """
+        hparams = {key: _to_json(value) for key, value in dict(hparams).items()}
+        indexed = [int(hparams[key]) if hparams.get(key) is not None else None for key in INDEXED_HPARAMS]
+        with self._connect() as con:
+            con.execute("INSERT INTO runs (model_id, model_type, dirpath, hparams, "+", ".join(INDEXED_HPARAMS)+", updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(model_id) DO UPDATE SET model_type=excluded.model_type, dirpath=excluded.dirpath, "
+                        "hparams=excluded.hparams, "+", ".join(key+"=excluded."+key for key in INDEXED_HPARAMS)+", updated=excluded.updated",
+                        [model_id, model_type, dirpath, json.dumps(hparams)] + indexed + [time.time()])
+
+    def add_metrics(self, model_id, epochs, val_loss, train_loss=None):
+        """
+        Add per-epoch metrics of a run (arrays or scalars) and update its best epoch
+        """
+        epochs = np.atleast_1d(epochs).astype(int)
+        val_loss = np.atleast_1d(val_loss).astype(float)
+        train_loss = np.full(len(epochs), np.nan) if train_loss is None else np.atleast_1d(train_loss).astype(float)
+        rows = [(model_id, int(e), float(v), None if np.isnan(t) else float(t)) for e, v, t in zip(epochs, val_loss, train_loss)]
+        with self._connect() as con:
+            con.executemany("INSERT OR REPLACE INTO metrics (model_id, epoch, val_loss, train_loss) VALUES (?, ?, ?, ?)", rows)
+            con.execute("UPDATE runs SET best_epoch=(SELECT epoch FROM metrics WHERE model_id=? ORDER BY val_loss ASC, epoch ASC LIMIT 1), "
+                        "best_val_loss=(SELECT MIN(val_loss) FROM metrics WHERE model_id=?), updated=? WHERE model_id=?",
+                        (model_id, model_id, time.time(), model_id))
+
+    def is_stale(self, model_id, checkpoint_dir="checkpoints"):
+        """
+        True if the run is missing from the registry or its metrics were written after its last update,
+        e.g. by a run resumed without RegistryCallback
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT best_epoch, updated FROM runs WHERE model_id=?", (model_id,)).fetchone()
+        if row is None or row[0] is None:
+            return True
+        path = metrics_path(model_id, checkpoint_dir)
+        return os.path.exists(path) and os.path.getmtime(path) > row[1]
+
+    def set_checkpoints(self, model_id, paths):
+        """
+        Index the model-epoch=XX.ckpt files of paths as the checkpoints of a run, forget the others
+        """
+        rows = []
+        for path in paths:
+            match = re.match(r"model-epoch=(\d+)\.ckpt$", os.path.basename(path))
+            if match:
+                rows.append((model_id, int(match.group(1)), path))
+        with self._connect() as con:
+            con.execute("DELETE FROM checkpoints WHERE model_id=?", (model_id,))
+            con.executemany("INSERT INTO checkpoints (model_id, epoch, path) VALUES (?, ?, ?)", rows)
+
+    def sync_checkpoints(self, model_id, dirpath):
+        """
+        Index the model-epoch=XX.ckpt files present in dirpath, forget the deleted ones
+        """
+        self.set_checkpoints(model_id, [os.path.join(dirpath, filename) for filename in os.listdir(dirpath)])
+
+    def index_run(self, model_id, checkpoint_dir="checkpoints"):
+        """
+        Index an existing run from its metrics and checkpoint files
+        """
+        dirpath = os.path.join(checkpoint_dir, model_id)
+        path = metrics_path(model_id, checkpoint_dir)
+        train_loss = None
+        if path.endswith(".pt"):
+            epochs, val_loss = load_metrics(path)
+        else:
+            epochs, metrics = read_metrics(path)
+            val_loss = metrics["val_loss"]
+            train_loss = metrics.get("train_loss")
+        hparams = {}
+        ckpts = sorted(f for f in os.listdir(dirpath) if f.endswith(".ckpt"))
+        if ckpts:
+            checkpoint = torch.load(os.path.join(dirpath, ckpts[0]), map_location=torch.device('cpu'))
+            hparams = checkpoint.get("hyper_parameters", {})
+        model_type = "lstm-ae" if "encoded_space_dim" in hparams or model_id.find("lstm-ae") != -1 else "lstm"
+        self.register_run(model_id, model_type, hparams, dirpath)
+        self.add_metrics(model_id, epochs, val_loss, train_loss)
+        self.sync_checkpoints(model_id, dirpath)
+
+    def index_all(self, checkpoint_dir="checkpoints"):
+        """
+        Index every run folder of checkpoint_dir having metrics
+        """
+        model_ids = []
+        for model_id in sorted(os.listdir(checkpoint_dir)):
+            if os.path.isdir(os.path.join(checkpoint_dir, model_id)) and os.path.exists(metrics_path(model_id, checkpoint_dir)):
+                self.index_run(model_id, checkpoint_dir)
+                model_ids.append(model_id)
+        return model_ids
+
+    def best_models(self, k=5, model_type=None, **filters):
+        """
+        Best k runs by validation NSE, e.g. best_models(5, statics=True)
+        Returns
+        -------
+            list of (model_id, best_epoch, val_nse)
+        """
+        where = ["best_val_loss IS NOT NULL"]
+        values = []
+        if model_type is not None:
+            where.append("model_type=?")
+            values.append(model_type)
+        for key, value in filters.items():
+            if key not in INDEXED_HPARAMS:
+                raise Exception("Invalid filter provided. Allowed "+", ".join(INDEXED_HPARAMS))
+            where.append(key+"=?")
+            values.append(int(value))
+        with self._connect() as con:
+            rows = con.execute("SELECT model_id, best_epoch, -best_val_loss FROM runs WHERE "+" AND ".join(where)+
+                               " ORDER BY best_val_loss ASC LIMIT ?", values+[k]).fetchall()
+        return rows
+
+    def model_ids(self, model_type=None):
+        with self._connect() as con:
+            if model_type is None:
+                rows = con.execute("SELECT model_id FROM runs ORDER BY model_id").fetchall()
+            else:
+                rows = con.execute("SELECT model_id FROM runs WHERE model_type=? ORDER BY model_id", (model_type,)).fetchall()
+        return [row[0] for row in rows]
+
+    def best_epoch(self, model_id):
+        with self._connect() as con:
+            row = con.execute("SELECT best_epoch FROM runs WHERE model_id=?", (model_id,)).fetchone()
+        if row is None or row[0] is None:
+            raise Exception("Run "+model_id+" has no validation metrics in the registry")
+        return int(row[0])
+
+    def checkpoint_path(self, model_id, epoch=None):
+        """
+        Path of the checkpoint of a run at epoch, default its best epoch
+        """
+        if epoch is None:
+            epoch = self.best_epoch(model_id)
+        with self._connect() as con:
+            row = con.execute("SELECT path FROM checkpoints WHERE model_id=? AND epoch=?", (model_id, epoch)).fetchone()
+        if row is None:
+            raise Exception("No checkpoint of "+model_id+" at epoch "+str(epoch))
+        return row[0]
+
+    def metrics(self, model_id):
+        """
+        Returns
+        -------
+            epochs, val_loss, train_loss : np.ndarray sorted by epoch
+        """
+        with self._connect() as con:
+            rows = con.execute("SELECT epoch, val_loss, train_loss FROM metrics WHERE model_id=? ORDER BY epoch", (model_id,)).fetchall()
+        data = np.array(rows, dtype=float).reshape(-1, 3)
+        return data[:,0].astype(int), data[:,1], data[:,2]
+
+
+def find_best_epoch(model_id, checkpoint_dir="checkpoints"):
+    """
+    Find the epoch at which the validation error is minimized, or quivalently
+    when thevalidation NSE is maximized. It is read from the registry of checkpoint_dir if there is one,
+    after indexing the run again if its metrics are newer, else from the metrics of the run
+    Returns
+    -------
+        best_epoch : (int)
+    """
+    path = os.path.join(checkpoint_dir, "registry.db")
+    if not os.path.exists(path):
+        epochs, val_loss = load_metrics(metrics_path(model_id, checkpoint_dir))
+        return int(epochs[np.argmin(val_loss)])
+    registry = RunRegistry(path)
+    if registry.is_stale(model_id, checkpoint_dir):
+        registry.index_run(model_id, checkpoint_dir)
+    return registry.best_epoch(model_id)
+
+
+def best_model_ids(checkpoint_dir="checkpoints", num_lstm_ae=3, num_lstm=2):
+    """
+    Best autoencoders and best lstm of checkpoint_dir by validation NSE, after indexing all its runs
+    """
+    registry = RunRegistry(os.path.join(checkpoint_dir, "registry.db"))
+    registry.index_all(checkpoint_dir)
+    model_ids = [row[0] for row in registry.best_models(num_lstm_ae, model_type="lstm-ae") + registry.best_models(num_lstm, model_type="lstm")]
+    if not model_ids:
+        raise Exception("No run with validation metrics found in "+checkpoint_dir)
+    return model_ids
+
+
+class RegistryCallback(Callback):
+    """
+    PyTorch Lightning callback keeping a run up to date in the RunRegistry.
+    The members of a Hydro_LSTM_Ensemble are registered as the runs of their EnsembleCheckpoint folders.
+    Lightning runs ModelCheckpoint last in on_validation_end, so checkpoints are indexed at the end of the epoch,
+    from the top-k kept by the checkpoint callbacks and only when it changed. The files are indexed once more
+    in on_fit_end, which Lightning calls after the teardown of the checkpoint IO plugin has flushed the
+    pending (asynchronous) writes.
+    """
+    def __init__(self, registry, model_id, dirpath, model_type):
+        super().__init__()
+        self.registry = registry
+        self.model_id = model_id
+        self.dirpath = dirpath
+        self.model_type = model_type
+        self.indexed = {}
+
+    def _runs(self, trainer, pl_module):
+        # (model_id, dirpath, checkpoint paths kept by the callbacks) of the run and of the ensemble members
+        runs = []
+        for callback in trainer.callbacks:
+            if isinstance(callback, ModelCheckpoint) and os.path.normpath(str(callback.dirpath)) == os.path.normpath(self.dirpath):
+                runs.append((self.model_id, self.dirpath, set(callback.best_k_models)))
+            elif isinstance(callback, EnsembleCheckpoint):
+                for k in range(pl_module.num_members):
+                    dirpath = callback.member_dirpath(k)
+                    runs.append((os.path.basename(dirpath), dirpath, set(path for _, path in callback.best.get(k, []))))
+        return runs
+
+    def on_train_start(self, trainer, pl_module):
+        self.registry.register_run(self.model_id, self.model_type, pl_module.hparams, self.dirpath)
+        for model_id, dirpath, _ in self._runs(trainer, pl_module):
+            if model_id != self.model_id:
+                k = int(model_id.rsplit("-M", 1)[1])
+                self.registry.register_run(model_id, self.model_type, pl_module.member(k).hparams, dirpath)
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        metrics = trainer.logged_metrics
+        epoch_num = int(metrics["epoch_num"])
+        train_loss = float(metrics["train_loss"]) if "train_loss" in metrics else None
+        self.registry.add_metrics(self.model_id, epoch_num, float(metrics["val_loss"]), train_loss)
+        for model_id, _, _ in self._runs(trainer, pl_module):
+            if model_id != self.model_id:
+                k = model_id.rsplit("-M", 1)[1]
+                train_loss = float(metrics["train_loss_"+k]) if "train_loss_"+k in metrics else None
+                self.registry.add_metrics(model_id, epoch_num, float(metrics["val_loss_"+k]), train_loss)
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        for model_id, _, paths in self._runs(trainer, pl_module):
+            if self.indexed.get(model_id) != paths:
+                self.registry.set_checkpoints(model_id, paths)
+                self.indexed[model_id] = paths
+
+    def on_fit_end(self, trainer, pl_module):
+        for model_id, dirpath, _ in self._runs(trainer, pl_module) or [(self.model_id, self.dirpath, None)]:
+            if os.path.isdir(dirpath):
+                self.registry.sync_checkpoints(model_id, dirpath)
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Index training runs and query the best ones")
+    parser.add_argument('--index', type=int, default=0, help="Index all runs found in checkpoints/. 0 False, else True")
+    parser.add_argument('--best', type=int, default=5, help="Number of best models to print")
+    parser.add_argument('--statics', type=int, default=None, help="Only models with (1) or without (0) statics")
+    parser.add_argument('--hydro', type=int, default=None, help="Only models with (1) or without (0) hydrological signatures")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    registry = RunRegistry()
+    if args.index:
+        print("Indexed runs: ", registry.index_all())
+    filters = {key: value for key, value in [("statics", args.statics), ("hydro", args.hydro)] if value is not None}
+    for model_id, best_epoch, val_nse in registry.best_models(args.best, **filters):
+        print(model_id, best_epoch, round(val_nse, 3))
@@ -0,0 +1,160 @@
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import special
+
+# user functions
+from bootstrap import resample_chunks
+
+
+def batch_linregress(X, Y):
+    """
+    Least-squares regression of every column of Y on every column of X, as scipy.stats.linregress(x, y)
+    for all the pairs at once
+    Args:
+        X : attributes, np.ndarray of size (N, num_attributes)
+        Y : responses (e.g. the NSE of several models), np.ndarray of size (N, num_responses)
+    Returns
+    -------
+        dict "slope", "intercept", "rvalue", "pvalue", "stderr", "intercept_stderr" -> np.ndarray of size (num_responses, num_attributes)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    n = X.shape[0]
+    assert Y.shape[0] == n
+    xmean = X.mean(axis=0)
+    ymean = Y.mean(axis=0)
+    dx = X - xmean
+    dy = Y - ymean
+    # population (co)variances as in linregress, size (num_responses, num_attributes)
+    ssxm = np.mean(dx**2, axis=0)[None, :]
+    ssym = np.mean(dy**2, axis=0)[:, None]
+    ssxym = dy.T @ dx / n
+    return _regression_from_moments(n, xmean[None, :], ymean[:, None], ssxm, ssym, ssxym)
+
+
+def _regression_from_moments(n, xmean, ymean, ssxm, ssym, ssxym):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denom = np.sqrt(ssxm * ssym)
+        r = np.where(denom == 0.0, 0.0, ssxym / denom)
+        r = np.clip(r, -1.0, 1.0)
+        slope = ssxym / ssxm
+        intercept = ymean - slope * xmean
+        df = n - 2
+        TINY = 1.0e-20
+        t = r * np.sqrt(df / ((1.0 - r + TINY)*(1.0 + r + TINY)))
+        # two-sided p-value of the t statistic, stats.t.sf without importing scipy.stats
+        pvalue = 2 * special.stdtr(df, -np.abs(t))
+        stderr = np.sqrt((1 - r**2) * ssym / ssxm / df)
+        intercept_stderr = stderr * np.sqrt(ssxm + xmean**2)
+    return {"slope": slope, "intercept": intercept, "rvalue": r, "pvalue": pvalue, "stderr": stderr, "intercept_stderr": intercept_stderr}
+
+
+def bootstrap_linregress(X, Y, num_resamples=1000, confidence=0.95, seed=42, chunk_size=100):
+    """
+    Percentile bootstrap confidence intervals of the slope and r of batch_linregress(X, Y).
+    Basins are resampled with replacement; each resample is a vector of counts, so the moments of all
+    the (response, attribute) pairs come from matrix products, chunk_size resamples at a time.
+    Returns
+    -------
+        dict "slope_low", "slope_high", "rvalue_low", "rvalue_high" -> np.ndarray of size (num_responses, num_attributes)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    n = X.shape[0]
+    slopes = np.zeros((num_resamples, Y.shape[1], X.shape[1]))
+    rvalues = np.zeros((num_resamples, Y.shape[1], X.shape[1]))
+    for start, indices in resample_chunks(n, num_resamples, seed, chunk_size):
+        end = start + indices.shape[0]
+        # counts of each basin in each resample, size (chunk, N)
+        W = np.zeros((end - start, n))
+        np.add.at(W, (np.arange(end - start)[:, None], indices), 1.0)
+        W /= n
+        xmean = W @ X
+        ymean = W @ Y
+        ssxm = W @ X**2 - xmean**2
+        ssym = W @ Y**2 - ymean**2
+        ssxym = np.einsum("bn,nm,na->bma", W, Y, X) - ymean[:, :, None] * xmean[:, None, :]
+        res = _regression_from_moments(n, xmean[:, None, :], ymean[:, :, None], ssxm[:, None, :], ssym[:, :, None], ssxym)
+        slopes[start:end] = res["slope"]
+        rvalues[start:end] = res["rvalue"]
+    alpha = (1.0 - confidence) / 2.0
+    with np.errstate(invalid="ignore"):
+        # constant attributes have infinite slopes
+        slope_low, slope_high = np.nanquantile(slopes, [alpha, 1.0 - alpha], axis=0)
+        rvalue_low, rvalue_high = np.nanquantile(rvalues, [alpha, 1.0 - alpha], axis=0)
+    return {"slope_low": slope_low, "slope_high": slope_high, "rvalue_low": rvalue_low, "rvalue_high": rvalue_high}
+
+
+def regression_table(X, Y, attributes, responses, num_resamples=1000, confidence=0.95, seed=42):
+    """
+    batch_linregress and bootstrap_linregress of all the pairs in one long table
+    Args:
+        attributes : names of the columns of X
+        responses : names of the columns of Y, e.g. (model_id, metric) tuples
+    Returns
+    -------
+        pd.DataFrame with one row per (response, attribute)
+    """
+    results = batch_linregress(X, Y)
+    if num_resamples > 0:
+        results.update(bootstrap_linregress(X, Y, num_resamples, confidence, seed))
+    response_index, attribute_index = np.meshgrid(np.arange(len(responses)), np.arange(len(attributes)), indexing="ij")
+    table = pd.DataFrame({"response": [responses[i] for i in response_index.ravel()],
+                          "attribute": [attributes[j] for j in attribute_index.ravel()]})
+    for name, values in results.items():
+        table[name] = values.ravel()
+    return table
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Regress the metrics of all the registered models against static attributes and hydrological signatures")
+    parser.add_argument('--model_type', type=str, default=None, help="Only runs of this type in the registry, e.g. lstm or lstm-ae")
+    parser.add_argument('--num_resamples', type=int, default=1000, help="Bootstrap resamples of the confidence intervals")
+    parser.add_argument('--chunk_size', type=int, default=32, help="Basins per forward pass")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    # torch and lightning are only needed to evaluate the models, plotting imports batch_linregress without them
+    from dataset import CamelDataset
+    from registry import RunRegistry
+    from evaluation import evaluate_models, METRICS
+    from feature_store import FeatureStore
+
+    args = parse_args()
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["prcp(mm/day)", "srad(W/m2)", "tmin(C)", "tmax(C)", "vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data()
+    camel_dataset.load_statics()
+    camel_dataset.load_hydro()
+
+    model_ids = RunRegistry().model_ids(args.model_type)
+    print("Screening %d models"%len(model_ids))
+    indices = np.arange(len(camel_dataset))
+    metric_dfs = evaluate_models(model_ids, camel_dataset, indices, chunk_size=args.chunk_size)
+
+    # attributes aligned to the basins of the dataset
+    store = FeatureStore()
+    statics = store.load_frame("statics", camel_dataset.basin_list)
+    hydro = store.load_frame("hydro", camel_dataset.basin_list)
+    attributes = pd.concat([statics, hydro], axis=1)
+
+    responses = [(model_id, metric) for metric in METRICS for model_id in model_ids]
+    Y = np.concatenate([df[model_ids].to_numpy() for df in metric_dfs], axis=1)
+    table = regression_table(attributes.to_numpy(), Y, list(attributes.columns), responses, num_resamples=args.num_resamples)
+    table.insert(0, "model_id", [response[0] for response in table["response"]])
+    table.insert(1, "metric", [response[1] for response in table["response"]])
+    table.drop(columns=["response"], inplace=True)
+    table.to_csv("plot/regression_attributes.csv", sep=" ", index=False)
+    print(table.sort_values("rvalue", key=np.abs, ascending=False).head(20))
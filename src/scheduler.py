@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import fcntl
+import math
+import socket
+import numpy as np
+import torch
+from pytorch_lightning import Callback
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving (ASHA) of training runs.
+    Rungs are placed at min_epoch * reduction_factor**i epochs. When a run reaches a rung it reports
+    its best validation loss so far and it is stopped if it does not rank in the best
+    1/reduction_factor fraction of the runs that reached the same rung.
+    The state is kept in log_dir as append-only JSON lines guarded by a file lock, so that runs of a
+    local process pool and runs in separate (SLURM) processes share the same rungs.
+    A run counts as active while its process is alive (same host) or its heartbeat file was touched
+    within heartbeat_timeout seconds (other hosts), so crashed runs do not stay active forever.
+    """
+    def __init__(self, log_dir="checkpoints/asha", min_epoch=100, reduction_factor=3, max_epoch=20000, min_runs=None,
+                 heartbeat_timeout=3600):
+        """
+        Args:
+            log_dir : folder with rungs.jsonl, decisions.jsonl and runs.jsonl
+            min_epoch : epoch of the first rung
+            reduction_factor : only the best 1/reduction_factor of the runs continue at each rung
+            max_epoch : no rung is placed beyond this epoch
+            min_runs : runs continue as long as fewer than min_runs reached the rung, default reduction_factor
+            heartbeat_timeout : seconds without heartbeat after which a run of another host is no longer active
+        """
+        assert reduction_factor > 1
+        self.log_dir = log_dir
+        self.min_epoch = min_epoch
+        self.reduction_factor = reduction_factor
+        self.max_epoch = max_epoch
+        self.min_runs = reduction_factor if min_runs is None else min_runs
+        self.heartbeat_timeout = heartbeat_timeout
+        self.rungs = []
+        epoch = min_epoch
+        while epoch < max_epoch:
+            self.rungs.append(int(epoch))
+            epoch *= reduction_factor
+        os.makedirs(log_dir, exist_ok=True)
+        self.path_rungs = os.path.join(log_dir, "rungs.jsonl")
+        self.path_decisions = os.path.join(log_dir, "decisions.jsonl")
+        self.path_runs = os.path.join(log_dir, "runs.jsonl")
+        self.path_lock = os.path.join(log_dir, ".lock")
+        self.heartbeat_dir = os.path.join(log_dir, "heartbeats")
+        os.makedirs(self.heartbeat_dir, exist_ok=True)
+
+    def _lock(self):
+        f = open(self.path_lock, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            return []
+        records = []
+        with open(path) as f:
+            for line in f:
+                # skip a line truncated by a crash
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+        return records
+
+    def _append(self, path, record):
+        with open(path, "a") as f:
+            f.write(json.dumps(record)+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, model_id):
+        lock = self._lock()
+        try:
+            self._append(self.path_runs, {"time":time.time(), "model_id":model_id, "status":"running",
+                                          "host":socket.gethostname(), "pid":os.getpid()})
+        finally:
+            lock.close()
+        self.heartbeat(model_id)
+
+    def heartbeat(self, model_id):
+        """
+        Mark a run as alive, by the modification time of its heartbeat file
+        """
+        path = os.path.join(self.heartbeat_dir, model_id)
+        with open(path, "a"):
+            os.utime(path)
+
+    def _alive(self, record):
+        if record.get("host") == socket.gethostname() and "pid" in record:
+            try:
+                os.kill(record["pid"], 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+        path = os.path.join(self.heartbeat_dir, record["model_id"])
+        return os.path.exists(path) and time.time() - os.path.getmtime(path) < self.heartbeat_timeout
+
+    def finish(self, model_id, status="finished"):
+        lock = self._lock()
+        try:
+            self._append(self.path_runs, {"time":time.time(), "model_id":model_id, "status":status})
+        finally:
+            lock.close()
+
+    def active_runs(self, host=None):
+        """
+        Model ids of the runs started, neither stopped nor finished, and still alive, only those of host if given
+        """
+        last = {}
+        for record in self._read(self.path_runs):
+            last[record["model_id"]] = record
+        return [model_id for model_id, record in last.items() if record["status"] == "running" and self._alive(record)
+                and (host is None or record.get("host") == host)]
+
+    def next_rung(self, epoch):
+        """
+        Index of the last rung reached at epoch, -1 if none
+        """
+        reached = [i for i, rung in enumerate(self.rungs) if epoch >= rung]
+        return reached[-1] if reached else -1
+
+    def report(self, model_id, rung, val_loss):
+        """
+        Record the loss of a run at a rung and decide whether it continues
+        Returns
+        -------
+            decision : (str) "continue" or "stop"
+        """
+        lock = self._lock()
+        try:
+            records = [r for r in self._read(self.path_rungs) if r["rung"] == rung]
+            previous = [r for r in records if r["model_id"] == model_id]
+            if previous:
+                # already decided, e.g. the run was resumed
+                val_loss = previous[0]["val_loss"]
+            else:
+                self._append(self.path_rungs, {"model_id":model_id, "rung":rung, "val_loss":val_loss})
+                records.append({"model_id":model_id, "rung":rung, "val_loss":val_loss})
+
+            losses = np.array([r["val_loss"] for r in records])
+            num_runs = len(losses)
+            num_keep = int(math.ceil(num_runs / self.reduction_factor))
+            cutoff = float(np.sort(losses)[num_keep-1])
+            if num_runs < self.min_runs or val_loss <= cutoff:
+                decision = "continue"
+            else:
+                decision = "stop"
+
+            self._append(self.path_decisions, {"time":time.time(), "model_id":model_id, "rung":rung,
+                                               "epoch":self.rungs[rung], "val_loss":val_loss, "cutoff":cutoff,
+                                               "num_runs":num_runs, "decision":decision})
+            if decision == "stop" and not previous:
+                self._append(self.path_runs, {"time":time.time(), "model_id":model_id, "status":"stopped"})
+        finally:
+            lock.close()
+        return decision
+
+    def decisions(self):
+        return self._read(self.path_decisions)
+
+
+class SuccessiveHalvingCallback(Callback):
+    """
+    PyTorch Lightning callback stopping a run when the SuccessiveHalving scheduler says so.
+    The best validation loss so far is taken from the val_loss of trainer.callback_metrics at every
+    validation and kept in the checkpoints, so it survives --resume.
+    num_threads is the thread budget of the node, default the torch threads at creation. At the start and
+    at every rung the run takes num_threads divided by the active runs of its host in the shared runs log,
+    so capacity freed by stopped or finished runs goes to the ones still training, whether they are
+    workers of a sweep or separate processes.
+    """
+    def __init__(self, scheduler, model_id, num_threads=None):
+        super().__init__()
+        self.scheduler = scheduler
+        self.model_id = model_id
+        self.num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+        self.host = socket.gethostname()
+        self.last_rung = -1
+        self.best_loss = float("inf")
+        self.stopped = False
+
+    def _rebalance_threads(self):
+        num_active = max(1, len(self.scheduler.active_runs(host=self.host)))
+        torch.set_num_threads(max(1, self.num_threads // num_active))
+
+    def on_train_start(self, trainer, pl_module):
+        self.scheduler.start(self.model_id)
+        self._rebalance_threads()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        self.scheduler.heartbeat(self.model_id)
+        self.best_loss = min(self.best_loss, float(trainer.callback_metrics["val_loss"]))
+        rung = self.scheduler.next_rung(trainer.current_epoch)
+        if rung <= self.last_rung:
+            return
+        self.last_rung = rung
+        decision = self.scheduler.report(self.model_id, rung, self.best_loss)
+        print("Successive halving, "+self.model_id+" at epoch "+str(trainer.current_epoch)+": "+decision)
+        if decision == "stop":
+            self.stopped = True
+            trainer.should_stop = True
+        else:
+            self._rebalance_threads()
+
+    def on_train_end(self, trainer, pl_module):
+        if not self.stopped:
+            self.scheduler.finish(self.model_id)
+
+    def on_exception(self, trainer, pl_module, exception):
+        self.scheduler.finish(self.model_id, status="failed")
+
+    def state_dict(self):
+        return {"last_rung": self.last_rung, "best_loss": self.best_loss}
+
+    def load_state_dict(self, state_dict):
+        self.last_rung = state_dict["last_rung"]
+        self.best_loss = state_dict["best_loss"]
@@ -0,0 +1,203 @@
+import os
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+
+# pytorch
+import torch
+
+# user functions
+from dataset import CamelDataset
+from metrics import yearly_windows
+from compact_checkpoints import load_model
+from evaluation import predict
+from registry import find_best_epoch
+
+
+# same names and order as camels_hydro.txt
+SIGNATURES = ["q_mean", "runoff_ratio", "slope_fdc", "baseflow_index", "stream_elas", "q5", "q95",
+              "high_q_freq", "high_q_dur", "low_q_freq", "low_q_dur", "zero_q_freq", "hfd_mean"]
+
+
+def _divide(num, den):
+    # nan where the denominator is zero
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=np.float64), np.asarray(den, dtype=np.float64))
+    return np.divide(num, den, out=np.full(num.shape, np.nan), where=den != 0)
+
+
+def _events(condition):
+    """
+    Number of days and of events (runs of consecutive days) where condition holds, per basin
+    """
+    starts = condition.copy()
+    starts[:, 1:] &= ~condition[:, :-1]
+    return condition.sum(axis=1), starts.sum(axis=1)
+
+
+def baseflow(flow, alpha=0.925, passes=3):
+    """
+    Lyne-Hollick digital filter (forward, backward, forward passes as in Ladson et al. 2013),
+    vectorized over the basins
+    Args:
+        flow : np.ndarray of size (num_basins, seq_len)
+    Returns
+    -------
+        baseflow : np.ndarray of size (num_basins, seq_len)
+    """
+    # time on the first axis, so that each step works on a contiguous row of basins
+    q = np.ascontiguousarray(flow.T, dtype=np.float64)
+    c = (1.0 + alpha) / 2.0
+    for i in range(passes):
+        if i % 2 == 1:
+            q = q[::-1]
+        quick = np.zeros_like(q)
+        for t in range(1, q.shape[0]):
+            quick[t] = np.maximum(alpha * quick[t-1] + c * (q[t] - q[t-1]), 0.0)
+        q = np.clip(q - quick, 0.0, q)
+        if i % 2 == 1:
+            q = q[::-1]
+    return np.ascontiguousarray(q.T)
+
+
+def hydro_signatures(flow, prcp, start_date, end_date, basin_ids=None, signatures=SIGNATURES):
+    """
+    Hydrological signatures of camels_hydro.txt (Addor et al. 2017) computed for a batch of basins at once
+        q_mean : mean daily discharge
+        runoff_ratio : mean discharge / mean precipitation
+        slope_fdc : slope of the flow duration curve between the log flows exceeded 33% and 66% of the time
+        baseflow_index : baseflow / discharge, baseflow from the Lyne-Hollick filter
+        stream_elas : median over hydrological years of (dQ/Q) / (dP/P), deviations of the yearly means
+        q5, q95 : 5% (low flow) and 95% (high flow) quantiles of the daily discharge
+        high_q_freq, high_q_dur : days per year and mean duration of the events with flow > 9 * median flow
+        low_q_freq, low_q_dur : days per year and mean duration of the events with flow < 0.2 * mean flow
+        zero_q_freq : fraction of days with zero flow
+        hfd_mean : mean day since October 1 on which the cumulative discharge reaches half of the yearly one
+    Args:
+        flow : streamflow (mm/day) of size (num_basins, seq_len), np.ndarray or tensor
+        prcp : precipitation (mm/day) of size (num_basins, seq_len)
+        start_date, end_date : datetime.date of the first and last day of the series
+        basin_ids : index of the returned frame
+        signatures : names of the signatures to compute, among SIGNATURES
+    Returns
+    -------
+        pd.DataFrame with one row per basin and one column per signature
+    """
+    for name in signatures:
+        if name not in SIGNATURES:
+            raise Exception("Invalid signature provided. Allowed "+", ".join(SIGNATURES))
+    q = np.asarray(flow, dtype=np.float64)
+    p = np.asarray(prcp, dtype=np.float64)
+    assert q.shape == p.shape and q.ndim == 2
+    num_years = q.shape[1] / 365.25
+
+    out = {}
+    q_mean = q.mean(axis=1)
+    out["q_mean"] = q_mean
+    out["runoff_ratio"] = _divide(q_mean, p.mean(axis=1))
+
+    # one partial sort for all the quantiles
+    q05, q34, q50, q67, q95 = np.quantile(q, [0.05, 0.34, 0.5, 0.67, 0.95], axis=1)
+    out["q5"] = q05
+    out["q95"] = q95
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (np.log(q67) - np.log(q34)) / (0.66 - 0.33)
+    out["slope_fdc"] = np.where(np.isfinite(slope), slope, np.nan)
+
+    if "baseflow_index" in signatures:
+        out["baseflow_index"] = _divide(baseflow(q).sum(axis=1), q.sum(axis=1))
+
+    days, events = _events(q > 9.0 * q50[:, None])
+    out["high_q_freq"] = days / num_years
+    out["high_q_dur"] = _divide(days, events)
+    days, events = _events(q < 0.2 * q_mean[:, None])
+    out["low_q_freq"] = days / num_years
+    out["low_q_dur"] = _divide(days, events)
+    out["zero_q_freq"] = (q == 0.0).mean(axis=1)
+
+    if "stream_elas" in signatures or "hfd_mean" in signatures:
+        t0, t1, _ = yearly_windows(start_date, end_date, first_month=10)
+        if len(t0) == 0:
+            raise Exception("stream_elas and hfd_mean need at least one complete hydrological year")
+        q_year = np.stack([q[:, a:b].mean(axis=1) for a, b in zip(t0, t1)], axis=1)
+        p_year = np.stack([p[:, a:b].mean(axis=1) for a, b in zip(t0, t1)], axis=1)
+        dq = _divide(q_year - q_year.mean(axis=1, keepdims=True), q_year.mean(axis=1, keepdims=True))
+        dp = _divide(p_year - p_year.mean(axis=1, keepdims=True), p_year.mean(axis=1, keepdims=True))
+        with warnings.catch_warnings():
+            # all-nan basins (e.g. a single year) are left nan
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            out["stream_elas"] = np.nanmedian(_divide(dq, dp), axis=1)
+        hfd = []
+        for a, b in zip(t0, t1):
+            cumulative = np.cumsum(q[:, a:b], axis=1)
+            hfd.append(np.argmax(cumulative >= 0.5 * cumulative[:, -1:], axis=1))
+        out["hfd_mean"] = np.mean(hfd, axis=0)
+
+    return pd.DataFrame({name: out[name] for name in signatures}, index=basin_ids)
+
+
+def _prcp_index(camel_dataset):
+    for i, attribute in enumerate(camel_dataset.force_attributes):
+        if attribute.lower().startswith("prcp"):
+            return i
+    raise Exception("Precipitation is not among the force attributes of the dataset")
+
+
+def dataset_signatures(camel_dataset, flow=None, indices=None, signatures=SIGNATURES):
+    """
+    Signatures of the basins of camel_dataset, from the observed streamflow or from flow
+    Args:
+        flow : normalized streamflow of size (len(indices), seq_len), e.g. a model output, default observed streamflow
+        indices : basins of camel_dataset, default all
+    Returns
+    -------
+        pd.DataFrame indexed by basin id
+    """
+    if indices is None:
+        indices = np.arange(len(camel_dataset))
+    indices = torch.as_tensor(np.asarray(indices, dtype=int))
+    if flow is None:
+        flow = camel_dataset.input_data[indices].squeeze(-1).squeeze(1)
+    flow = torch.as_tensor(flow).cpu()
+    # back to mm/day
+    flow = flow * (camel_dataset.max_flow - camel_dataset.min_flow) + camel_dataset.min_flow
+    i = _prcp_index(camel_dataset)
+    prcp = camel_dataset.output_data[indices][:, 0, :, i]
+    prcp = prcp * (camel_dataset.max_force[i] - camel_dataset.min_force[i]) + camel_dataset.min_force[i]
+    basin_ids = [camel_dataset.basin_list[idx] for idx in indices.tolist()]
+    return hydro_signatures(flow, prcp, camel_dataset.start_date, camel_dataset.end_date, basin_ids, signatures)
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Hydrological signatures of observed and simulated streamflow")
+    parser.add_argument('--model_ids', type=str, nargs="*", default=[], help="Models whose simulated streamflow is analysed")
+    parser.add_argument('--chunk_size', type=int, default=32, help="Basins per forward pass")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["prcp(mm/day)", "srad(W/m2)", "tmin(C)", "tmax(C)", "vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data()
+    camel_dataset.load_statics()
+    camel_dataset.load_hydro()
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    dirpath = "signatures"
+    os.makedirs(dirpath, exist_ok=True)
+    observed = dataset_signatures(camel_dataset)
+    observed.to_csv(os.path.join(dirpath, "observed.csv"), sep=" ")
+
+    indices = np.arange(len(camel_dataset))
+    for model_id in args.model_ids:
+        model = load_model(model_id, find_best_epoch(model_id))
+        simulated = dataset_signatures(camel_dataset, predict(model, camel_dataset, indices, args.chunk_size, device), indices)
+        simulated.to_csv(os.path.join(dirpath, model_id+".csv"), sep=" ")
+        print(model_id)
+        for name in SIGNATURES:
+            print("  %s: correlation %.3f, median relative error %.3f"%(name,
+                observed[name].corr(simulated[name]),
+                np.nanmedian(np.abs(_divide(simulated[name] - observed[name], observed[name])))))
@@ -0,0 +1,299 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+
+# pytorch
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset, random_split
+import pytorch_lightning as pl
+from pytorch_lightning.callbacks import ModelCheckpoint
+
+
+# user functions
+from dataset import CamelDataset, YearlyCamelsDataset
+from models import Hydro_LSTM, Hydro_LSTM_AE
+from utils import MetricsCallback, NSELoss
+from scheduler import SuccessiveHalving, SuccessiveHalvingCallback
+from registry import RunRegistry, RegistryCallback, find_best_epoch
+
+
+# default values of a sweep configuration, same as the entry points
+DEFAULT_CONFIG = {
+    "model": "lstm",        # "lstm" (LSTM_main.py) or "lstm-ae" (LSTM_AE_main.py)
+    "bidirectional": 1,
+    "noise_dim": 0,
+    "statics": 0,
+    "hydro": 0,
+    "num_features": 27,
+    "decoder": "lstm",      # decoder of "lstm-ae", "lstm" or "tcn"
+    "batch_size": None,     # None for the batch size of the entry point, 1024 for "lstm" and 32 for "lstm-ae"
+    "lr": 1e-5,
+    "seed": 42,
+}
+
+# train and validation periods of the yearly sequences of LSTM_main.py
+TRAIN_DATES = ["1980/10/01", "1995/09/27"]
+VAL_DATES = ["1995/10/01", "2010/09/26"]
+
+# dataset shared by the workers of the pool, set by _init_worker
+_WORKER_STATE = {}
+
+
+def model_id_from_config(config):
+    """
+    Name of the checkpoint folder of a configuration, same naming as LSTM_main.py and LSTM_AE_main.py
+    """
+    if config["model"] == "lstm-ae":
+        model_id = "lstm-ae-bd"+str(bool(config["bidirectional"]))+"-E"+str(config["num_features"])
+        if config["decoder"] != "lstm":
+            model_id += "-"+config["decoder"]
+        return model_id
+    elif config["model"] == "lstm":
+        return "lstm-bd"+str(bool(config["bidirectional"]))+"-N"+str(config["noise_dim"])+"-S"+str(bool(config["statics"]))+"-H"+str(bool(config["hydro"]))
+    else:
+        raise Exception("Invalid model provided. Allowed 'lstm', 'lstm-ae'")
+
+
+def build_model(config, seq_len, num_force_attributes):
+    """
+    Initialize Hydro_LSTM or Hydro_LSTM_AE with the hyperparameters used by the entry points
+    """
+    loss_fn = NSELoss()
+    if config["model"] == "lstm-ae":
+        model = Hydro_LSTM_AE(in_channels=(1,8,16),
+                        out_channels=(8,16,32),
+                        kernel_sizes=(6,7,4),
+                        encoded_space_dim=config["num_features"],
+                        drop_p=0.5,
+                        seq_len=seq_len,
+                        lr = config["lr"],
+                        act=nn.LeakyReLU,
+                        loss_fn=loss_fn,
+                        lstm_hidden_units=256,
+                        layers_num=2,
+                        bidirectional = bool(config["bidirectional"]),
+                        linear=512,
+                        num_force_attributes = num_force_attributes,
+                        warmup = 45,
+                        decoder = config["decoder"])
+    else:
+        assert config["noise_dim"] >= 0
+        model = Hydro_LSTM(lstm_hidden_units = 256,
+                     bidirectional = bool(config["bidirectional"]),
+                     layers_num = 2,
+                     act = nn.LeakyReLU,
+                     loss_fn = loss_fn,
+                     drop_p = 0.5,
+                     seq_len = seq_len,
+                     lr = config["lr"],
+                     weight_decay = 0.0,
+                     num_force_attributes = num_force_attributes,
+                     noise_dim = config["noise_dim"],
+                     statics = bool(config["statics"]),
+                     hydro =  bool(config["hydro"]),
+                     warmup = 45)
+    return model
+
+
+def split_basins(num_basins, model="lstm", seed=42):
+    """
+    Split basin indices 70/15/15 as the entry point of model does: np.random.shuffle after np.random.seed(seed)
+    in LSTM_main.py, random_split after torch.manual_seed(seed) in LSTM_AE_main.py
+    Returns
+    -------
+        train_indices, val_indices, test_indices : lists of int
+    """
+    num_train_data = int(num_basins * 0.7)
+    num_val_data = int(num_basins * 0.15)
+    num_test_data = num_basins - num_train_data - num_val_data
+    if model == "lstm":
+        index_basins = np.arange(num_basins)
+        np.random.RandomState(seed).shuffle(index_basins)
+        index_basins = index_basins.tolist()
+        return [index_basins[:num_train_data], index_basins[num_train_data:num_train_data+num_val_data], index_basins[num_train_data+num_val_data:]]
+    generator = torch.Generator().manual_seed(seed)
+    splits = random_split(range(num_basins), (num_train_data, num_val_data, num_test_data), generator=generator)
+    return [list(split.indices) for split in splits]
+
+
+def share_dataset(camel_dataset):
+    """
+    Move the loaded tensors of a CamelDataset to shared memory, so that worker processes
+    receive a handle to the same storage instead of a copy
+    """
+    for name in ["input_data", "output_data", "statics_data", "hydro_data"]:
+        getattr(camel_dataset, name).share_memory_()
+    return camel_dataset
+
+
+def _init_worker(camel_dataset, splits, num_threads):
+    torch.set_num_threads(num_threads)
+    _WORKER_STATE["dataset"] = camel_dataset
+    _WORKER_STATE["splits"] = splits
+
+
+def train_config(config, max_epochs=20000, check_val_every_n_epoch=10, checkpoint_dir="checkpoints/sweep", device=None, callbacks=None, scheduler=None, num_threads=None):
+    """
+    Train one configuration on the dataset shared with this worker, with the split, sequences and batch size
+    of its entry point: yearly sequences of the train and validation periods for "lstm" as LSTM_main.py,
+    whole series for "lstm-ae" as LSTM_AE_main.py.
+    Checkpoints and metrics are written to checkpoint_dir/<model_id>/, apart from the runs of the entry points
+    If a SuccessiveHalving scheduler is given, the run is stopped early when it falls behind at a rung
+    and the num_threads of the node are rebalanced among the runs that continue.
+    Returns
+    -------
+        model_id : (str)
+        best_epoch : (int) epoch with best validation NSE, None if no validation happened
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    camel_dataset = _WORKER_STATE["dataset"]
+    train_indices, val_indices, _ = _WORKER_STATE["splits"][config["model"]]
+    model_id = model_id_from_config(config)
+    dirpath = os.path.join(checkpoint_dir, model_id)
+
+    torch.manual_seed(config["seed"])
+    np.random.seed(config["seed"])
+
+    if config["model"] == "lstm":
+        train_dataset = YearlyCamelsDataset(train_indices, TRAIN_DATES[0], TRAIN_DATES[1], camel_dataset)
+        val_dataset = YearlyCamelsDataset(val_indices, VAL_DATES[0], VAL_DATES[1], camel_dataset)
+        batch_size = 1024
+    else:
+        train_dataset = Subset(camel_dataset, train_indices)
+        val_dataset = Subset(camel_dataset, val_indices)
+        batch_size = 32
+    if config["batch_size"] is not None:
+        batch_size = config["batch_size"]
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=0, shuffle=True,  drop_last=False)
+    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, num_workers=0, shuffle=False)
+
+    seq_len = train_dataset.seq_len if config["model"] == "lstm" else camel_dataset.seq_len
+    model = build_model(config, seq_len, camel_dataset.num_force_attributes)
+
+    metrics_callback = MetricsCallback(
+        dirpath=dirpath,
+        filename="metrics.bin",
+    )
+
+    checkpoint_model = ModelCheckpoint(
+            save_top_k=10,
+            save_last=True,
+            monitor="val_loss",
+            mode="min",
+            dirpath=dirpath,
+            filename="model-{epoch:02d}",
+        )
+
+    callbacks = list(callbacks or [])
+    callbacks.append(RegistryCallback(RunRegistry(os.path.join(checkpoint_dir, "registry.db")), model_id, dirpath, config["model"]))
+    if scheduler is not None:
+        callbacks.append(SuccessiveHalvingCallback(scheduler, model_id, num_threads=num_threads))
+
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    if device.type == "cuda":
+        devices = [device.index if device.index is not None else 0]
+    else:
+        devices = 1
+
+    trainer = pl.Trainer(max_epochs=max_epochs, callbacks=[checkpoint_model,metrics_callback]+callbacks, accelerator=device.type, devices=devices, check_val_every_n_epoch=check_val_every_n_epoch, logger=False, gradient_clip_val=1.0, gradient_clip_algorithm="value", enable_progress_bar=False)
+    trainer.fit(model=model, train_dataloaders=train_dataloader, val_dataloaders = val_dataloader)
+
+    if os.path.exists(os.path.join(dirpath, "metrics.bin")):
+        best_epoch = find_best_epoch(model_id, checkpoint_dir)
+    else:
+        best_epoch = None
+    return model_id, best_epoch
+
+
+def _train_task(task):
+    config, kwargs = task
+    return train_config(config, **kwargs)
+
+
+def run_sweep(configs, camel_dataset, num_workers=None, num_threads=None, max_epochs=20000, check_val_every_n_epoch=10, checkpoint_dir="checkpoints/sweep", seed=42, scheduler=None):
+    """
+    Train many configurations concurrently on one loaded CamelDataset.
+    The dataset tensors are placed in shared memory once and every worker of the process pool
+    trains one configuration at a time on them. CPU threads are split evenly between workers
+    and, if gpus are available, configurations are assigned to them round robin.
+    Arguments
+    ---------
+        configs : list of dict, each overriding DEFAULT_CONFIG
+        camel_dataset : CamelDataset with data, statics and hydro loaded
+        num_workers : number of concurrent trainings, default min(len(configs), num_cpus)
+        num_threads : torch threads per worker, default num_cpus // num_workers
+        scheduler : optional SuccessiveHalving stopping weak runs at its rungs. A worker freed by a
+                    stopped run takes the next configuration, and once the queue is empty its threads
+                    go to the runs still training
+    Returns
+    -------
+        results : list of (model_id, best_epoch) in completion order
+    """
+    num_cpus = multiprocessing.cpu_count()
+    num_gpus = torch.cuda.device_count()
+    if num_workers is None:
+        num_workers = min(len(configs), num_cpus)
+    if num_threads is None:
+        num_threads = max(1, num_cpus // num_workers)
+
+    share_dataset(camel_dataset)
+    splits = {model: split_basins(len(camel_dataset), model, seed=seed) for model in ["lstm", "lstm-ae"]}
+
+    tasks = []
+    for i, config in enumerate(configs):
+        device = torch.device("cuda", i % num_gpus) if num_gpus > 0 else torch.device("cpu")
+        tasks.append((config, {"max_epochs":max_epochs, "check_val_every_n_epoch":check_val_every_n_epoch, "checkpoint_dir":checkpoint_dir, "device":device,
+                               "scheduler":scheduler, "num_threads":num_cpus}))
+
+    results = []
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(camel_dataset, splits, num_threads)) as pool:
+        for model_id, best_epoch in pool.imap_unordered(_train_task, tasks):
+            print("Finished "+model_id+", best epoch: "+str(best_epoch))
+            results.append((model_id, best_epoch))
+    return results
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Train several configurations concurrently on one loaded dataset")
+    parser.add_argument('--configs', type=str, required=True, help="JSON file with a list of configurations (keys of DEFAULT_CONFIG)")
+    parser.add_argument('--num_workers', type=int, default=None, help="Number of configurations trained concurrently")
+    parser.add_argument('--num_threads', type=int, default=None, help="Torch threads per worker")
+    parser.add_argument('--max_epochs', type=int, default=20000, help="Maximum number of epochs of each configuration")
+    parser.add_argument('--checkpoint_dir', type=str, default="checkpoints/sweep", help="Folder of the checkpoints and run registry of the sweep")
+    parser.add_argument('--asha_dir', type=str, default="", help="Folder of the successive halving scheduler. Empty string disables it")
+    parser.add_argument('--asha_min_epoch', type=int, default=100, help="Epoch of the first successive halving rung")
+    parser.add_argument('--asha_reduction_factor', type=int, default=3, help="Fraction 1/factor of runs continuing at each rung")
+    args=parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.configs) as f:
+        configs = json.load(f)
+
+    ##########################################################
+    # dataset, loaded once for all configurations
+    ##########################################################
+    dates = ["1980/10/01", "2010/09/30"] # interval dates to pick
+    force_attributes = ["PRCP(mm/day)", "SRAD(W/m2)", "Tmin(C)", "Tmax(C)", "Vp(Pa)"] # force attributes to use
+    camel_dataset = CamelDataset(dates, force_attributes)
+    camel_dataset.load_data() # load data
+    camel_dataset.load_statics() # load statics attributes
+    camel_dataset.load_hydro() # load hydrological signatures
+    print("Number of basins: %d" %len(camel_dataset))
+    print("Number of configurations: %d" %len(configs))
+
+    scheduler = None
+    if args.asha_dir:
+        scheduler = SuccessiveHalving(log_dir=args.asha_dir, min_epoch=args.asha_min_epoch, reduction_factor=args.asha_reduction_factor, max_epoch=args.max_epochs)
+
+    results = run_sweep(configs, camel_dataset, num_workers=args.num_workers, num_threads=args.num_threads, max_epochs=args.max_epochs, checkpoint_dir=args.checkpoint_dir, scheduler=scheduler)
+    for model_id, best_epoch in results:
+        print(model_id, best_epoch)
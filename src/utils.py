@@ -2,9 +2,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch import Tensor
+import pytorch_lightning as pl
 from pytorch_lightning import Callback
 import os
-import copy
+import json
 from typing import Tuple
 
 # NLDAS mean/std calculated over all basins in period 01.10.1999 until 30.09.2008
@@ -79,30 +80,173 @@ class Globally_Scale_Data:
         return x
 
 ### callbacks
+class MetricsLog:
+    """
+    Append-only log of per-epoch metrics.
+    Each record is a fixed-width row of float64 appended to path, the column names are written to
+    path+".json". A metric first logged after the first record starts a new segment of wider rows at the
+    current end of the file, so no metric is dropped. Appending is O(1) and a row torn by a crash is dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.path_columns = path + ".json"
+        self.segments = []
+        self.columns = None
+        if os.path.exists(self.path_columns):
+            self.segments = _read_segments(self.path_columns)
+            self.columns = self.segments[-1]["columns"]
+            # drop a partially written last row before appending again
+            if os.path.exists(self.path):
+                row_size = 8 * len(self.columns)
+                size = os.path.getsize(self.path)
+                torn = (size - self.segments[-1]["offset"]) % row_size
+                if torn != 0:
+                    os.truncate(self.path, size - torn)
+
+    def _new_segment(self, columns):
+        # the segment is on disk before any of its rows
+        offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.segments.append({"offset":offset, "columns":columns})
+        self.columns = columns
+        tmp = self.path_columns + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"columns":columns, "segments":self.segments}, f)
+        os.replace(tmp, self.path_columns)
+
+    def append(self, metrics):
+        """
+        Append one record, metrics is a dict of floats or 0-dim tensors.
+        Missing metrics are NaN, new ones widen the rows from this record on
+        """
+        keys = set(key for key in metrics if key != "epoch_num")
+        if self.columns is None or not keys.issubset(self.columns):
+            previous = set(self.columns[1:]) if self.columns is not None else set()
+            self._new_segment(["epoch_num"] + sorted(previous | keys))
+        row = np.array([float(metrics[key]) if key in metrics else np.nan for key in self.columns], dtype=np.float64)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, row.tobytes())
+        finally:
+            os.close(fd)
+
+
+def _read_segments(path_columns):
+    with open(path_columns) as f:
+        header = json.load(f)
+    # logs written before segments have a single one
+    return header.get("segments", [{"offset":0, "columns":header["columns"]}])
+
+
+def read_metrics(path):
+    """
+    Read a MetricsLog
+    Returns
+    -------
+        epochs : np.ndarray of int
+        metrics : dict of np.ndarray, one array per logged metric, aligned with epochs, NaN before a metric was logged
+    """
+    segments = _read_segments(path + ".json")
+    raw = np.fromfile(path, dtype=np.uint8)
+    blocks = []
+    for i, segment in enumerate(segments):
+        end = segments[i+1]["offset"] if i + 1 < len(segments) else len(raw)
+        row_size = 8 * len(segment["columns"])
+        # drop a torn last row
+        data = raw[segment["offset"]:end]
+        data = data[:len(data) - len(data) % row_size].view(np.float64).reshape(-1, len(segment["columns"]))
+        blocks.append((segment["columns"], data))
+    columns = segments[-1]["columns"]
+    metrics = {key: np.concatenate([data[:, cols.index(key)] if key in cols else np.full(len(data), np.nan) for cols, data in blocks]) for key in columns}
+    return metrics["epoch_num"].astype(int), metrics
+
+
 class MetricsCallback(Callback):
     """
     PyTorch Lightning metric callback.
-    Save logged metrics
+    Append logged metrics to a MetricsLog at every validation (sanity check excluded)
     """
 
-    def __init__(self, dirpath, filename):
+    def __init__(self, dirpath, filename="metrics.bin"):
         super().__init__()
         self.dirpath = dirpath
         self.filename = filename
         self.path = os.path.join(dirpath, filename)
-        exists = os.path.exists(self.path)
-        # if already exists a saving, load it and update
-        if exists:
-            self.dict_metrics = torch.load(self.path, map_location=torch.device('cpu'))
-        else:
-            os.makedirs(self.dirpath, exist_ok = True) 
-            self.dict_metrics = {}
+        os.makedirs(self.dirpath, exist_ok = True) 
+        # if already exists a saving, keep appending to it
+        self.metrics_log = MetricsLog(self.path)
             
         
     def on_validation_epoch_end(self,trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        self.metrics_log.append(trainer.logged_metrics)
+
+
+class EnsembleCheckpoint(Callback):
+    """
+    PyTorch Lightning callback for Hydro_LSTM_Ensemble.
+    Each member k gets its own folder dirpath-M<k>/ with metrics.bin, the save_top_k best
+    model-epoch=XX.ckpt and, at the end of training, last.ckpt, loadable with Hydro_LSTM.load_from_checkpoint.
+    The top-k of every member is kept in the checkpoint of the packed model, so it survives --resume.
+    Member checkpoints are written and removed by the checkpoint IO of the trainer, e.g. AsyncAtomicCheckpointIO
+    """
+
+    def __init__(self, dirpath, save_top_k=10):
+        super().__init__()
+        self.dirpath = dirpath.rstrip("/")
+        self.save_top_k = save_top_k
+        self.logs = {}
+        self.best = {}
+
+    def member_dirpath(self, k):
+        return self.dirpath+"-M"+str(k)
+
+    def _save_member(self, trainer, member, path):
+        checkpoint = {
+            "epoch": trainer.current_epoch,
+            "global_step": trainer.global_step,
+            "pytorch-lightning_version": pl.__version__,
+            "state_dict": member.state_dict(),
+            "hyper_parameters": dict(member.hparams),
+        }
+        trainer.strategy.checkpoint_io.save_checkpoint(checkpoint, path)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
         epoch_num = int(trainer.logged_metrics["epoch_num"].cpu().item())
-        self.dict_metrics["Epoch: "+str(epoch_num)] = copy.deepcopy(trainer.logged_metrics)
-        torch.save(self.dict_metrics, self.path)
+        for k in range(pl_module.num_members):
+            dirpath = self.member_dirpath(k)
+            os.makedirs(dirpath, exist_ok=True)
+            val_loss = trainer.logged_metrics["val_loss_"+str(k)].detach().cpu()
+            # metrics in the same format as MetricsCallback
+            if k not in self.logs:
+                self.logs[k] = MetricsLog(os.path.join(dirpath, "metrics.bin"))
+            self.logs[k].append({"epoch_num":epoch_num, "val_loss":val_loss})
+
+            # keep the save_top_k best checkpoints of the member
+            best = self.best.setdefault(k, [])
+            path = os.path.join(dirpath, "model-epoch=%02d.ckpt"%trainer.current_epoch)
+            if len(best) < self.save_top_k or val_loss.item() < best[-1][0]:
+                self._save_member(trainer, pl_module.member(k), path)
+                best.append((val_loss.item(), path))
+                best.sort(key=lambda b: b[0])
+                while len(best) > self.save_top_k:
+                    _, worst_path = best.pop()
+                    trainer.strategy.checkpoint_io.remove_checkpoint(worst_path)
+
+    def on_train_end(self, trainer, pl_module):
+        for k in range(pl_module.num_members):
+            dirpath = self.member_dirpath(k)
+            os.makedirs(dirpath, exist_ok=True)
+            self._save_member(trainer, pl_module.member(k), os.path.join(dirpath, "last.ckpt"))
+
+    def state_dict(self):
+        return {"best": {k: list(best) for k, best in self.best.items()}}
+
+    def load_state_dict(self, state_dict):
+        self.best = {int(k): [tuple(b) for b in best] for k, best in state_dict["best"].items()}
 
 
 class NSELoss(nn.Module):
@@ -165,7 +309,7 @@ class PFAB():
         if self.reduction == "mean":
             out = torch.mean(out)
         elif self.reduction == "sum":
-            NSE = torch.sum(out)
+            out = torch.sum(out)
         elif self.reduction==None:
             pass
         else:
@@ -176,30 +320,35 @@ class PFAB():
 
 
 
-def find_best_epoch(model_id):
-        """
-        Find the epoch at which the validation error is minimized, or quivalently
-        when thevalidation NSE is maximized
-        Returns
-        -------
-            best_epoch : (int)
-        """
-        dirpath = os.path.join("checkpoints", model_id)
-        path_metrics = os.path.join(dirpath, "metrics.pt")
-        data = torch.load(path_metrics, map_location=torch.device('cpu'))
-        epochs_mod = []
-        nse_mod = []
-        for key in data:
-            epoch_num = data[key]["epoch_num"]
-            nse = -data[key]["val_loss"]
-            if isinstance(epoch_num, int):
-                epochs_mod.append(epoch_num)
-                nse_mod.append(nse)
-            else:
-                epochs_mod.append(int(epoch_num.item()))
-                nse_mod.append(nse.item())
-        idx_ae = np.argmax(nse_mod)
-        return int(epochs_mod[idx_ae])
+def load_metrics(path):
+    """
+    Read the validation history saved by MetricsCallback, either a MetricsLog
+    or a dictionary saved with torch.save by older runs (.pt)
+    Returns
+    -------
+        epochs : np.ndarray of int, sorted
+        val_loss : np.ndarray of float, validation loss at epochs
+    """
+    if path.endswith(".pt"):
+        data = torch.load(path, map_location=torch.device('cpu'))
+        epochs = np.array([int(data[key]["epoch_num"]) for key in data])
+        val_loss = np.array([float(data[key]["val_loss"]) for key in data])
+    else:
+        epochs, metrics = read_metrics(path)
+        val_loss = metrics["val_loss"]
+    order = np.argsort(epochs, kind="stable")
+    return epochs[order], val_loss[order]
+
+
+def metrics_path(model_id, checkpoint_dir="checkpoints"):
+    """
+    Path of the metrics of a model, metrics.bin or metrics.pt for older runs
+    """
+    dirpath = os.path.join(checkpoint_dir, model_id)
+    path = os.path.join(dirpath, "metrics.bin")
+    if not os.path.exists(path) and os.path.exists(os.path.join(dirpath, "metrics.pt")):
+        path = os.path.join(dirpath, "metrics.pt")
+    return path
 
 
 def reshape_data(x: np.ndarray, y: np.ndarray, seq_length: int) -> Tuple[np.ndarray, np.ndarray]: